@@ -7,13 +7,12 @@ To install put into:
     ~/.local/share/albert/org.albert.extension.python/modules/brotab_search.py
 """
 
-import os
 import time
 import subprocess
 
 from albert import QueryHandler, Item, info, Action, runDetachedProcess
 
-from brotab.search.query import query as brotab_query
+from brotab.search.query import QueryEngine
 
 __title__ = "BroTab Search"
 __version__ = "0.1"
@@ -32,21 +31,30 @@ md_url = "https://github.com/balta2ar/brotab"
 md_maintainers = "@balta2ar"
 
 SQL_DB_FILENAME = '/tmp/tabs.sqlite'
-SQL_DB_TTL_SECONDS = 5 * 60
-QUERY_DELAY = 0.3
+# queries are cheap with a warm engine, the delay only skips keystrokes
+# that are typed quickly
+QUERY_DELAY = 0.1
 
+ENGINE = QueryEngine(SQL_DB_FILENAME)
 
-def refresh_index():
-    info('Brotab: refreshing index')
-    subprocess.Popen(['bt', 'index'])
 
+WATCHER = None
 
-def need_refresh_index():
-    if not os.path.isfile(SQL_DB_FILENAME):
-        return True
 
-    mtime = os.stat(SQL_DB_FILENAME).st_mtime
-    return time.time() - mtime > SQL_DB_TTL_SECONDS
+def start_watcher():
+    """
+    Keep the index up to date in the background. If another watcher runs
+    already, the new one exits immediately with 0 and isn't restarted.
+    """
+    global WATCHER
+    if WATCHER is None or WATCHER.poll() not in (None, 0):
+        info('Brotab: starting index watcher')
+        WATCHER = subprocess.Popen(['bt', 'index', '--watch', '--sqlite', SQL_DB_FILENAME])
+
+
+def stop_watcher():
+    if WATCHER is not None and WATCHER.poll() is None:
+        WATCHER.terminate()
 
 
 def handleQuery(query):
@@ -64,8 +72,7 @@ def handleQuery(query):
     if not query.isValid:
         return None
 
-    if need_refresh_index():
-        refresh_index()
+    start_watcher()
 
     items = []
 
@@ -85,8 +92,8 @@ def handleQuery(query):
         ))
 
     info('query %s' % user_query)
-    query_results = brotab_query(
-        SQL_DB_FILENAME, user_query, max_tokens=20, max_results=100, marker_cut='')
+    query_results = ENGINE.query(
+        user_query, max_tokens=20, max_results=100, marker_cut='')
     info('brotab search: %s results' % len(query_results))
     for query_result in query_results:
         items.append(Item(
@@ -109,8 +116,13 @@ class Plugin(QueryHandler):
     def id(self): return md_id
     def name(self): return md_name
     def description(self): return md_description
-    def initialize(self): info('brotab initialize')
-    def finalize(self): info('brotab finalize')
+    def initialize(self):
+        info('brotab initialize')
+        start_watcher()
+    def finalize(self):
+        info('brotab finalize')
+        stop_watcher()
+        ENGINE.close()
     def defaultTrigger(self): return __triggers__
     def handleQuery(self, query):
         info('brotab handleQuery')
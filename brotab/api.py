@@ -3,97 +3,259 @@ import json
 import logging
 import socket
 import sys
+import zlib
 from collections.abc import Mapping
 from copy import deepcopy
-from functools import partial
+from http.client import HTTPException
 from http.client import RemoteDisconnected
+from itertools import islice
 from json import dumps
 from traceback import print_exc
+from typing import Iterator
 from typing import List
 from urllib.error import HTTPError
 from urllib.error import URLError
 from urllib.parse import quote_plus
-from urllib.request import Request
-from urllib.request import urlopen
 
+from brotab.compression import ACCEPT_ENCODING
+from brotab.compression import Decoder
+from brotab.compression import LineSplitter
+from brotab.compression import is_local_host
+from brotab.const import HTTP_TIMEOUT
+from brotab.const import TAB_COLUMNS_MIMETYPE
 from brotab.env import http_iface
+from brotab.env import mediator_timeout
+from brotab.http_pool import ConnectionPool
+from brotab.http_pool import default_pool
 from brotab.inout import MultiPartForm
 from brotab.inout import edit_tabs_in_editor
+from brotab.mediator.support import is_valid_integer
 from brotab.operations import infer_all_commands
-from brotab.parallel import call_parallel
+from brotab.parallel import merge_iterators
+from brotab.parallel import scatter_gather
+from brotab.tab import Tab
 from brotab.tab import parse_tab_lines
+from brotab.tab import tabs_from_columns
 from brotab.utils import encode_query
+from brotab.utils import fast_json_loads
 from brotab.wait import ConditionTrue
 from brotab.wait import Waiter
 
 logger = logging.getLogger('brotab')
 
-HTTP_TIMEOUT = 10.0
 MAX_NUMBER_OF_TABS = 5000
+# bytes of a compressed body read at a time
+READ_SIZE = 64 * 1024
+# requests that are safe to send again when a reused connection fails
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+
+def form_body(files):
+    """Encode {filename: text} as a multipart form, return body and headers."""
+    form = MultiPartForm()
+    for filename, content in files.items():
+        form.add_file(filename, filename,
+                      io.BytesIO(content.encode('utf8')))
+
+    data = bytes(form)
+    return data, {
+        'Content-Type': form.get_content_type(),
+        'Content-Length': str(len(data)),
+    }
+
+
+def json_body(body):
+    """Encode `body` as JSON, return body and headers."""
+    data = json.dumps(body).encode('utf8')
+    return data, {'Content-Type': 'application/json', 'Content-Length': str(len(data))}
 
 
 class HttpClient:
-    def __init__(self, host='localhost', port=4625, timeout=HTTP_TIMEOUT):
+    """
+    Sends requests to a mediator over keep-alive connections taken from a
+    pool that is shared by all clients in the process.
+
+    With `compress` responses are asked for compressed (see
+    brotab.compression), by default only from mediators on other machines.
+    """
+
+    def __init__(self, host='localhost', port=4625, timeout=HTTP_TIMEOUT, pool: ConnectionPool = None,
+                 compress: bool = None):
         self._host: str = host
         self._port: int = port
         self._timeout: float = timeout
+        self._pool: ConnectionPool = default_pool() if pool is None else pool
+        self._compress: bool = not is_local_host(host) if compress is None else compress
 
-    def get(self, path, data=None):
+    def get(self, path, data=None, timeout=None, headers=None):
         url = 'http://%s:%s%s' % (self._host, self._port, path)
         logger.info('GET %s' % url)
         if data is not None:
             data = data.encode('utf8')
-        request = Request(url=url, data=data, method='GET')
-
-        with urlopen(request, timeout=self._timeout) as response:
-            return response.read().decode('utf8')
+        return self._request('GET', path, data, headers or {}, timeout).decode('utf8')
 
     def post(self, path, files=None):
         url = 'http://%s:%s%s' % (self._host, self._port, path)
         logger.info('POST %s' % url)
-        form = MultiPartForm()
-        for filename, content in files.items():
-            form.add_file(filename, filename,
-                          io.BytesIO(content.encode('utf8')))
+        data, headers = form_body(files)
+        return self._request('POST', path, data, headers).decode('utf8')
 
-        data = bytes(form)
-        request = Request(url=url, data=data, method='POST')
-        request.add_header('Content-Type', form.get_content_type())
-        request.add_header('Content-Length', str(len(data)))
+    def post_json(self, path, body, timeout=None):
+        url = 'http://%s:%s%s' % (self._host, self._port, path)
+        logger.info('POST %s' % url)
+        data, headers = json_body(body)
+        return self._request('POST', path, data, headers, timeout).decode('utf8')
+
+    def iter_lines(self, path, timeout=None, body=None) -> Iterator[str]:
+        """
+        GET a response (or POST `body` as JSON if it's given) and yield its
+        lines as they arrive, without holding the whole body in memory.
+        `timeout` applies to every read.
+        """
+        if body is None:
+            connection, response = self._open('GET', path, None, {}, timeout)
+        else:
+            data, headers = json_body(body)
+            connection, response = self._open('POST', path, data, headers, timeout)
+        decoder = self._decoder(connection, response)
+        try:
+            if decoder is None:
+                for line in response:
+                    yield line.decode('utf8').rstrip('\n')
+            else:
+                splitter = LineSplitter()
+                for chunk in self._iter_body(response):
+                    for line in splitter.feed(decoder.decompress(chunk)):
+                        yield line.decode('utf8')
+                for line in splitter.feed(decoder.flush()) + splitter.finish():
+                    yield line.decode('utf8')
+        except (OSError, HTTPException, zlib.error) as e:
+            connection.close()
+            raise URLError(e)
+        except GeneratorExit:
+            # the rest of the body is still in the connection
+            connection.close()
+            raise
+        self._finish(connection, response)
+
+    def _request(self, method, path, data, headers, timeout=None) -> bytes:
+        connection, response = self._open(method, path, data, headers, timeout)
+        decoder = self._decoder(connection, response)
+        try:
+            if decoder is None:
+                body = response.read()
+            else:
+                body = decoder.decompress_all(self._iter_body(response))
+        except socket.timeout:
+            connection.close()
+            raise
+        except (OSError, HTTPException, zlib.error) as e:
+            connection.close()
+            raise URLError(e)
+        self._finish(connection, response)
+        return body
+
+    def _open(self, method, path, data, headers, timeout=None):
+        """Send a request, return the connection and the response to read."""
+        url = 'http://%s:%s%s' % (self._host, self._port, path)
+        timeout = self._timeout if timeout is None else timeout
+        if self._compress:
+            headers = dict(headers, **{'Accept-Encoding': ACCEPT_ENCODING})
+        while True:
+            connection, reused = self._pool.acquire(self._host, self._port, timeout)
+            sent = False
+            try:
+                connection.request(method, path, body=data, headers=headers)
+                sent = True
+                response = connection.getresponse()
+            except (RemoteDisconnected, ConnectionResetError, BrokenPipeError, ConnectionAbortedError):
+                connection.close()
+                # the mediator may have closed the idle connection before the
+                # request reached it. It's sent again only if it didn't go out
+                # in full or can be repeated: a POST that the mediator did get
+                # (e.g. open_urls) must not be done twice
+                if reused and (not sent or method in IDEMPOTENT_METHODS):
+                    continue
+                raise
+            except socket.timeout:
+                connection.close()
+                raise
+            except (OSError, HTTPException) as e:
+                connection.close()
+                raise URLError(e)
+
+            if response.status != 200:
+                response.read()
+                self._finish(connection, response)
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            return connection, response
+
+    @staticmethod
+    def _iter_body(response):
+        """Yield pieces of the body as they arrive."""
+        while True:
+            chunk = response.read1(READ_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        # marks the response as read, the connection is ready for the next
+        # request
+        response.read()
+
+    @staticmethod
+    def _decoder(connection, response):
+        try:
+            return Decoder.for_encoding(response.getheader('Content-Encoding'))
+        except ValueError as e:
+            connection.close()
+            raise URLError(e)
 
-        with urlopen(request, timeout=self._timeout) as response:
-            return response.read().decode('utf8')
+    def _finish(self, connection, response) -> None:
+        if response.will_close:
+            connection.close()
+        else:
+            self._pool.release(connection)
 
 
 class StartupTimeout(BaseException):
     pass
 
 
-class SingleMediatorAPI(object):
+NETWORK_ERRORS = (URLError, HTTPError, socket.timeout, RemoteDisconnected, ConnectionResetError)
+ERROR_BROWSER = '<ERROR>'
+
+
+def fetch_pid(client: HttpClient, timeout: float = None) -> int:
+    """Get process ID from the mediator."""
+    try:
+        return int(client.get('/get_pid', timeout=timeout))
+    except NETWORK_ERRORS as e:
+        logger.info('_get_pid failed: %s', e)
+    return -1
+
+
+def fetch_browser(client: HttpClient, timeout: float = None) -> str:
+    """Get browser name from the mediator."""
+    try:
+        return client.get('/get_browser', timeout=timeout)
+    except NETWORK_ERRORS as e:
+        logger.info('_get_browser failed: %s', e)
+    return ERROR_BROWSER
+
+
+class BaseMediatorAPI(object):
     """
-    This API is designed to work with a single mediator.
+    Tab ids and request paths of a single mediator, everything that
+    SingleMediatorAPI and its asyncio counterpart (brotab.async_api) have in
+    common besides the I/O.
     """
 
-    def __init__(self, prefix, host='localhost', port=4625, startup_timeout: float = None, client: HttpClient = None):
+    def __init__(self, prefix, host='localhost', port=4625):
         self._prefix = '%s.' % prefix
         self._host = host
         self._port = port
-        self._client = HttpClient(host=host, port=port) if client is None else client
-        if startup_timeout is not None:
-            self.must_ready(timeout=startup_timeout)
-        self._pid = self.get_pid()
-        self._browser = self.get_browser()
-
-    def must_ready(self, timeout: float) -> None:
-        condition = ConditionTrue(lambda: self.get_pid() != -1)
-        if not Waiter(condition).wait(timeout=timeout):
-            raise StartupTimeout('Failed to start in %s seconds' % timeout)
-
-    def pid_ready(self) -> bool:
-        return self.get_pid() != -1
-
-    def pid_not_ready(self) -> bool:
-        return not self.pid_ready()
+        self._pid = -1
+        self._browser = ERROR_BROWSER
 
     @property
     def browser(self) -> str:
@@ -101,7 +263,11 @@ class SingleMediatorAPI(object):
 
     @property
     def ready(self) -> bool:
-        return self._browser != '<ERROR>'
+        return self._browser != ERROR_BROWSER
+
+    @property
+    def prefix(self) -> str:
+        return self._prefix[:-1]
 
     def __str__(self):
         return '%s\t%s:%s\t%s\t%s' % (
@@ -130,34 +296,191 @@ class SingleMediatorAPI(object):
     def _split_tabs(self, tabs):
         return [tab.split('.') for tab in tabs]
 
+    def _close_tabs_path(self, args):
+        tabs = ','.join(tab_id for _prefix, _window_id,
+                                   tab_id in self._split_tabs(args))
+        return '/close_tabs/%s' % tabs
+
+    @staticmethod
+    def _activate_tab_path(args: List[str], focused: bool):
+        # args: ['a.1.2']
+        _prefix, _window_id, tab_id = args[0].split('.')
+        return '/activate_tab/%s%s' % (tab_id, '?focused=1' if focused else '')
+
+    @staticmethod
+    def _query_tabs_path(args):
+        """Return None if the query is not a JSON object."""
+        query = args
+        if isinstance(query, str):
+            try:
+                query = json.loads(query)
+                if not isinstance(query, Mapping):
+                    raise json.JSONDecodeError("json has attributes unsupported by brotab.", "", 0)
+            except json.JSONDecodeError as e:
+                print("Cannot decode JSON: %s: %s" % (__name__, e), file=sys.stderr)
+                return None
+        return '/query_tabs/%s' % encode_query(json.dumps(query))
+
+    @staticmethod
+    def _num_tabs(args):
+        return int(args[0]) if len(args) > 0 else MAX_NUMBER_OF_TABS
+
+    def _tab_records(self, body: str, limit) -> List[Tab]:
+        """
+        Tab objects of a reply to a request that accepts the columnar format.
+        A mediator that doesn't support it replies with tab lines, these
+        start with a digit, never with "{".
+        """
+        if body.startswith('{'):
+            return tabs_from_columns(self.prefix, fast_json_loads(body), limit)
+        return parse_tab_lines(self.prefix_tabs(body.splitlines()[:limit]))
+
+    def _prefix_delta(self, delta: dict) -> dict:
+        delta['changed'] = [{'tab': self.prefix_tab(change['line']),
+                             'index': change['index'],
+                             'status': change.get('status')}
+                            for change in delta['changed']]
+        delta['removed'] = self.prefix_tabs(delta['removed'])
+        return delta
+
+    @staticmethod
+    def _move_tabs_path(args):
+        commands = ','.join(
+            '%s %s %s' % (tab_id, window_id, new_index)
+            for tab_id, window_id, new_index in args)
+        return '/move_tabs/%s' % quote_plus(commands)
+
+    @staticmethod
+    def _script_options_query(concurrency=None, script_timeout=None):
+        """
+        Query parameters that limit how many tabs the browser runs a script
+        in at a time and how long it waits for a single tab (seconds).
+        """
+        query = ''
+        if concurrency is not None:
+            query += '&concurrency=%d' % concurrency
+        if script_timeout is not None:
+            query += '&timeout=%s' % script_timeout
+        return query
+
+    def _words_path(self, tab_ids, match_regex, join_with, concurrency=None, script_timeout=None):
+        """Return None if none of tab_ids belong to this mediator."""
+        path = '/get_words?match_regex=%s&join_with=%s%s' % (
+            encode_query(match_regex), encode_query(join_with),
+            self._script_options_query(concurrency, script_timeout))
+        if tab_ids:
+            own_tab_ids, _window_ids = self.split_tab_and_window_ids(tab_ids)
+            if not own_tab_ids:
+                return None
+            path += '&tab_ids=%s' % ','.join(map(str, own_tab_ids))
+        return path
+
+    def split_tab_and_window_ids(self, ids):
+        """
+        Return ids of tabs (<prefix>.<window_id>.<tab_id>) and windows
+        (<prefix>.<window_id>) from `ids` that belong to this mediator.
+        Raise ValueError if one of them is malformed.
+        """
+        tab_ids, window_ids = [], []
+        for id_ in ids:
+            parts = id_.split('.')
+            if parts[0] + '.' != self._prefix:
+                continue
+            if not all(is_valid_integer(part) for part in parts[1:]):
+                raise ValueError('Invalid tab or window id: %s' % id_)
+            if len(parts) == 3:
+                tab_ids.append(int(parts[2]))
+            elif len(parts) == 2:
+                window_ids.append(int(parts[1]))
+        return tab_ids, window_ids
+
+    def _text_or_html_path(self, command, delimiter_regex, replace_with, tab_ids=None,
+                           concurrency=None, script_timeout=None):
+        """
+        If tab_ids is given, only tabs and windows from it are processed by
+        the browser. Returns None if none of them belong to this mediator,
+        there is nothing to ask the browser then.
+        """
+        path = '/%s?delimiter_regex=%s&replace_with=%s' % (
+            command,
+            encode_query(delimiter_regex),
+            encode_query(replace_with),
+        ) + self._script_options_query(concurrency, script_timeout)
+        if tab_ids:
+            own_tab_ids, own_window_ids = self.split_tab_and_window_ids(tab_ids)
+            if not own_tab_ids and not own_window_ids:
+                return None
+            if own_tab_ids:
+                path += '&tab_ids=%s' % ','.join(map(str, own_tab_ids))
+            if own_window_ids:
+                path += '&window_ids=%s' % ','.join(map(str, own_window_ids))
+        return path
+
+    def own_updates(self, all_updates):
+        """Updates of the tabs of this mediator, with tab ids the browser expects."""
+        updates = [deepcopy(u) for u in all_updates if self.prefix_match(u['tab_id'])]
+        for u in updates:
+            u['tab_id'] = int_tab_id(u['tab_id'])
+        return updates
+
+    def own_hashes(self, hashes):
+        """
+        Convert {<prefix>.<window_id>.<tab_id>: hash} to {<tab_id>: hash}
+        of the tabs of this mediator, that's what the browser expects.
+        """
+        if not hashes:
+            return None
+        own = {}
+        for tab_id, hash_ in hashes.items():
+            parts = tab_id.split('.')
+            if len(parts) == 3 and parts[0] + '.' == self._prefix:
+                own[parts[2]] = hash_
+        return own or None
+
+
+class SingleMediatorAPI(BaseMediatorAPI):
+    """
+    This API is designed to work with a single mediator.
+    """
+
+    def __init__(self, prefix, host='localhost', port=4625, startup_timeout: float = None, client: HttpClient = None,
+                 pid: int = None, browser: str = None):
+        super().__init__(prefix, host, port)
+        self._client = HttpClient(host=host, port=port) if client is None else client
+        if startup_timeout is not None:
+            self.must_ready(timeout=startup_timeout)
+        # pid and browser are known upfront when mediators are discovered
+        # in bulk, see brotab.discovery
+        self._pid = self.get_pid() if pid is None else pid
+        self._browser = self.get_browser() if browser is None else browser
+
+    def must_ready(self, timeout: float) -> None:
+        condition = ConditionTrue(lambda: self.get_pid() != -1)
+        if not Waiter(condition).wait(timeout=timeout):
+            raise StartupTimeout('Failed to start in %s seconds' % timeout)
+
+    def pid_ready(self) -> bool:
+        return self.get_pid() != -1
+
+    def pid_not_ready(self) -> bool:
+        return not self.pid_ready()
+
     def get_pid(self):
         """Get process ID from the mediator."""
-        try:
-            return int(self._get('/get_pid'))
-        except (URLError, HTTPError, socket.timeout, RemoteDisconnected, ConnectionResetError) as e:
-            logger.info('_get_pid failed: %s', e)
-        return -1
+        return fetch_pid(self._client)
 
     def get_browser(self):
         """Get browser name from the mediator."""
-        try:
-            return self._get('/get_browser')
-        except (URLError, HTTPError, socket.timeout, RemoteDisconnected, ConnectionResetError) as e:
-            logger.info('_get_browser failed: %s', e)
-        return '<ERROR>'
+        return fetch_browser(self._client)
 
     def close_tabs(self, args):
-        tabs = ','.join(tab_id for _prefix, _window_id,
-                                   tab_id in self._split_tabs(args))
-        return self._get('/close_tabs/%s' % tabs)
+        return self._get(self._close_tabs_path(args))
 
     def activate_tab(self, args: List[str], focused: bool):
         if len(args) == 0:
             return
 
-        # args: ['a.1.2']
-        _prefix, _window_id, tab_id = args[0].split('.')
-        self._get('/activate_tab/%s%s' % (tab_id, '?focused=1' if focused else ''))
+        self._get(self._activate_tab_path(args, focused))
 
     def get_active_tabs(self, args) -> List[str]:
         return [self.prefix_tab(tab) for tab in self._get('/get_active_tabs').split(',')]
@@ -166,17 +489,11 @@ class SingleMediatorAPI(object):
         return self._get('/get_screenshot')
 
     def query_tabs(self, args):
-        query = args
-        if isinstance(query, str):
-            try:
-                query = json.loads(query)
-                if not isinstance(query, Mapping):
-                    raise json.JSONDecodeError("json has attributes unsupported by brotab.", "", 0)
-            except json.JSONDecodeError as e:
-                print("Cannot decode JSON: %s: %s" % (__name__, e), file=sys.stderr)
-                return []
+        path = self._query_tabs_path(args)
+        if path is None:
+            return []
 
-        result = self._get('/query_tabs/%s' % encode_query(json.dumps(query)))
+        result = self._get(path)
         lines = result.splitlines()[:MAX_NUMBER_OF_TABS]
         return self.prefix_tabs(lines)
 
@@ -196,15 +513,44 @@ class SingleMediatorAPI(object):
         return tabs
 
     def list_tabs(self, args):
-        num_tabs = MAX_NUMBER_OF_TABS
-        if len(args) > 0:
-            num_tabs = int(args[0])
-
         result = self._get('/list_tabs')
-        lines = []
-        for line in result.splitlines()[:num_tabs]:
-            lines.append(line)
-        return self.prefix_tabs(lines)
+        return self.prefix_tabs(result.splitlines()[:self._num_tabs(args)])
+
+    def query_tab_records(self, args) -> List[Tab]:
+        """Like query_tabs, but return Tab objects, see list_tab_records."""
+        path = self._query_tabs_path(args)
+        if path is None:
+            return []
+        return self._tab_records(self._get_columns(path), MAX_NUMBER_OF_TABS)
+
+    def list_tab_records(self, args) -> List[Tab]:
+        """
+        Like list_tabs, but return Tab objects. The mediator is asked for
+        the columnar format, so tab lines are neither built nor parsed.
+        """
+        return self._tab_records(self._get_columns('/list_tabs'), self._num_tabs(args))
+
+    def list_tabs_delta(self, since: int = 0, wait: float = None) -> dict:
+        """
+        Return changes of the tab list since version `since` (0 gets all
+        tabs):
+
+            {'version': <version to pass next time>,
+             'full': <True if 'changed' is the whole list and replaces it>,
+             'changed': [{'tab': <prefixed tab line>, 'index': <index in window>,
+                          'status': <'loading', 'complete' or None if unknown>}],
+             'removed': [<prefixed tab id>]}
+
+        Version 0 means the mediator can't track changes, so every call
+        returns the full list. With `wait` the mediator holds the request
+        up to that many seconds until something changes.
+        """
+        if wait is None:
+            delta = json.loads(self._get('/list_tabs?since=%d' % since))
+        else:
+            delta = json.loads(self._client.get(
+                '/list_tabs?since=%d&wait=%s' % (since, wait), timeout=wait + HTTP_TIMEOUT))
+        return self._prefix_delta(delta)
 
     def list_tabs_safe(self, args, print_error=False):
         args = args or []
@@ -223,10 +569,7 @@ class SingleMediatorAPI(object):
 
     def move_tabs(self, args):
         logger.info('SENDING MOVE COMMANDS: %s', args)
-        commands = ','.join(
-            '%s %s %s' % (tab_id, window_id, new_index)
-            for tab_id, window_id, new_index in args)
-        return self._get('/move_tabs/%s' % quote_plus(commands))
+        return self._get(self._move_tabs_path(args))
 
     def open_urls(self, urls, window_id=None):
         data = '\n'.join(urls)
@@ -244,52 +587,76 @@ class SingleMediatorAPI(object):
         ids = self._post('/update_tabs', files)
         return self.prefix_tabs(ids.splitlines())
 
-    def get_words(self, tab_ids, match_regex, join_with):
-        words = set()
-        match_regex = encode_query(match_regex)
-        join_with = encode_query(join_with)
-
-        for tab_id in tab_ids:
-            prefix, _window_id, tab_id = tab_id.split('.')
-            if prefix + '.' != self._prefix:
-                continue
-
-            logger.info(
-                'SingleMediatorAPI: get_words: %s, match_regex: %s, join_with: %s',
-                tab_id, match_regex, join_with)
-            words |= set(self._get(
-                '/get_words/%s?match_regex=%s&join_with=%s' % (tab_id, match_regex, join_with)
-            ).splitlines())
-
-        if not tab_ids:
-            words = set(self._get(
-                '/get_words?match_regex=%s&join_with=%s' % (match_regex, join_with)
-            ).splitlines())
-
-        return sorted(list(words))
-
-    def get_text_or_html(self, command, args, delimiter_regex, replace_with):
-        num_tabs = MAX_NUMBER_OF_TABS
-        if len(args) > 0:
-            num_tabs = int(args[0])
-
-        result = self._get(
-            '/%s?delimiter_regex=%s&replace_with=%s' % (
-                command,
-                encode_query(delimiter_regex),
-                encode_query(replace_with),
-            ),
-        )
-        lines = []
-        for line in result.splitlines()[:num_tabs]:
-            lines.append(line)
-        return self.prefix_tabs(lines)
+    def get_words(self, tab_ids, match_regex, join_with, concurrency=None, script_timeout=None):
+        """
+        Words of the given tabs of this mediator (of the active tab if no
+        tabs are given), all tabs are processed by a single request.
+        """
+        path = self._words_path(tab_ids, match_regex, join_with, concurrency, script_timeout)
+        if path is None:
+            return []
 
-    def get_text(self, args, delimiter_regex, replace_with):
-        return self.get_text_or_html('get_text', args, delimiter_regex, replace_with)
+        logger.info('SingleMediatorAPI: get_words: %s', path)
+        return sorted(set(self._get(path).splitlines()))
 
-    def get_html(self, args, delimiter_regex, replace_with):
-        return self.get_text_or_html('get_html', args, delimiter_regex, replace_with)
+    def get_text_or_html(self, command, args, delimiter_regex, replace_with, tab_ids=None,
+                         concurrency=None, script_timeout=None, hashes=None):
+        """
+        `hashes` maps tab ids to text_hash of the text the caller has
+        already, the text of these tabs is UNCHANGED_MARKER if it's the same.
+        """
+        path = self._text_or_html_path(command, delimiter_regex, replace_with, tab_ids,
+                                       concurrency, script_timeout)
+        if path is None:
+            return []
+        hashes = self.own_hashes(hashes)
+        if hashes is None:
+            result = self._get(path)
+        else:
+            result = self._client.post_json(path, {'hashes': hashes})
+        return self.prefix_tabs(result.splitlines()[:self._num_tabs(args)])
+
+    def iter_text_or_html(self, command, delimiter_regex, replace_with, tab_ids=None,
+                          concurrency=None, script_timeout=None, hashes=None) -> Iterator[str]:
+        """
+        Like get_text_or_html, but yields lines while the browser is still
+        extracting the rest, memory use doesn't depend on the number of tabs.
+        """
+        path = self._text_or_html_path(command, delimiter_regex, replace_with, tab_ids,
+                                       concurrency, script_timeout)
+        if path is None:
+            return
+        # a single tab may take up to script_timeout to extract
+        timeout = None if script_timeout is None else script_timeout + HTTP_TIMEOUT
+        hashes = self.own_hashes(hashes)
+        body = None if hashes is None else {'hashes': hashes}
+        lines = self._client.iter_lines(path + '&stream=1', timeout, body)
+        for line in islice(lines, MAX_NUMBER_OF_TABS):
+            yield self.prefix_tab(line)
+
+    def get_text(self, args, delimiter_regex, replace_with, tab_ids=None,
+                 concurrency=None, script_timeout=None, hashes=None):
+        return self.get_text_or_html('get_text', args, delimiter_regex, replace_with, tab_ids,
+                                     concurrency, script_timeout, hashes)
+
+    def get_html(self, args, delimiter_regex, replace_with, tab_ids=None,
+                 concurrency=None, script_timeout=None, hashes=None):
+        return self.get_text_or_html('get_html', args, delimiter_regex, replace_with, tab_ids,
+                                     concurrency, script_timeout, hashes)
+
+    def iter_text(self, delimiter_regex, replace_with, tab_ids=None,
+                  concurrency=None, script_timeout=None, hashes=None):
+        return self.iter_text_or_html('get_text', delimiter_regex, replace_with, tab_ids,
+                                      concurrency, script_timeout, hashes)
+
+    def iter_html(self, delimiter_regex, replace_with, tab_ids=None,
+                  concurrency=None, script_timeout=None, hashes=None):
+        return self.iter_text_or_html('get_html', delimiter_regex, replace_with, tab_ids,
+                                      concurrency, script_timeout, hashes)
+
+    def get_stats(self):
+        """Return statistics of the scripts the browser ran in tabs."""
+        return json.loads(self._get('/get_stats'))
 
     def shutdown(self):
         return self._get('/shutdown')
@@ -297,6 +664,9 @@ class SingleMediatorAPI(object):
     def _get(self, path, data=None):
         return self._client.get(path, data)
 
+    def _get_columns(self, path):
+        return self._client.get(path, headers={'Accept': TAB_COLUMNS_MIMETYPE})
+
     def _post(self, path, files=None):
         return self._client.post(path, files)
 
@@ -316,48 +686,77 @@ def int_tab_id(tab_id: str) -> int:
     return int(tab_id.split('.')[-1])
 
 
+def successful_values(results):
+    """Report calls of scatter_gather that failed, return values of the rest."""
+    values = []
+    for result in results:
+        if result.error is None:
+            values.append(result.value)
+        else:
+            print("Cannot access API %s: %s" % (result.api, result.error), file=sys.stderr)
+            logger.error("Cannot access API %s: %s" % (result.api, result.error))
+    return values
+
+
 class MultipleMediatorsAPI(object):
     """
     This API is designed to work with multiple mediators.
+
+    Every operation is sent to all mediators at once (see scatter_gather),
+    so a command takes about as long as the slowest browser. A mediator
+    that fails or doesn't reply in `timeout` seconds is reported and left
+    out of the result, the results of the others are kept. Latencies of the
+    last operation are in `latencies`, by mediator prefix.
     """
 
-    def __init__(self, apis):
+    def __init__(self, apis, timeout=None):
         self._apis = apis
+        self._timeout = mediator_timeout() if timeout is None else timeout
+        self.latencies = {}
 
     @property
     def ready_apis(self):
         return [api for api in self._apis if api.ready]
 
+    def _scatter(self, function, apis=None):
+        """
+        Call function(api) for every ready api (or `apis`) in parallel,
+        return values of the calls that succeeded in the order of apis.
+        """
+        results = scatter_gather(self.ready_apis if apis is None else apis,
+                                 function, self._timeout)
+        self.latencies = {result.api.prefix: result.elapsed for result in results}
+        logger.info('Mediator latencies: %s', self.latencies)
+        return successful_values(results)
+
     def close_tabs(self, args):
-        for api in self._apis:
-            api.close_tabs(args)
+        self._scatter(lambda api: api.close_tabs(args), self._apis)
 
     def activate_tab(self, args: List[str], focused: bool):
         if len(args) == 0:
             print('Usage: brotab_client.py activate_tab [--focused] <#tab>')
             return 2
 
-        for api in self._apis:
-            api.activate_tab(args, focused)
+        self._scatter(lambda api: api.activate_tab(args, focused), self._apis)
 
     def get_active_tabs(self, args):
-        return [api.get_active_tabs(args) for api in self._apis]
+        return self._scatter(lambda api: api.get_active_tabs(args), self._apis)
+
+    def get_stats(self):
+        """Return statistics of every mediator by its prefix."""
+        return dict(self._scatter(lambda api: (api.prefix, api.get_stats())))
 
     def query_tabs(self, args, print_error=False):
-        functions = [partial(api.query_tabs_safe, args, print_error)
-                     for api in self.ready_apis]
-        if not functions:
-            return []
-        tabs = sum(call_parallel(functions), [])
-        return tabs
+        return sum(self._scatter(lambda api: api.query_tabs_safe(args, print_error)), [])
 
     def list_tabs(self, args, print_error=False):
-        functions = [partial(api.list_tabs_safe, args, print_error)
-                     for api in self.ready_apis]
-        if not functions:
-            return []
-        tabs = sum(call_parallel(functions), [])
-        return tabs
+        return sum(self._scatter(lambda api: api.list_tabs_safe(args, print_error)), [])
+
+    def query_tab_records(self, args):
+        return sum(self._scatter(lambda api: api.query_tab_records(args)), [])
+
+    def list_tab_records(self, args):
+        return sum(self._scatter(lambda api: api.list_tab_records(args)), [])
 
     def _move_tabs_if_changed(self, api, tabs_before, tabs_after):
         delete_commands, move_commands, update_commands = infer_all_commands(
@@ -377,13 +776,8 @@ class MultipleMediatorsAPI(object):
             api.update_tabs(update_commands)
 
     def update_tabs(self, all_updates):
-        results = []
-        for api in self._apis:
-            updates = [deepcopy(u) for u in all_updates if api.prefix_match(u['tab_id'])]
-            for u in updates:
-                u['tab_id'] = int_tab_id(u['tab_id'])
-            results.extend(api.update_tabs(updates))
-        return results
+        return sum(self._scatter(lambda api: api.update_tabs(api.own_updates(all_updates)),
+                                 self._apis), [])
 
     def move_tabs(self, args):
         """
@@ -406,11 +800,10 @@ class MultipleMediatorsAPI(object):
         if tabs_after is None:
             return
 
-        for api in self._apis:
-            self._move_tabs_if_changed(
-                api,
-                api.filter_tabs(tabs_before),
-                api.filter_tabs(tabs_after))
+        self._scatter(lambda api: self._move_tabs_if_changed(
+            api,
+            api.filter_tabs(tabs_before),
+            api.filter_tabs(tabs_after)), self._apis)
 
     def _get_api_by_prefix(self, prefix):
         for api in self._apis:
@@ -425,44 +818,48 @@ class MultipleMediatorsAPI(object):
         client = self._get_api_by_prefix(prefix)
         return client.open_urls(urls, window_id)
 
-    def get_words(self, tab_ids, match_regex, join_with):
+    def get_words(self, tab_ids, match_regex, join_with, concurrency=None, script_timeout=None):
         words = set()
-        import time
-        for api in self.ready_apis:
-            start = time.time()
-            words |= set(api.get_words(tab_ids, match_regex, join_with))
-            delta = time.time() - start
-            # print('DELTA', delta, file=sys.stderr)
-        return sorted(list(words))
-
-    def _get_text_or_html(self, api, getter, args, delimiter_regex, replace_with):
-        result = []
+        for api_words in self._scatter(lambda api: api.get_words(
+                tab_ids, match_regex, join_with, concurrency, script_timeout)):
+            words.update(api_words)
+        return sorted(words)
+
+    def get_text(self, args, delimiter_regex, replace_with, tab_ids=None,
+                 concurrency=None, script_timeout=None, hashes=None):
+        return sum(self._scatter(lambda api: api.get_text(
+            args, delimiter_regex, replace_with, tab_ids, concurrency, script_timeout,
+            hashes)), [])
+
+    def get_html(self, args, delimiter_regex, replace_with, tab_ids=None,
+                 concurrency=None, script_timeout=None, hashes=None):
+        return sum(self._scatter(lambda api: api.get_html(
+            args, delimiter_regex, replace_with, tab_ids, concurrency, script_timeout,
+            hashes)), [])
+
+    def _iter_text_or_html(self, api, iterator):
         try:
-            import time
-            start = time.time()
-            result = getter(args, delimiter_regex, replace_with)
-            delta = time.time() - start
-            logger.info('get text/html (single client) took %s', delta)
+            yield from iterator
         except ValueError as e:
             print("Cannot decode JSON: %s: %s" % (api, e), file=sys.stderr)
             logger.error("Cannot decode JSON: %s: %s" % (api, e))
         except URLError as e:
             print("Cannot access API %s: %s" % (api, e), file=sys.stderr)
             logger.error("Cannot access API %s: %s" % (api, e))
-        except Exception as e:
-            logger.error("Unknown exception: %s %s" % (api, e))
-        return result
-
-    def get_text(self, args, delimiter_regex, replace_with):
-        tabs = []
-        for api in self.ready_apis:
-            tabs.extend(self._get_text_or_html(api, api.get_text, args,
-                                               delimiter_regex, replace_with))
-        return tabs
-
-    def get_html(self, args, delimiter_regex, replace_with):
-        tabs = []
-        for api in self.ready_apis:
-            tabs.extend(self._get_text_or_html(api, api.get_html, args,
-                                               delimiter_regex, replace_with))
-        return tabs
+        except socket.timeout as e:
+            print("Timeout reading from API %s: %s" % (api, e), file=sys.stderr)
+            logger.error("Timeout reading from API %s: %s" % (api, e))
+
+    def iter_text(self, delimiter_regex, replace_with, tab_ids=None,
+                  concurrency=None, script_timeout=None, hashes=None):
+        """Yield text lines of all mediators as they come (see merge_iterators)."""
+        return merge_iterators(self._iter_text_or_html(api, api.iter_text(
+            delimiter_regex, replace_with, tab_ids, concurrency, script_timeout, hashes))
+            for api in self.ready_apis)
+
+    def iter_html(self, delimiter_regex, replace_with, tab_ids=None,
+                  concurrency=None, script_timeout=None, hashes=None):
+        """Yield html lines of all mediators as they come (see merge_iterators)."""
+        return merge_iterators(self._iter_text_or_html(api, api.iter_html(
+            delimiter_regex, replace_with, tab_ids, concurrency, script_timeout, hashes))
+            for api in self.ready_apis)
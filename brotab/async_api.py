@@ -0,0 +1,604 @@
+"""
+asyncio counterpart of brotab.api for programs that run an event loop.
+
+AsyncHttpClient is a small HTTP/1.1 client built on asyncio streams: idle
+keep-alive connections are reused, every call has a deadline (the client's
+timeout unless given), and a call that is cancelled or runs out of time
+closes its connection instead of returning it half-read.
+
+AsyncSingleMediatorAPI and AsyncMultipleMediatorsAPI have the methods of
+SingleMediatorAPI and MultipleMediatorsAPI as coroutines (iter_text and
+iter_html are async generators):
+
+    api = AsyncMultipleMediatorsAPI([
+        await AsyncSingleMediatorAPI.create('a', port=4625),
+        await AsyncSingleMediatorAPI.create('b', port=4626),
+    ])
+    tabs = await api.list_tabs([])
+    await api.close()
+"""
+import asyncio
+import json
+import logging
+import sys
+import zlib
+from typing import AsyncIterator
+from typing import List
+from urllib.error import HTTPError
+from urllib.error import URLError
+
+from brotab.api import BaseMediatorAPI
+from brotab.api import ERROR_BROWSER
+from brotab.api import HTTP_TIMEOUT
+from brotab.api import IDEMPOTENT_METHODS
+from brotab.api import MAX_NUMBER_OF_TABS
+from brotab.api import form_body
+from brotab.api import json_body
+from brotab.api import successful_values
+from brotab.compression import ACCEPT_ENCODING
+from brotab.compression import Decoder
+from brotab.compression import LineSplitter
+from brotab.compression import is_local_host
+from brotab.const import TAB_COLUMNS_MIMETYPE
+from brotab.env import mediator_timeout
+from brotab.parallel import merge_async_iterators
+from brotab.parallel import scatter_gather_async
+from brotab.tab import Tab
+
+logger = logging.getLogger('brotab')
+
+# idle connections kept per client
+DEFAULT_MAX_IDLE = 4
+READ_SIZE = 64 * 1024
+
+NETWORK_ERRORS = (URLError, HTTPError, asyncio.TimeoutError, ConnectionError)
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+
+    def usable(self) -> bool:
+        return (self.loop is asyncio.get_running_loop() and
+                not self.writer.is_closing() and not self.reader.at_eof())
+
+    def close(self) -> None:
+        if not self.loop.is_closed():
+            self.writer.close()
+
+
+class _Response:
+    """Status and headers of a response, the body is read with read_chunk."""
+
+    def __init__(self, reader, status, reason, headers):
+        self._reader = reader
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+        self._length = int(headers['content-length']) if 'content-length' in headers else None
+        self.will_close = (headers.get('connection', '').lower() == 'close' or
+                           (not self._chunked and self._length is None))
+        self._done = False
+
+    @classmethod
+    async def read_head(cls, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed before the response')
+        _version, status, reason = (status_line.decode('latin-1').rstrip('\r\n') + ' ').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        return cls(reader, int(status), reason.strip(), headers)
+
+    async def read_chunk(self) -> bytes:
+        """Return the next piece of the body, b'' at its end."""
+        if self._done:
+            return b''
+        if self._chunked:
+            size = int((await self._reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await self._reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                self._done = True
+                return b''
+            data = await self._reader.readexactly(size)
+            await self._reader.readexactly(2)
+            return data
+        if self._length is not None:
+            if self._length == 0:
+                self._done = True
+                return b''
+            data = await self._reader.read(min(self._length, READ_SIZE))
+            if not data:
+                raise ConnectionResetError('Connection closed in the middle of the response')
+            self._length -= len(data)
+            return data
+        data = await self._reader.read(READ_SIZE)
+        self._done = not data
+        return data
+
+    async def read(self) -> bytes:
+        chunks = []
+        while True:
+            chunk = await self.read_chunk()
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+
+class AsyncHttpClient:
+    def __init__(self, host='localhost', port=4625, timeout=HTTP_TIMEOUT,
+                 max_idle=DEFAULT_MAX_IDLE, compress: bool = None):
+        self._host: str = host
+        self._port: int = port
+        self._timeout: float = timeout
+        self._max_idle: int = max_idle
+        self._idle: List[_Connection] = []
+        # see HttpClient
+        self._compress: bool = not is_local_host(host) if compress is None else compress
+
+    async def get(self, path, timeout=None, headers=None) -> str:
+        logger.info('GET http://%s:%s%s', self._host, self._port, path)
+        return (await self._request('GET', path, None, headers or {}, timeout)).decode('utf8')
+
+    async def post(self, path, files=None, timeout=None) -> str:
+        logger.info('POST http://%s:%s%s', self._host, self._port, path)
+        data, headers = form_body(files)
+        return (await self._request('POST', path, data, headers, timeout)).decode('utf8')
+
+    async def post_json(self, path, body, timeout=None) -> str:
+        logger.info('POST http://%s:%s%s', self._host, self._port, path)
+        data, headers = json_body(body)
+        return (await self._request('POST', path, data, headers, timeout)).decode('utf8')
+
+    async def iter_lines(self, path, timeout=None, body=None) -> AsyncIterator[str]:
+        """
+        GET a response (or POST `body` as JSON if it's given) and yield its
+        lines as they arrive. `timeout` applies to every read.
+        """
+        timeout = self._timeout if timeout is None else timeout
+        if body is None:
+            data, headers, method = None, {}, 'GET'
+        else:
+            (data, headers), method = json_body(body), 'POST'
+        connection, response = await asyncio.wait_for(
+            self._open(method, path, data, headers), timeout)
+        decoder = self._decoder(connection, response)
+        splitter = LineSplitter()
+        try:
+            while True:
+                chunk = await asyncio.wait_for(response.read_chunk(), timeout)
+                if not chunk:
+                    break
+                if decoder is not None:
+                    chunk = decoder.decompress(chunk)
+                for line in splitter.feed(chunk):
+                    yield line.decode('utf8')
+            rest = [] if decoder is None else splitter.feed(decoder.flush())
+            for line in rest + splitter.finish():
+                yield line.decode('utf8')
+        except (ConnectionError, asyncio.IncompleteReadError, zlib.error) as e:
+            connection.close()
+            raise URLError(e)
+        except BaseException:
+            # cancelled, timed out or not read to the end, the rest of the
+            # body is still in the connection
+            connection.close()
+            raise
+        self._finish(connection, response)
+
+    async def close(self) -> None:
+        """Close idle connections."""
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    async def _request(self, method, path, data, headers, timeout=None) -> bytes:
+        timeout = self._timeout if timeout is None else timeout
+        return await asyncio.wait_for(self._exchange(method, path, data, headers), timeout)
+
+    async def _exchange(self, method, path, data, headers) -> bytes:
+        connection, response = await self._open(method, path, data, headers)
+        decoder = self._decoder(connection, response)
+        try:
+            if decoder is None:
+                body = await response.read()
+            else:
+                parts = []
+                while True:
+                    chunk = await response.read_chunk()
+                    if not chunk:
+                        break
+                    parts.append(decoder.decompress(chunk))
+                parts.append(decoder.flush())
+                body = b''.join(parts)
+        except (ConnectionError, asyncio.IncompleteReadError, zlib.error) as e:
+            connection.close()
+            raise URLError(e)
+        except BaseException:
+            connection.close()
+            raise
+        self._finish(connection, response)
+        return body
+
+    async def _open(self, method, path, data, headers):
+        """Send a request, return the connection and the response to read."""
+        url = 'http://%s:%s%s' % (self._host, self._port, path)
+        head = ['%s %s HTTP/1.1' % (method, path), 'Host: %s:%s' % (self._host, self._port)]
+        head.extend('%s: %s' % item for item in headers.items())
+        if self._compress:
+            head.append('Accept-Encoding: %s' % ACCEPT_ENCODING)
+        if data is None and method != 'GET':
+            head.append('Content-Length: 0')
+        request = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + (data or b'')
+        while True:
+            connection, reused = await self._acquire()
+            sent = False
+            try:
+                connection.writer.write(request)
+                await connection.writer.drain()
+                sent = True
+                response = await _Response.read_head(connection.reader)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                connection.close()
+                # the mediator may have closed the idle connection, a request
+                # it might have got is sent again only if it can be repeated
+                if reused and (not sent or method in IDEMPOTENT_METHODS):
+                    continue
+                raise URLError(e)
+            except (OSError, ValueError) as e:
+                connection.close()
+                raise URLError(e)
+            except BaseException:
+                connection.close()
+                raise
+
+            if response.status != 200:
+                try:
+                    await response.read()
+                except BaseException:
+                    connection.close()
+                    raise
+                self._finish(connection, response)
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            return connection, response
+
+    async def _acquire(self):
+        while self._idle:
+            connection = self._idle.pop()
+            if connection.usable():
+                return connection, True
+            connection.close()
+        try:
+            reader, writer = await asyncio.open_connection(self._host, self._port)
+        except OSError as e:
+            raise URLError(e)
+        return _Connection(reader, writer), False
+
+    @staticmethod
+    def _decoder(connection, response):
+        try:
+            return Decoder.for_encoding(response.headers.get('content-encoding'))
+        except ValueError as e:
+            connection.close()
+            raise URLError(e)
+
+    def _finish(self, connection, response) -> None:
+        if response.will_close or len(self._idle) >= self._max_idle:
+            connection.close()
+        else:
+            self._idle.append(connection)
+
+
+async def fetch_pid(client: AsyncHttpClient, timeout: float = None) -> int:
+    """Get process ID from the mediator."""
+    try:
+        return int(await client.get('/get_pid', timeout=timeout))
+    except NETWORK_ERRORS as e:
+        logger.info('_get_pid failed: %s', e)
+    return -1
+
+
+async def fetch_browser(client: AsyncHttpClient, timeout: float = None) -> str:
+    """Get browser name from the mediator."""
+    try:
+        return await client.get('/get_browser', timeout=timeout)
+    except NETWORK_ERRORS as e:
+        logger.info('_get_browser failed: %s', e)
+    return ERROR_BROWSER
+
+
+class AsyncSingleMediatorAPI(BaseMediatorAPI):
+    """
+    SingleMediatorAPI for asyncio. Use create() to get one that knows pid
+    and browser of the mediator, the constructor doesn't do I/O.
+    """
+
+    def __init__(self, prefix, host='localhost', port=4625, client: AsyncHttpClient = None,
+                 pid: int = -1, browser: str = ERROR_BROWSER):
+        super().__init__(prefix, host, port)
+        self._client = AsyncHttpClient(host=host, port=port) if client is None else client
+        self._pid = pid
+        self._browser = browser
+
+    @classmethod
+    async def create(cls, prefix, host='localhost', port=4625, client: AsyncHttpClient = None):
+        api = cls(prefix, host, port, client)
+        api._pid, api._browser = await asyncio.gather(api.get_pid(), api.get_browser())
+        return api
+
+    async def get_pid(self):
+        return await fetch_pid(self._client)
+
+    async def get_browser(self):
+        return await fetch_browser(self._client)
+
+    async def close_tabs(self, args):
+        return await self._get(self._close_tabs_path(args))
+
+    async def activate_tab(self, args: List[str], focused: bool):
+        if len(args) == 0:
+            return
+        await self._get(self._activate_tab_path(args, focused))
+
+    async def get_active_tabs(self, args) -> List[str]:
+        return [self.prefix_tab(tab) for tab in (await self._get('/get_active_tabs')).split(',')]
+
+    async def get_screenshot(self, args):
+        return await self._get('/get_screenshot')
+
+    async def query_tabs(self, args):
+        path = self._query_tabs_path(args)
+        if path is None:
+            return []
+        result = await self._get(path)
+        return self.prefix_tabs(result.splitlines()[:MAX_NUMBER_OF_TABS])
+
+    async def list_tabs(self, args):
+        result = await self._get('/list_tabs')
+        return self.prefix_tabs(result.splitlines()[:self._num_tabs(args)])
+
+    async def query_tab_records(self, args) -> List[Tab]:
+        """See SingleMediatorAPI.query_tab_records."""
+        path = self._query_tabs_path(args)
+        if path is None:
+            return []
+        return self._tab_records(await self._get_columns(path), MAX_NUMBER_OF_TABS)
+
+    async def list_tab_records(self, args) -> List[Tab]:
+        """See SingleMediatorAPI.list_tab_records."""
+        return self._tab_records(await self._get_columns('/list_tabs'), self._num_tabs(args))
+
+    async def list_tabs_delta(self, since: int = 0, wait: float = None) -> dict:
+        """See SingleMediatorAPI.list_tabs_delta."""
+        if wait is None:
+            delta = json.loads(await self._get('/list_tabs?since=%d' % since))
+        else:
+            delta = json.loads(await self._client.get(
+                '/list_tabs?since=%d&wait=%s' % (since, wait), timeout=wait + HTTP_TIMEOUT))
+        return self._prefix_delta(delta)
+
+    async def move_tabs(self, args):
+        logger.info('SENDING MOVE COMMANDS: %s', args)
+        return await self._get(self._move_tabs_path(args))
+
+    async def open_urls(self, urls, window_id=None):
+        logger.info('AsyncSingleMediatorAPI: open_urls: %s', urls)
+        ids = await self._client.post('/open_urls' if window_id is None
+                                      else ('/open_urls/%s' % window_id),
+                                      {'urls': '\n'.join(urls)})
+        return self.prefix_tabs(ids.splitlines())
+
+    async def update_tabs(self, updates):
+        logger.info('AsyncSingleMediatorAPI: update_tabs: %s', updates)
+        ids = await self._client.post('/update_tabs', {'updates': json.dumps(updates)})
+        return self.prefix_tabs(ids.splitlines())
+
+    async def get_words(self, tab_ids, match_regex, join_with, concurrency=None, script_timeout=None):
+        path = self._words_path(tab_ids, match_regex, join_with, concurrency, script_timeout)
+        if path is None:
+            return []
+        return sorted(set((await self._get(path)).splitlines()))
+
+    async def get_text_or_html(self, command, args, delimiter_regex, replace_with, tab_ids=None,
+                               concurrency=None, script_timeout=None, hashes=None):
+        path = self._text_or_html_path(command, delimiter_regex, replace_with, tab_ids,
+                                       concurrency, script_timeout)
+        if path is None:
+            return []
+        # extracting text of all tabs takes longer than a usual request
+        timeout = None if script_timeout is None else script_timeout + HTTP_TIMEOUT
+        hashes = self.own_hashes(hashes)
+        if hashes is None:
+            result = await self._client.get(path, timeout=timeout)
+        else:
+            result = await self._client.post_json(path, {'hashes': hashes}, timeout)
+        return self.prefix_tabs(result.splitlines()[:self._num_tabs(args)])
+
+    async def iter_text_or_html(self, command, delimiter_regex, replace_with, tab_ids=None,
+                                concurrency=None, script_timeout=None, hashes=None) -> AsyncIterator[str]:
+        path = self._text_or_html_path(command, delimiter_regex, replace_with, tab_ids,
+                                       concurrency, script_timeout)
+        if path is None:
+            return
+        timeout = None if script_timeout is None else script_timeout + HTTP_TIMEOUT
+        hashes = self.own_hashes(hashes)
+        body = None if hashes is None else {'hashes': hashes}
+        count = 0
+        async for line in self._client.iter_lines(path + '&stream=1', timeout, body):
+            if count == MAX_NUMBER_OF_TABS:
+                break
+            count += 1
+            yield self.prefix_tab(line)
+
+    async def get_text(self, args, delimiter_regex, replace_with, tab_ids=None,
+                       concurrency=None, script_timeout=None, hashes=None):
+        return await self.get_text_or_html('get_text', args, delimiter_regex, replace_with, tab_ids,
+                                           concurrency, script_timeout, hashes)
+
+    async def get_html(self, args, delimiter_regex, replace_with, tab_ids=None,
+                       concurrency=None, script_timeout=None, hashes=None):
+        return await self.get_text_or_html('get_html', args, delimiter_regex, replace_with, tab_ids,
+                                           concurrency, script_timeout, hashes)
+
+    def iter_text(self, delimiter_regex, replace_with, tab_ids=None,
+                  concurrency=None, script_timeout=None, hashes=None):
+        return self.iter_text_or_html('get_text', delimiter_regex, replace_with, tab_ids,
+                                      concurrency, script_timeout, hashes)
+
+    def iter_html(self, delimiter_regex, replace_with, tab_ids=None,
+                  concurrency=None, script_timeout=None, hashes=None):
+        return self.iter_text_or_html('get_html', delimiter_regex, replace_with, tab_ids,
+                                      concurrency, script_timeout, hashes)
+
+    async def get_stats(self):
+        return json.loads(await self._get('/get_stats'))
+
+    async def shutdown(self):
+        return await self._get('/shutdown')
+
+    async def close(self):
+        await self._client.close()
+
+    async def _get(self, path):
+        return await self._client.get(path)
+
+    async def _get_columns(self, path):
+        return await self._client.get(path, headers={'Accept': TAB_COLUMNS_MIMETYPE})
+
+
+class AsyncMultipleMediatorsAPI(object):
+    """
+    MultipleMediatorsAPI for asyncio: every operation is sent to all
+    mediators at once, a mediator that fails or doesn't reply in `timeout`
+    seconds is reported and left out. Latencies of the last operation are
+    in `latencies`, by mediator prefix.
+    """
+
+    def __init__(self, apis: List[AsyncSingleMediatorAPI], timeout=None):
+        self._apis = apis
+        self._timeout = mediator_timeout() if timeout is None else timeout
+        self.latencies = {}
+
+    @property
+    def ready_apis(self):
+        return [api for api in self._apis if api.ready]
+
+    async def _scatter(self, function, apis=None):
+        """
+        Await function(api) for every ready api (or `apis`) at once, return
+        values of the calls that succeeded in the order of apis.
+        """
+        results = await scatter_gather_async(self.ready_apis if apis is None else apis,
+                                             function, self._timeout)
+        self.latencies = {result.api.prefix: result.elapsed for result in results}
+        logger.info('Mediator latencies: %s', self.latencies)
+        return successful_values(results)
+
+    async def close_tabs(self, args):
+        async def close_tabs(api):
+            return await api.close_tabs(args)
+        await self._scatter(close_tabs, self._apis)
+
+    async def activate_tab(self, args: List[str], focused: bool):
+        async def activate_tab(api):
+            return await api.activate_tab(args, focused)
+        await self._scatter(activate_tab, self._apis)
+
+    async def get_active_tabs(self, args):
+        async def get_active_tabs(api):
+            return await api.get_active_tabs(args)
+        return await self._scatter(get_active_tabs, self._apis)
+
+    async def get_stats(self):
+        """Return statistics of every mediator by its prefix."""
+        async def get_stats(api):
+            return api.prefix, await api.get_stats()
+        return dict(await self._scatter(get_stats))
+
+    async def query_tabs(self, args):
+        async def query_tabs(api):
+            return await api.query_tabs(args)
+        return sum(await self._scatter(query_tabs), [])
+
+    async def list_tabs(self, args):
+        async def list_tabs(api):
+            return await api.list_tabs(args)
+        return sum(await self._scatter(list_tabs), [])
+
+    async def query_tab_records(self, args):
+        async def query_tab_records(api):
+            return await api.query_tab_records(args)
+        return sum(await self._scatter(query_tab_records), [])
+
+    async def list_tab_records(self, args):
+        async def list_tab_records(api):
+            return await api.list_tab_records(args)
+        return sum(await self._scatter(list_tab_records), [])
+
+    async def update_tabs(self, all_updates):
+        async def update_tabs(api):
+            return await api.update_tabs(api.own_updates(all_updates))
+        return sum(await self._scatter(update_tabs, self._apis), [])
+
+    async def open_urls(self, urls, prefix, window_id=None):
+        for api in self._apis:
+            if api._prefix == prefix:
+                return await api.open_urls(urls, window_id)
+        raise ValueError('No such client with prefix "%s"' % prefix)
+
+    async def get_words(self, tab_ids, match_regex, join_with, concurrency=None, script_timeout=None):
+        async def get_words(api):
+            return await api.get_words(tab_ids, match_regex, join_with, concurrency, script_timeout)
+        words = set()
+        for api_words in await self._scatter(get_words):
+            words.update(api_words)
+        return sorted(words)
+
+    async def get_text(self, args, delimiter_regex, replace_with, tab_ids=None,
+                       concurrency=None, script_timeout=None, hashes=None):
+        async def get_text(api):
+            return await api.get_text(args, delimiter_regex, replace_with, tab_ids,
+                                      concurrency, script_timeout, hashes)
+        return sum(await self._scatter(get_text), [])
+
+    async def get_html(self, args, delimiter_regex, replace_with, tab_ids=None,
+                       concurrency=None, script_timeout=None, hashes=None):
+        async def get_html(api):
+            return await api.get_html(args, delimiter_regex, replace_with, tab_ids,
+                                      concurrency, script_timeout, hashes)
+        return sum(await self._scatter(get_html), [])
+
+    @staticmethod
+    async def _iter_text_or_html(api, iterator):
+        try:
+            async for line in iterator:
+                yield line
+        except (ValueError, URLError, asyncio.TimeoutError) as e:
+            print("Cannot access API %s: %s" % (api, e), file=sys.stderr)
+            logger.error("Cannot access API %s: %s" % (api, e))
+
+    def iter_text(self, delimiter_regex, replace_with, tab_ids=None,
+                  concurrency=None, script_timeout=None, hashes=None):
+        """Yield text lines of all mediators as they come (see merge_async_iterators)."""
+        return merge_async_iterators(self._iter_text_or_html(api, api.iter_text(
+            delimiter_regex, replace_with, tab_ids, concurrency, script_timeout, hashes))
+            for api in self.ready_apis)
+
+    def iter_html(self, delimiter_regex, replace_with, tab_ids=None,
+                  concurrency=None, script_timeout=None, hashes=None):
+        """Yield html lines of all mediators as they come (see merge_async_iterators)."""
+        return merge_async_iterators(self._iter_text_or_html(api, api.iter_html(
+            delimiter_regex, replace_with, tab_ids, concurrency, script_timeout, hashes))
+            for api in self.ready_apis)
+
+    async def close(self):
+        await asyncio.gather(*[api.close() for api in self._apis])
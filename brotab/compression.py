@@ -0,0 +1,170 @@
+"""
+Compression of HTTP responses between clients and mediators.
+
+A client that talks to a mediator on another machine sends
+"Accept-Encoding: gzip, deflate" and the mediator compresses responses of
+at least COMPRESS_MIN_SIZE bytes with the first encoding it accepts. A
+streamed response (no Content-Length) is compressed as it goes, every
+chunk is flushed so that lines reach the client as soon as the browser
+sends them. Clients on the same machine don't ask for compression, it
+would only cost CPU there.
+
+Clients decompress while reading, a compressed body is never held whole.
+"""
+import zlib
+from ipaddress import ip_address
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+# responses smaller than this are not compressed
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+ACCEPT_ENCODING = 'gzip, deflate'
+# zlib window bits of every encoding: gzip has a gzip header, deflate in
+# HTTP is a zlib stream
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def is_local_host(host: str) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """First encoding of the Accept-Encoding header we can compress with."""
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if name in WBITS and params.replace(' ', '') not in ('q=0', 'q=0.0'):
+            return name
+    return None
+
+
+class CompressionMiddleware:
+    """WSGI middleware that compresses responses for clients that accept it."""
+
+    def __init__(self, app, min_size=COMPRESS_MIN_SIZE, level=COMPRESS_LEVEL):
+        self._app = app
+        self._min_size = min_size
+        self._level = level
+
+    def __call__(self, environ, start_response):
+        encoding = accepted_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None or environ['REQUEST_METHOD'] == 'HEAD':
+            return self._app(environ, start_response)
+
+        response = {}
+        # the body an application passes to the legacy write(), it goes
+        # before the returned iterable
+        written = []
+
+        def defer(status, headers, exc_info=None):
+            # headers are sent once it's known whether the body is compressed
+            response['status'], response['headers'] = status, headers
+            response['exc_info'] = exc_info
+            return written.append
+
+        result = self._app(environ, defer)
+        if written:
+            result = self._chain(written, result)
+        headers = response['headers']
+        names = {name.lower(): value for name, value in headers}
+        length = names.get('content-length')
+        if (not response['status'].startswith('200') or 'content-encoding' in names or
+                (length is not None and int(length) < self._min_size)):
+            start_response(response['status'], headers, response.get('exc_info'))
+            return result
+
+        headers = [(name, value) for name, value in headers
+                   if name.lower() != 'content-length']
+        headers.extend([('Content-Encoding', encoding), ('Vary', 'Accept-Encoding')])
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, WBITS[encoding])
+        if length is None:
+            start_response(response['status'], headers, response.get('exc_info'))
+            return self._compress_stream(result, compressor)
+        try:
+            data = compressor.compress(b''.join(result)) + compressor.flush()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        headers.append(('Content-Length', str(len(data))))
+        start_response(response['status'], headers, response.get('exc_info'))
+        return [data]
+
+    @staticmethod
+    def _chain(written: List[bytes], result):
+        try:
+            yield from written
+            yield from result
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    @staticmethod
+    def _compress_stream(result, compressor):
+        try:
+            for chunk in result:
+                if chunk:
+                    yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+class Decoder:
+    """Decompresses a body as it's read."""
+
+    def __init__(self, encoding: str):
+        self._decompressor = zlib.decompressobj(WBITS[encoding])
+
+    @classmethod
+    def for_encoding(cls, encoding: Optional[str]) -> Optional['Decoder']:
+        """None if the body is not compressed, ValueError if it's compressed with something else."""
+        encoding = (encoding or 'identity').strip().lower()
+        if encoding == 'identity':
+            return None
+        if encoding not in WBITS:
+            raise ValueError('Unsupported Content-Encoding: %s' % encoding)
+        return cls(encoding)
+
+    def decompress(self, chunk: bytes) -> bytes:
+        return self._decompressor.decompress(chunk)
+
+    def flush(self) -> bytes:
+        return self._decompressor.flush()
+
+    def decompress_all(self, chunks: Iterable[bytes]) -> bytes:
+        return b''.join([self.decompress(chunk) for chunk in chunks] + [self.flush()])
+
+
+class LineSplitter:
+    """
+    Splits chunks of a body into lines without the newline. A long line
+    that arrives in many chunks is joined once, when its end arrives.
+    """
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        if b'\n' not in chunk:
+            if chunk:
+                self._parts.append(chunk)
+            return []
+        lines = chunk.split(b'\n')
+        if self._parts:
+            self._parts.append(lines[0])
+            lines[0] = b''.join(self._parts)
+        self._parts = [lines.pop()]
+        return lines
+
+    def finish(self) -> List[bytes]:
+        """The last line, if the body doesn't end with a newline."""
+        rest, self._parts = b''.join(self._parts), []
+        return [rest] if rest else []
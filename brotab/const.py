@@ -1,3 +1,9 @@
+# seconds a client waits for a mediator to send anything
+HTTP_TIMEOUT = 10.0
+# seconds every mediator of a multi-browser command is given, a command
+# can take a few requests
+DEFAULT_MEDIATOR_TIMEOUT = 3 * HTTP_TIMEOUT
+
 DEFAULT_GET_WORDS_MATCH_REGEX = r'/\w+/g'
 DEFAULT_GET_WORDS_JOIN_WITH = r'"\n"'
 
@@ -6,3 +12,11 @@ DEFAULT_GET_TEXT_REPLACE_WITH = r'" "'
 
 DEFAULT_GET_HTML_DELIMITER_REGEX = r'/\n|\r|\t/g'
 DEFAULT_GET_HTML_REPLACE_WITH = r'" "'
+
+# text of a tab in the reply to get_text/get_html when the client already
+# has text with the same hash (see brotab.utils.text_hash)
+UNCHANGED_MARKER = '\x00brotab:unchanged'
+
+# media type of the columnar reply to list_tabs/query_tabs that a client
+# asks for with "Accept:", see brotab.tab.tab_columns
+TAB_COLUMNS_MIMETYPE = 'application/vnd.brotab.tabs+json'
@@ -0,0 +1,59 @@
+"""
+Discovery of running mediators.
+
+Every bt invocation starts by finding out which mediators are alive. Ports
+are probed all at once, and pid and browser name of every live mediator are
+fetched concurrently, so discovery takes as long as the slowest mediator
+rather than the sum of all of them.
+"""
+import time
+from concurrent.futures import wait
+from typing import List
+
+from brotab.api import ERROR_BROWSER
+from brotab.api import HttpClient
+from brotab.api import SingleMediatorAPI
+from brotab.api import fetch_browser
+from brotab.api import fetch_pid
+from brotab.inout import probe_ports
+from brotab.parallel import executor
+
+DEFAULT_PROBE_TIMEOUT = 0.100
+DEFAULT_DISCOVERY_TIMEOUT = 2.0
+
+
+def discover_mediators(prefixes: List[str], hosts: List[str], ports: List[int],
+                       timeout: float = DEFAULT_DISCOVERY_TIMEOUT) -> List[SingleMediatorAPI]:
+    """
+    Return clients for the mediators that accept connections. `timeout` is
+    a hard deadline for the whole discovery: mediators that haven't told
+    their pid and browser name by then are returned as not ready.
+    """
+    expires_at = time.monotonic() + timeout
+    alive = probe_ports(list(zip(hosts, ports)), timeout=min(DEFAULT_PROBE_TIMEOUT, timeout))
+    candidates = [(prefix, host, port)
+                  for prefix, host, port, accepting in zip(prefixes, hosts, ports, alive)
+                  if accepting]
+    if not candidates:
+        return []
+
+    remaining = max(expires_at - time.monotonic(), 0.001)
+    clients = [HttpClient(host=host, port=port) for _prefix, host, port in candidates]
+    pool = executor()
+    pids = [pool.submit(fetch_pid, client, remaining) for client in clients]
+    browsers = [pool.submit(fetch_browser, client, remaining) for client in clients]
+    wait(pids + browsers, timeout=remaining)
+    for future in pids + browsers:
+        future.cancel()
+
+    return [SingleMediatorAPI(prefix, host=host, port=port, client=client,
+                              pid=_result_or(pid, -1),
+                              browser=_result_or(browser, ERROR_BROWSER))
+            for (prefix, host, port), client, pid, browser
+            in zip(candidates, clients, pids, browsers)]
+
+
+def _result_or(future, default):
+    if future.done() and not future.cancelled() and future.exception() is None:
+        return future.result()
+    return default
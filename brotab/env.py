@@ -2,6 +2,7 @@ from os import environ
 from os.path import exists
 from os.path import expanduser
 
+from brotab.const import DEFAULT_MEDIATOR_TIMEOUT
 from brotab.files import slurp_lines
 from brotab.mediator.const import DEFAULT_HTTP_IFACE
 from brotab.mediator.const import DEFAULT_MAX_HTTP_PORT
@@ -24,6 +25,25 @@ def max_http_port():
     return environ.get('MAX_HTTP_PORT', DEFAULT_MAX_HTTP_PORT)
 
 
+def mediator_timeout():
+    """
+    Seconds to wait for every mediator in a multi-browser command. A value
+    of MEDIATOR_TIMEOUT that is not a positive number is ignored.
+    """
+    value = environ.get('MEDIATOR_TIMEOUT')
+    if not value:
+        return DEFAULT_MEDIATOR_TIMEOUT
+    try:
+        timeout = float(value)
+    except ValueError:
+        timeout = None
+    if timeout is None or not 0 < timeout < float('inf'):
+        mediator_logger.warning('Bad MEDIATOR_TIMEOUT %r, using %s seconds',
+                                value, DEFAULT_MEDIATOR_TIMEOUT)
+        return DEFAULT_MEDIATOR_TIMEOUT
+    return timeout
+
+
 def load_dotenv(filename=None):
     if filename is None: filename = DEFAULT_FILENAME
     mediator_logger.info('Loading .env file: %s', filename)
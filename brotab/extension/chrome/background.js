@@ -4,9 +4,24 @@ On startup, connect to the "brotab_mediator" app.
 
 //const GET_WORDS_SCRIPT = '[...new Set(document.body.innerText.match(/\\w+/g))].sort().join("\\n");';
 const GET_WORDS_SCRIPT = '[...new Set(document.documentElement.innerText.match(#match_regex#))].sort().join(#join_with#);';
+// words of a tab as an array, for getting words of many tabs at once
+const GET_WORDS_LIST_SCRIPT = '[...new Set(document.documentElement.innerText.match(#match_regex#))];';
 //const GET_TEXT_SCRIPT = 'document.body.innerText.replace(/\\n|\\r|\\t/g, " ");';
 const GET_TEXT_SCRIPT = 'document.documentElement.innerText.replace(#delimiter_regex#, #replace_with#);';
 const GET_HTML_SCRIPT = 'document.documentElement.innerHTML.replace(#delimiter_regex#, #replace_with#);';
+// scripts run in this many tabs at a time, a tab that hasn't answered in
+// this many milliseconds is skipped
+const DEFAULT_SCRIPT_CONCURRENCY = 8;
+const DEFAULT_SCRIPT_TIMEOUT = 5000;
+// changes of these properties are pushed to the app, the rest (e.g. favicon)
+// would only generate noise. status is needed: bt index --watch extracts
+// text of a tab when it changes to "complete" (the status of a tab delta)
+const TAB_RECORD_CHANGES = ['title', 'url', 'status', 'pinned', 'audible', 'mutedInfo', 'discarded'];
+// total length of the script results the cache keeps, in characters
+const SCRIPT_CACHE_MAX_SIZE = 32 * 1024 * 1024;
+// text of a tab whose hash matches the one the app sent (see
+// brotab.const.UNCHANGED_MARKER)
+const UNCHANGED_MARKER = '\u0000brotab:unchanged';
 
 
 class BrowserTabs {
@@ -22,6 +37,25 @@ class BrowserTabs {
     throw new Error('list is not implemented');
   }
 
+  get(tabId, onSuccess, onError) {
+    throw new Error('get is not implemented');
+  }
+
+  subscribe(onChanged, onRemoved) {
+    // tab events have the same shape in Firefox and Chrome
+    const tabs = this._browser.tabs;
+    tabs.onCreated.addListener(onChanged);
+    tabs.onUpdated.addListener((tabId, changeInfo, tab) => {
+      if (TAB_RECORD_CHANGES.some(key => changeInfo.hasOwnProperty(key))) {
+        onChanged(tab);
+      }
+    });
+    tabs.onMoved.addListener((tabId, moveInfo) => this.get(tabId, onChanged));
+    tabs.onAttached.addListener((tabId, attachInfo) => this.get(tabId, onChanged));
+    tabs.onActivated.addListener((activeInfo) => this.get(activeInfo.tabId, onChanged));
+    tabs.onRemoved.addListener((tabId, removeInfo) => onRemoved(tabId));
+  }
+
   query(queryInfo, onSuccess) {
     throw new Error('query is not implemented');
   }
@@ -71,6 +105,18 @@ class FirefoxTabs extends BrowserTabs {
     );
   }
 
+  get(tabId, onSuccess, onError) {
+    this._browser.tabs.get(tabId).then(
+      onSuccess,
+      (error) => {
+        console.log(`Error getting tab ${tabId}: ${error}`);
+        if (onError) {
+          onError(error);
+        }
+      }
+    );
+  }
+
   query(queryInfo, onSuccess) {
     if (queryInfo.hasOwnProperty('windowFocused')) {
       let keepFocused = queryInfo['windowFocused']
@@ -191,6 +237,20 @@ class ChromeTabs extends BrowserTabs {
     this._browser.tabs.query(queryInfo, onSuccess);
   }
 
+  get(tabId, onSuccess, onError) {
+    this._browser.tabs.get(tabId, (tab) => {
+      let lastError = chrome.runtime.lastError;
+      if (lastError) {
+        console.log(`Error getting tab ${tabId}: ${lastError.message}`);
+        if (onError) {
+          onError(lastError);
+        }
+      } else {
+        onSuccess(tab);
+      }
+    });
+  }
+
   activate(tab_id, focused) {
     this._browser.tabs.update(tab_id, {'active': true});
     this._browser.tabs.get(tab_id, function(tab) {
@@ -291,6 +351,120 @@ class ChromeTabs extends BrowserTabs {
 
 
 console.log("Detecting browser");
+/*
+Results of scripts run in tabs, keyed by tab id and script. A result is
+valid while the tab shows the same URL and hasn't loaded again: a tab that
+starts loading gets a new load generation. Results of tabs that are still
+loading are not kept. When the results take more than maxSize characters,
+the least recently used are evicted.
+*/
+class ScriptCache {
+  constructor(maxSize) {
+    this._maxSize = maxSize;
+    this._size = 0;
+    // key -> {url, generation, result, size}, a Map iterates in insertion
+    // order, so the least recently used entry is the first one
+    this._entries = new Map();
+    // tab id -> load generation
+    this._generations = new Map();
+    this.hits = 0;
+    this.misses = 0;
+    this.evictions = 0;
+  }
+
+  generation(tabId) {
+    return this._generations.get(tabId) || 0;
+  }
+
+  get(tab, script) {
+    const key = tab.id + '\n' + script;
+    const entry = this._entries.get(key);
+    if (entry === undefined || entry.url !== tab.url ||
+        entry.generation !== this.generation(tab.id)) {
+      this.misses++;
+      return undefined;
+    }
+    this.hits++;
+    this._entries.delete(key);
+    this._entries.set(key, entry);
+    return entry.result;
+  }
+
+  // generation is the one the tab had when the script started
+  put(tab, script, generation, result) {
+    const size = resultSize(result);
+    if (tab.status !== 'complete' || generation !== this.generation(tab.id) ||
+        size > this._maxSize) {
+      return;
+    }
+    const key = tab.id + '\n' + script;
+    this._delete(key);
+    this._entries.set(key, {url: tab.url, generation: generation, result: result, size: size});
+    this._size += size;
+    for (const oldest of this._entries.keys()) {
+      if (this._size <= this._maxSize) {
+        break;
+      }
+      this._delete(oldest);
+      this.evictions++;
+    }
+  }
+
+  tabChanged(tab) {
+    if (tab.status === 'loading') {
+      this._generations.set(tab.id, this.generation(tab.id) + 1);
+    }
+  }
+
+  tabRemoved(tabId) {
+    this._generations.delete(tabId);
+    for (const key of [...this._entries.keys()]) {
+      if (key.startsWith(tabId + '\n')) {
+        this._delete(key);
+      }
+    }
+  }
+
+  stats() {
+    return {
+      hits: this.hits,
+      misses: this.misses,
+      evictions: this.evictions,
+      entries: this._entries.size,
+      size: this._size,
+      max_size: this._maxSize,
+    };
+  }
+
+  _delete(key) {
+    const entry = this._entries.get(key);
+    if (entry !== undefined) {
+      this._size -= entry.size;
+      this._entries.delete(key);
+    }
+  }
+}
+
+function resultSize(result) {
+  if (typeof result === 'string') {
+    return result.length;
+  }
+  if (Array.isArray(result)) {
+    return result.reduce((size, item) => size + resultSize(item), 0);
+  }
+  return 16;
+}
+
+const scriptCache = new ScriptCache(SCRIPT_CACHE_MAX_SIZE);
+
+/*
+Hex SHA-1 of the UTF-8 text, the same as brotab.utils.text_hash.
+*/
+function sha1Hex(text) {
+  return crypto.subtle.digest('SHA-1', new TextEncoder().encode(text)).then(digest =>
+    Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join(''));
+}
+
 var port = undefined;
 var tabs = undefined;
 var browserTabs = undefined;
@@ -314,6 +488,90 @@ function reconnect() {
   }
 }
 
+/*
+Chrome doesn't let a message to the app be larger than 1 MB. A larger
+message is sent as fragments of its JSON text:
+
+  {fragment: <message id>, seq: <0, 1, ...>, length: <length of the text>, data: <part of the text>}
+
+(plus id: <command id> if the message is a reply) and the app joins them
+back. The text of a list (lines of get_text or
+get_html, tabs of a snapshot) is built item by item, so a large reply is
+never held as one string.
+*/
+// characters of JSON text per message, at most 3 bytes each in UTF-8
+const MAX_MESSAGE_CHARS = 256 * 1024;
+let nextFragmentId = 1;
+
+function listPieces(head, items, tail) {
+  const pieces = [head];
+  items.forEach((item, i) => {
+    const json = JSON.stringify(item);
+    pieces.push((i > 0 ? ',' : '') + (json === undefined ? 'null' : json));
+  });
+  pieces.push(tail);
+  return pieces;
+}
+
+function jsonPieces(message) {
+  if (Array.isArray(message)) {
+    return listPieces('[', message, ']');
+  }
+  const key = ['result', 'chunk', 'tabs'].find(
+    key => message !== null && typeof message === 'object' && Array.isArray(message[key]));
+  if (key === undefined) {
+    return [JSON.stringify(message)];
+  }
+  const rest = Object.assign({}, message);
+  delete rest[key];
+  const head = JSON.stringify(rest).slice(0, -1);
+  return listPieces(head + (head === '{' ? '' : ',') + JSON.stringify(key) + ':[',
+                    message[key], ']}');
+}
+
+function sendToApp(message) {
+  const pieces = jsonPieces(message);
+  const length = pieces.reduce((total, piece) => total + piece.length, 0);
+  if (length <= MAX_MESSAGE_CHARS) {
+    port.postMessage(message);
+    return;
+  }
+  const id = nextFragmentId++;
+  let seq = 0;
+  let buffer = [];
+  let size = 0;
+  const flush = () => {
+    const fragment = {fragment: id, seq: seq++, length: length, data: buffer.join('')};
+    // the app fails only this command if the message can't be joined
+    if (message.id !== undefined) {
+      fragment.id = message.id;
+    }
+    port.postMessage(fragment);
+    buffer = [];
+    size = 0;
+  };
+  for (let piece of pieces) {
+    while (size + piece.length > MAX_MESSAGE_CHARS) {
+      let cut = MAX_MESSAGE_CHARS - size;
+      // a surrogate pair is never split between fragments
+      const code = piece.charCodeAt(cut - 1);
+      if (code >= 0xD800 && code <= 0xDBFF) {
+        cut -= 1;
+      }
+      buffer.push(piece.slice(0, cut));
+      piece = piece.slice(cut);
+      flush();
+    }
+    if (piece.length > 0) {
+      buffer.push(piece);
+      size += piece.length;
+    }
+  }
+  if (size > 0) {
+    flush();
+  }
+}
+
 
 // see https://stackoverflow.com/a/15479354/258421
 // function naturalCompare(a, b) {
@@ -339,7 +597,7 @@ function compareWindowIdTabId(tabA, tabB) {
   return tabA.index - tabB.index;
 }
 
-function listTabsOnSuccess(tabs) {
+function listTabsOnSuccess(tabs, reply) {
   var lines = [];
   // Make sure tabs are sorted by their index within a window
   tabs.sort(compareWindowIdTabId);
@@ -349,26 +607,26 @@ function listTabsOnSuccess(tabs) {
     lines.push(line);
   }
   // lines = lines.sort(naturalCompare);
-  port.postMessage(lines);
+  reply(lines);
 }
 
-function listTabs() {
-  browserTabs.list({}, listTabsOnSuccess);
+function listTabs(reply) {
+  browserTabs.list({}, tabs => listTabsOnSuccess(tabs, reply));
 }
 
-function queryTabsOnSuccess(tabs) {
+function queryTabsOnSuccess(tabs, reply) {
   tabs.sort(compareWindowIdTabId);
   let lines = tabs.map(tab => `${tab.windowId}.${tab.id}\t${tab.title}\t${tab.url}`)
   console.log(lines);
-  port.postMessage(lines);
+  reply(lines);
 }
 
-function queryTabsOnFailure(error) {
+function queryTabsOnFailure(error, reply) {
   console.error(error);
-  port.postMessage([]);
+  reply([]);
 }
 
-function queryTabs(query_info) {
+function queryTabs(query_info, reply) {
   try {
     let query = atob(query_info)
     query = JSON.parse(query)
@@ -393,10 +651,10 @@ function queryTabs(query_info) {
       return o;
     }, {})
 
-    browserTabs.query(query, queryTabsOnSuccess);
+    browserTabs.query(query, tabs => queryTabsOnSuccess(tabs, reply));
   }
   catch(error) {
-    queryTabsOnFailure(error);
+    queryTabsOnFailure(error, reply);
   }
 }
 
@@ -407,12 +665,12 @@ function queryTabs(query_info) {
 //   }
 // }
 
-function moveTabs(move_triplets) {
+function moveTabs(move_triplets, reply) {
   // move_triplets is a tuple of (tab_id, window_id, new_index)
   if (move_triplets.length == 0) {
     // this post is only required to make bt move command synchronous. mediator
     // is waiting for any reply
-    port.postMessage('OK');
+    reply('OK');
     return
   }
 
@@ -420,18 +678,18 @@ function moveTabs(move_triplets) {
   // again with the remaining tabs (first omitted)
   const [tabId, windowId, index] = move_triplets[0];
   browserTabs.move(tabId, {index: index, windowId: windowId},
-    (tab) => moveTabs(move_triplets.slice(1))
+    (tab) => moveTabs(move_triplets.slice(1), reply)
   );
 }
 
-function closeTabs(tab_ids) {
-  browserTabs.close(tab_ids, () => port.postMessage('OK'));
+function closeTabs(tab_ids, reply) {
+  browserTabs.close(tab_ids, () => reply('OK'));
 }
 
-function openUrls(urls, window_id, first_result="") {
+function openUrls(urls, window_id, reply, first_result="") {
   if (urls.length == 0) {
     console.log('Opening urls done');
-    port.postMessage([]);
+    reply([]);
     return;
   }
 
@@ -440,7 +698,7 @@ function openUrls(urls, window_id, first_result="") {
       result = `${window.id}.${window.tabs[0].id}`;
       console.log(`Opened first window: ${result}`);
       urls = urls.slice(1);
-      openUrls(urls, window.id, result);
+      openUrls(urls, window.id, reply, result);
     });
     return;
   }
@@ -460,22 +718,22 @@ function openUrls(urls, window_id, first_result="") {
     }
     const data = Array.prototype.concat(...result)
     console.log(`Sending ids back: ${JSON.stringify(data)}`);
-    port.postMessage(data)
+    reply(data)
   });
 }
 
-function createTab(url) {
+function createTab(url, reply) {
   browserTabs.create({'url': url},
     (tab) => {
       console.log(`Created new tab: ${tab.id}`);
-      port.postMessage([`${tab.windowId}.${tab.id}`]);
+      reply([`${tab.windowId}.${tab.id}`]);
   });
 }
 
-function updateTabs(updates) {
+function updateTabs(updates, reply) {
   if (updates.length == 0) {
     console.log('Updating tabs done');
-    port.postMessage([]);
+    reply([]);
     return;
   }
 
@@ -495,7 +753,7 @@ function updateTabs(updates) {
   Promise.all(promises).then(result => {
     const data = Array.prototype.concat(...result).filter(x => !!x)
     console.log(`Sending ids back after update: ${JSON.stringify(data)}`);
-    port.postMessage(data)
+    reply(data)
   });
 }
 
@@ -503,17 +761,17 @@ function activateTab(tab_id, focused) {
   browserTabs.activate(tab_id, focused);
 }
 
-function getActiveTabs() {
+function getActiveTabs(reply) {
   browserTabs.getActive(tabs => {
       var result = tabs.map(tab => tab.windowId + "." + tab.id).toString()
       console.log(`Active tabs: ${result}`);
-      port.postMessage(result);
+      reply(result);
   });
 }
 
-function getActiveScreenshot() {
+function getActiveScreenshot(reply) {
   browserTabs.getActiveScreenshot(data => {
-    port.postMessage(data);
+    reply(data);
   });
 }
 
@@ -542,87 +800,239 @@ function listOr(list, default_value) {
   return list;
 }
 
-function getWordsFromTabs(tabs, match_regex, join_with) {
-  var promises = [];
-  console.log(`Getting words from tabs: ${tabs}`);
-  const script = getWordsScript(match_regex, join_with);
+/*
+Options of running a script in many tabs, taken from the command.
+*/
+function scriptOptions(command, reply) {
+  return {
+    name: command['name'],
+    concurrency: command['concurrency'] || DEFAULT_SCRIPT_CONCURRENCY,
+    // the app sends seconds
+    timeout: command['timeout'] ? command['timeout'] * 1000 : DEFAULT_SCRIPT_TIMEOUT,
+    // results are sent one by one as they are ready
+    onChunk: command['stream'] ? reply.chunk : undefined,
+    // tab id -> hash of the text the app has already
+    hashes: command['hashes'],
+  };
+}
 
-  for (let tab of tabs) {
-    var promise = new Promise(
-      (resolve, reject) => browserTabs.runScript(tab.id, script, null,
-        (words, _payload) => {
-          words = listOr(words, []);
-          console.log(`Got ${words.length} words from another tab`);
-          resolve(words);
+/*
+Run a script in the tabs, at most options.concurrency tabs at a time. A tab
+that fails or doesn't answer in options.timeout milliseconds gets an
+undefined result, so a single slow page can't stall the whole batch.
+onSuccess receives [{tab, result}] in the order of the tabs. Timing of
+every tab, the number of failures and of results served from scriptCache
+are sent to the app.
+
+If onResult is given, it receives every {tab, result} as soon as the results
+of all the tabs before it are ready, and the result is not kept.
+
+If options.transform is given, it receives (tab, result) and returns a
+promise of the result to send instead. scriptCache keeps the result as the
+script returned it.
+*/
+function runScriptOnTabs(tabs, script, options, onResult, onSuccess) {
+  const results = new Array(tabs.length);
+  const stats = {
+    command: options.name,
+    tabs: tabs.length,
+    concurrency: options.concurrency,
+    timeout: options.timeout,
+    failed: 0,
+    timed_out: 0,
+    cached: 0,
+    // [tab id, milliseconds, 'ok' | 'cached' | 'error' | 'timeout']
+    timings: [],
+  };
+  const started = Date.now();
+  let next = 0;
+  let emitted = 0;
+
+  function runOne(tab) {
+    return new Promise(resolve => {
+      const cached = scriptCache.get(tab, script);
+      if (cached !== undefined) {
+        stats.cached++;
+        stats.timings.push([tab.id, 0, 'cached']);
+        resolve(cached);
+        return;
+      }
+      const generation = scriptCache.generation(tab.id);
+      const tabStarted = Date.now();
+      let timer = undefined;
+      let done = false;
+      const finish = (status, result) => {
+        if (done) {
+          return;
+        }
+        done = true;
+        clearTimeout(timer);
+        stats.timings.push([tab.id, Date.now() - tabStarted, status]);
+        if (status == 'error') {
+          stats.failed++;
+        } else if (status == 'timeout') {
+          stats.timed_out++;
+        }
+        resolve(result);
+      };
+      timer = setTimeout(() => {
+        console.log(`Script timed out in tab ${tab.id} after ${options.timeout} ms`);
+        finish('timeout', undefined);
+      }, options.timeout);
+      browserTabs.runScript(tab.id, script, tab,
+        (result, _payload) => {
+          if (!done) {
+            scriptCache.put(tab, script, generation, result);
+          }
+          finish('ok', result);
         },
         (error, _payload) => {
-          console.log(`Could not get words from tab: ${error}`);
-          resolve([]);
+          console.log(`Could not run script in tab ${tab.id}: ${error}`);
+          finish('error', undefined);
         }
-      )
-    );
-    promises.push(promise);
+      );
+    });
+  }
+
+  function worker() {
+    if (next >= tabs.length) {
+      return Promise.resolve();
+    }
+    const index = next++;
+    return runOne(tabs[index]).then(result =>
+      options.transform ? options.transform(tabs[index], result) : result
+    ).then(result => {
+      results[index] = {tab: tabs[index], result: result};
+      while (onResult && emitted < tabs.length && results[emitted] !== undefined) {
+        onResult(results[emitted]);
+        results[emitted++] = null;
+      }
+      return worker();
+    });
+  }
+
+  let workers = [];
+  for (let i = 0; i < Math.min(options.concurrency, tabs.length); i++) {
+    workers.push(worker());
   }
-  Promise.all(promises).then(
-    (all_words) => {
-      const result = Array.prototype.concat(...all_words);
-      console.log(`Total number of words: ${result.length}`);
-      port.postMessage(result);
+  Promise.all(workers).then(() => {
+    stats.elapsed = Date.now() - started;
+    console.log(`Script ran in ${tabs.length} tabs in ${stats.elapsed} ms, ` +
+                `failed ${stats.failed}, timed out ${stats.timed_out}, cached ${stats.cached}`);
+    stats.cache = scriptCache.stats();
+    sendToApp({event: 'script_stats', stats: stats});
+    onSuccess(results);
+  });
+}
+
+function getWordsFromTabs(tabs, match_regex, join_with, options, reply) {
+  console.log(`Getting words from tabs: ${tabs}`);
+  const script = getWordsScript(match_regex, join_with);
+
+  runScriptOnTabs(tabs, script, options, undefined, (results) => {
+    const all_words = results.map(({tab, result}) => listOr(result, []));
+    const words = Array.prototype.concat(...all_words);
+    console.log(`Total number of words: ${words.length}`);
+    reply(words);
+  });
+}
+
+/*
+Words of many tabs, a word found in several tabs is sent once. The words
+are sent one per item, join_with doesn't apply.
+*/
+function getUniqueWordsFromTabs(tabs, match_regex, options, reply) {
+  console.log(`Getting unique words from tabs: ${tabs.length}`);
+  const script = GET_WORDS_LIST_SCRIPT.replace('#match_regex#', match_regex);
+
+  runScriptOnTabs(tabs, script, options, undefined, (results) => {
+    const words = new Set();
+    for (const {tab, result} of results) {
+      // the script returns an array, the result is an array of one item
+      for (const word of (result && result[0]) || []) {
+        words.add(word);
+      }
     }
-  )
+    console.log(`Total number of unique words: ${words.size}`);
+    reply(Array.from(words).sort());
+  });
 }
 
-function getWords(tab_id, match_regex, join_with) {
-  if (tab_id == null) {
+/*
+Words of the tabs listed in tab_ids if it's given, of the tab_id tab
+otherwise, or of the active tabs if tab_id is null.
+*/
+function getWords(tab_id, tab_ids, match_regex, join_with, options, reply) {
+  if (tab_ids !== undefined) {
+    console.log(`Getting words from tabs ${tab_ids}`);
+    browserTabs.list({'discarded': false},
+      (tabs) => getUniqueWordsFromTabs(filterTabs(tabs, tab_ids, undefined),
+                                       match_regex, options, reply),
+    );
+  } else if (tab_id == null) {
     console.log(`Getting words for active tabs`);
     browserTabs.getActive(
-      (tabs) => getWordsFromTabs(tabs, match_regex, join_with),
+      (tabs) => getWordsFromTabs(tabs, match_regex, join_with, options, reply),
     );
   } else {
-    const script = getWordsScript(match_regex, join_with);
-    console.log(`Getting words, running a script: ${script}`);
-    browserTabs.runScript(tab_id, script, null,
-      (words, _payload) => port.postMessage(listOr(words, [])),
-      (error, _payload) => console.log(`getWords: tab_id=${tab_id}, could not run script (${script})`),
+    console.log(`Getting words from tab ${tab_id}`);
+    browserTabs.get(tab_id,
+      (tab) => getWordsFromTabs([tab], match_regex, join_with, options, reply),
+      (error) => reply([]),
     );
   }
 }
 
-function getTextOrHtmlFromTabs(tabs, scriptGetter, delimiter_regex, replace_with, onSuccess) {
-  var promises = [];
+/*
+Keep only tabs that are listed in tab_ids or belong to windows listed in
+window_ids. Without both filters all tabs are kept.
+*/
+function filterTabs(tabs, tab_ids, window_ids) {
+  if (tab_ids === undefined && window_ids === undefined) {
+    return tabs;
+  }
+  return tabs.filter(tab =>
+    (tab_ids !== undefined && tab_ids.includes(tab.id)) ||
+    (window_ids !== undefined && window_ids.includes(tab.windowId)));
+}
+
+function getTextOrHtmlFromTabs(tabs, scriptGetter, delimiter_regex, replace_with, tab_ids, window_ids, options, onSuccess) {
+  tabs = filterTabs(tabs, tab_ids, window_ids);
   const script = scriptGetter(delimiter_regex, replace_with)
   console.log(`Getting text from tabs: ${tabs.length}, script (${script})`);
 
-  lines = [];
-  for (let tab of tabs) {
-    // console.log(`Processing tab ${tab.id}`);
-    var promise = new Promise(
-      (resolve, reject) => browserTabs.runScript(tab.id, script, tab,
-        (text, current_tab) => {
-          // let as_text = JSON.stringify(text);
-          // I don't know why, but an array of one item is sent here, so I take
-          // the first item.
-          if (text && text[0]) {
-            console.log(`Got ${text.length} chars of text from another tab: ${current_tab.id}`);
-            resolve({tab: current_tab, text: text[0]});
-          } else {
-            console.log(`Got empty text from another tab: ${current_tab.id}`);
-            resolve({tab: current_tab, text: ''});
-          }
-        },
-        (error, current_tab) => {
-          console.log(`Could not get text from tab: ${error}: ${current_tab.id}`);
-          resolve({tab: current_tab, text: ''});
-        }
-      )
-    );
-    promises.push(promise);
-  }
+  // I don't know why, but an array of one item is sent here, so I take
+  // the first item.
+  const firstItem = (result) => (result && result[0]) || '';
+  // text the app already has is replaced with UNCHANGED_MARKER
+  const hashes = options.hashes;
+  if (hashes) {
+    options = Object.assign({}, options, {transform: (tab, result) => {
+      if (result === undefined || hashes[tab.id] === undefined) {
+        return Promise.resolve(result);
+      }
+      return sha1Hex(firstItem(result)).then(
+        hash => hash == hashes[tab.id] ? [UNCHANGED_MARKER] : result,
+        error => result);
+    }});
+  }
+  // in streaming mode lines are sent as chunks and the final reply is empty
+  const onResult = options.onChunk &&
+    (({tab, result}) => options.onChunk(textLine(tab, firstItem(result))));
+  runScriptOnTabs(tabs, script, options, onResult, (results) => {
+    if (onResult) {
+      onSuccess([]);
+    } else {
+      onSuccess(results.map(({tab, result}) => ({tab: tab, text: firstItem(result)})));
+    }
+  });
+}
 
-  Promise.all(promises).then(onSuccess);
+function textLine(tab, text) {
+  return tab.windowId + "." + tab.id + "\t" + tab.title + "\t" + tab.url + "\t" + text;
 }
 
-function getTextOnRunScriptSuccess(all_results) {
+function getTextOnRunScriptSuccess(all_results, reply) {
   console.log(`Ready`);
   console.log(`Text promises are ready: ${all_results.length}`);
   // console.log(`All results: ${JSON.stringify(all_results)}`);
@@ -632,42 +1042,107 @@ function getTextOnRunScriptSuccess(all_results) {
     tab = result['tab'];
     text = result['text'];
     // console.log(`Result: ${tab.id}, ${text.length}`);
-    let line = tab.windowId + "." + tab.id + "\t" + tab.title + "\t" + tab.url + "\t" + text;
-    lines.push(line);
+    lines.push(textLine(tab, text));
   }
   // lines = lines.sort(naturalCompare);
   console.log(`Total number of lines of text: ${lines.length}`);
-  port.postMessage(lines);
+  reply(lines);
 }
 
-function getTextOnListSuccess(tabs, delimiter_regex, replace_with) {
+function getTextOnListSuccess(tabs, delimiter_regex, replace_with, tab_ids, window_ids, options, reply) {
   // Make sure tabs are sorted by their index within a window
   tabs.sort(compareWindowIdTabId);
-  getTextOrHtmlFromTabs(tabs, getTextScript, delimiter_regex, replace_with, getTextOnRunScriptSuccess);
+  getTextOrHtmlFromTabs(tabs, getTextScript, delimiter_regex, replace_with, tab_ids, window_ids, options,
+    results => getTextOnRunScriptSuccess(results, reply));
 }
 
-function getText(delimiter_regex, replace_with) {
+function getText(delimiter_regex, replace_with, tab_ids, window_ids, options, reply) {
   browserTabs.list({'discarded': false},
-      (tabs) => getTextOnListSuccess(tabs, delimiter_regex, replace_with),
+      (tabs) => getTextOnListSuccess(tabs, delimiter_regex, replace_with, tab_ids, window_ids, options, reply),
   );
 }
 
-function getHtmlOnListSuccess(tabs, delimiter_regex, replace_with) {
+function getHtmlOnListSuccess(tabs, delimiter_regex, replace_with, tab_ids, window_ids, options, reply) {
   // Make sure tabs are sorted by their index within a window
   tabs.sort(compareWindowIdTabId);
-  getTextOrHtmlFromTabs(tabs, getHtmlScript, delimiter_regex, replace_with, getTextOnRunScriptSuccess);
+  getTextOrHtmlFromTabs(tabs, getHtmlScript, delimiter_regex, replace_with, tab_ids, window_ids, options,
+    results => getTextOnRunScriptSuccess(results, reply));
 }
 
-function getHtml(delimiter_regex, replace_with) {
+function getHtml(delimiter_regex, replace_with, tab_ids, window_ids, options, reply) {
   browserTabs.list({'discarded': false},
-      (tabs) => getHtmlOnListSuccess(tabs, delimiter_regex, replace_with),
+      (tabs) => getHtmlOnListSuccess(tabs, delimiter_regex, replace_with, tab_ids, window_ids, options, reply),
   );
 }
 
-function getBrowserName() {
+function getBrowserName(reply) {
   const name = browserTabs.getBrowserName();
   console.log("Sending browser name: " + name);
-  port.postMessage(name);
+  reply(name);
+}
+
+/*
+The app keeps its own copy of the tabs to answer list_tabs and query_tabs
+without asking the browser. Every change is pushed to it as an event, a full
+snapshot is pushed on request.
+*/
+function tabRecord(tab) {
+  return {
+    id: tab.id,
+    windowId: tab.windowId,
+    index: tab.index,
+    title: tab.title,
+    url: tab.url,
+    status: tab.status,
+    active: tab.active,
+    pinned: tab.pinned,
+    audible: !!tab.audible,
+    muted: !!(tab.mutedInfo && tab.mutedInfo.muted),
+    discarded: !!tab.discarded,
+  };
+}
+
+function pushTabUpdated(tab) {
+  sendToApp({event: 'tab_updated', tab: tabRecord(tab)});
+}
+
+function pushTabRemoved(tabId) {
+  sendToApp({event: 'tab_removed', tab_id: tabId});
+}
+
+function pushTabSnapshot() {
+  browserTabs.list({}, tabs => {
+    console.log(`Pushing snapshot of ${tabs.length} tabs`);
+    sendToApp({event: 'tab_snapshot', tabs: tabs.map(tabRecord)});
+  });
+}
+
+browserTabs.subscribe(
+  (tab) => {
+    scriptCache.tabChanged(tab);
+    pushTabUpdated(tab);
+  },
+  (tabId) => {
+    scriptCache.tabRemoved(tabId);
+    pushTabRemoved(tabId);
+  },
+);
+
+/*
+Commands from the app carry an id. The reply has to carry the same id, that's
+how the app tells which of the commands in flight it belongs to.
+*/
+function makeReply(command) {
+  const reply = (result) => {
+    if (command['id'] === undefined) {
+      sendToApp(result);
+    } else {
+      sendToApp({id: command['id'], result: result});
+    }
+  };
+  // a streamed reply is any number of chunks followed by the result
+  reply.chunk = (chunk) => sendToApp({id: command['id'], chunk: chunk});
+  return reply;
 }
 
 /*
@@ -675,40 +1150,41 @@ Listen for messages from the app.
 */
 port.onMessage.addListener((command) => {
   console.log("Received: " + JSON.stringify(command, null, 4));
+  const reply = makeReply(command);
 
   if (command['name'] == 'list_tabs') {
     console.log('Listing tabs...');
-    listTabs();
+    listTabs(reply);
   }
 
   else if (command['name'] == 'query_tabs') {
     console.log('Querying tabs...');
-    queryTabs(command['query_info']);
+    queryTabs(command['query_info'], reply);
   }
 
   else if (command['name'] == 'close_tabs') {
     console.log('Closing tabs:', command['tab_ids']);
-    closeTabs(command['tab_ids']);
+    closeTabs(command['tab_ids'], reply);
   }
 
   else if (command['name'] == 'move_tabs') {
     console.log('Moving tabs:', command['move_triplets']);
-    moveTabs(command['move_triplets']);
+    moveTabs(command['move_triplets'], reply);
   }
 
   else if (command['name'] == 'open_urls') {
     console.log('Opening URLs:', command['urls'], command['window_id']);
-    openUrls(command['urls'], command['window_id']);
+    openUrls(command['urls'], command['window_id'], reply);
   }
 
   else if (command['name'] == 'new_tab') {
     console.log('Creating tab:', command['url']);
-    createTab(command['url']);
+    createTab(command['url'], reply);
   }
 
   else if (command['name'] == 'update_tabs') {
     console.log('Updating tabs:', command['updates']);
-    updateTabs(command['updates']);
+    updateTabs(command['updates'], reply);
   }
 
   else if (command['name'] == 'activate_tab') {
@@ -718,32 +1194,40 @@ port.onMessage.addListener((command) => {
 
   else if (command['name'] == 'get_active_tabs') {
     console.log('Getting active tabs');
-    getActiveTabs();
+    getActiveTabs(reply);
   }
 
   else if (command['name'] == 'get_screenshot') {
     console.log('Getting visible screenshot');
-    getActiveScreenshot();
+    getActiveScreenshot(reply);
   }
 
   else if (command['name'] == 'get_words') {
-    console.log('Getting words from tab:', command['tab_id']);
-    getWords(command['tab_id'], command['match_regex'], command['join_with']);
+    console.log('Getting words from tab:', command['tab_id'], command['tab_ids']);
+    getWords(command['tab_id'], command['tab_ids'], command['match_regex'], command['join_with'],
+             scriptOptions(command, reply), reply);
   }
 
   else if (command['name'] == 'get_text') {
     console.log('Getting texts from all tabs');
-    getText(command['delimiter_regex'], command['replace_with']);
+    getText(command['delimiter_regex'], command['replace_with'],
+            command['tab_ids'], command['window_ids'], scriptOptions(command, reply), reply);
   }
 
   else if (command['name'] == 'get_html') {
     console.log('Getting HTML from all tabs');
-    getHtml(command['delimiter_regex'], command['replace_with']);
+    getHtml(command['delimiter_regex'], command['replace_with'],
+            command['tab_ids'], command['window_ids'], scriptOptions(command, reply), reply);
+  }
+
+  else if (command['name'] == 'push_tab_snapshot') {
+    console.log('Pushing tab snapshot');
+    pushTabSnapshot();
   }
 
   else if (command['name'] == 'get_browser') {
     console.log('Getting browser name');
-    getBrowserName();
+    getBrowserName(reply);
   }
 });
 
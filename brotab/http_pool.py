@@ -0,0 +1,93 @@
+"""
+Keep-alive HTTP connections to mediators.
+
+A single `bt` invocation can send hundreds of requests to the same mediator
+(e.g. get_words for every tab), so connections are kept open and reused
+instead of paying for a TCP handshake on every request.
+"""
+import time
+from http.client import HTTPConnection
+from threading import Lock
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+DEFAULT_POOL_MAX_SIZE = 4
+DEFAULT_POOL_IDLE_TIMEOUT = 5.0
+
+
+class ConnectionPool:
+    """
+    Keeps up to `max_size` idle connections per host:port. Connections that
+    stayed idle longer than `idle_timeout` seconds are closed instead of
+    being reused, the mediator would drop them soon anyway.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_POOL_MAX_SIZE,
+                 idle_timeout: float = DEFAULT_POOL_IDLE_TIMEOUT):
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._idle: Dict[Tuple[str, int], List[Tuple[float, HTTPConnection]]] = {}
+        self._lock = Lock()
+
+    def acquire(self, host: str, port: int, timeout: float) -> Tuple[HTTPConnection, bool]:
+        """
+        Return a connection and a flag telling whether it has been used
+        before. A reused connection might have been closed by the server in
+        the meantime, so the caller should be ready to retry once.
+        """
+        key = (host, int(port))
+        now = time.monotonic()
+        stale = []
+        connection = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                released_at, candidate = idle.pop()
+                if now - released_at > self._idle_timeout:
+                    stale.append(candidate)
+                    continue
+                connection = candidate
+                break
+        for candidate in stale:
+            candidate.close()
+
+        if connection is None:
+            return HTTPConnection(host, port, timeout=timeout), False
+
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection, True
+
+    def release(self, connection: HTTPConnection) -> None:
+        """Put a connection whose response has been fully read back."""
+        if connection.sock is None:
+            return
+        key = (connection.host, connection.port)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._max_size:
+                idle.append((time.monotonic(), connection))
+                return
+        connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for _released_at, connection in connections:
+                connection.close()
+
+
+_default_pool = None
+_default_pool_lock = Lock()
+
+
+def default_pool() -> ConnectionPool:
+    """Process-wide pool shared by all HttpClient instances."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
@@ -1,8 +1,11 @@
+import errno
 import io
 import mimetypes
 import os
+import selectors
 import socket
 import sys
+import time
 import uuid
 from select import select
 from subprocess import CalledProcessError
@@ -10,6 +13,8 @@ from subprocess import check_call
 from tempfile import NamedTemporaryFile
 from typing import BinaryIO
 from typing import Iterable
+from typing import List
+from typing import Tuple
 from typing import Union
 
 from brotab.env import max_http_port
@@ -36,6 +41,50 @@ def is_port_accepting_connections(port, host='127.0.0.1'):
     return result == 0
 
 
+_CONNECT_IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY,
+                        getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK)}
+
+
+def probe_ports(addresses: List[Tuple[str, int]], timeout=0.100) -> List[bool]:
+    """
+    Tell which of the (host, port) pairs accept TCP connections.
+
+    Unlike is_port_accepting_connections, all connections are attempted at
+    once, so the check takes at most `timeout` seconds in total.
+    """
+    result = [False] * len(addresses)
+    sockets = []
+    selector = selectors.DefaultSelector()
+    try:
+        for i, (host, port) in enumerate(addresses):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(s)
+            s.setblocking(False)
+            try:
+                code = s.connect_ex((host, port))
+            except OSError:  # e.g. host cannot be resolved
+                continue
+            if code == 0:
+                result[i] = True
+            elif code in _CONNECT_IN_PROGRESS:
+                selector.register(s, selectors.EVENT_WRITE, i)
+
+        expires_at = time.monotonic() + timeout
+        while selector.get_map():
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                break
+            for key, _events in selector.select(remaining):
+                selector.unregister(key.fileobj)
+                code = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                result[key.data] = code == 0
+    finally:
+        selector.close()
+        for s in sockets:
+            s.close()
+    return result
+
+
 def save_tabs_to_file(tabs, filename):
     with open(filename, 'w', encoding='utf-8') as file_:
         file_.write('\n'.join(tabs))
@@ -192,6 +241,11 @@ class TimeoutIO(io.BytesIO):
         else:
             raise TimeoutError('Read timeout ({}s)'.format(self.timeout))
 
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
     def write(self, *args, **kwargs) -> int:
         _, wlist, _ = select([], [self.file_], [], self.timeout)
         if wlist:
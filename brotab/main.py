@@ -52,6 +52,7 @@ import re
 import sys
 import time
 from argparse import ArgumentParser
+from argparse import Namespace
 from functools import partial
 from itertools import groupby
 from json import loads, dumps
@@ -68,14 +69,17 @@ from brotab.const import DEFAULT_GET_TEXT_DELIMITER_REGEX
 from brotab.const import DEFAULT_GET_TEXT_REPLACE_WITH
 from brotab.const import DEFAULT_GET_WORDS_JOIN_WITH
 from brotab.const import DEFAULT_GET_WORDS_MATCH_REGEX
+from brotab.const import UNCHANGED_MARKER
+from brotab.discovery import discover_mediators
 from brotab.files import in_temp_dir
 from brotab.inout import get_mediator_ports
-from brotab.inout import is_port_accepting_connections
 from brotab.inout import marshal
 from brotab.inout import read_stdin
 from brotab.inout import read_stdin_lines
 from brotab.inout import stdout_buffer_write
 from brotab.mediator.log import brotab_logger
+from brotab.mediator.registry import read_entries as read_mediator_registry
+from brotab.mediator.support import is_valid_integer
 from brotab.operations import make_update
 from brotab.platform import is_windows
 from brotab.platform import make_windows_path_double_sep
@@ -83,9 +87,18 @@ from brotab.platform import register_native_manifest_windows_brave
 from brotab.platform import register_native_manifest_windows_chrome
 from brotab.platform import register_native_manifest_windows_firefox
 from brotab.search.index import index
+from brotab.search.index import index_lines
+from brotab.search.index import text_hashes
+from brotab.search.query import DEFAULT_QUERY_SOCKET
+from brotab.search.query import QueryClient
 from brotab.search.query import query
+from brotab.search.watch import DEFAULT_WATCH_RATE
+from brotab.search.watch import IndexWatcher
+from brotab.search.watch import acquire_watch_lock
 from brotab.utils import get_file_size
 from brotab.utils import split_tab_ids
+from brotab.utils import squeeze_whitespace
+from brotab.utils import text_hash
 from brotab.utils import which
 
 
@@ -102,20 +115,58 @@ def parse_target_hosts(target_hosts: str) -> Tuple[List[str], List[int]]:
     return hosts, ports
 
 
+def clients_from_registry(ports: List[int]) -> List[SingleMediatorAPI]:
+    """
+    Create clients for the mediators that published themselves in the
+    registry. Prefixes are assigned by port, the same way port scan does.
+    """
+    result = []
+    for entry in read_mediator_registry():
+        if entry.port not in ports:
+            continue
+        prefix = ascii_lowercase[ports.index(entry.port)]
+        host = 'localhost' if entry.host in ('', '0.0.0.0', '::') else entry.host
+        result.append(SingleMediatorAPI(prefix, host=host, port=entry.port,
+                                        pid=entry.pid, browser=entry.browser))
+    return result
+
+
 def create_clients(target_hosts=None) -> List[SingleMediatorAPI]:
     if target_hosts is None:
         ports = list(get_mediator_ports())
-        hosts = ['localhost'] * len(ports)
+        result = clients_from_registry(ports)
+        # mediators that don't publish themselves (older versions, or ones
+        # that are still waiting for the browser's name) are found by port
+        # scan of the ports no live entry accounts for
+        published = {client._port for client in result}
+        ports_to_scan = [port for port in ports if port not in published]
+        if ports_to_scan:
+            prefixes = [ascii_lowercase[ports.index(port)] for port in ports_to_scan]
+            hosts = ['localhost'] * len(ports_to_scan)
+            result = sorted(result + discover_mediators(prefixes, hosts, ports_to_scan),
+                            key=lambda client: client._port)
     else:
         hosts, ports = parse_target_hosts(target_hosts)
+        result = discover_mediators(list(ascii_lowercase[:len(ports)]), hosts, ports)
 
-    result = [SingleMediatorAPI(prefix, host=host, port=port)
-              for prefix, host, port in zip(ascii_lowercase, hosts, ports)
-              if is_port_accepting_connections(port, host)]
     brotab_logger.info('Created clients: %s', result)
     return result
 
 
+def check_tab_ids(tab_ids) -> bool:
+    """
+    Report ids that are neither <prefix>.<window_id>.<tab_id> nor
+    <prefix>.<window_id>, return True if there are none.
+    """
+    valid = True
+    for id_ in tab_ids:
+        parts = id_.split('.')
+        if len(parts) not in (2, 3) or not all(is_valid_integer(part) for part in parts[1:]):
+            print('Invalid tab or window id: %s' % id_, file=sys.stderr)
+            valid = False
+    return valid
+
+
 def parse_prefix_and_window_id(prefix_window_id):
     prefix, window_id = None, None
     try:
@@ -185,7 +236,19 @@ def screenshot(args):
         print(result)
 
 def search_tabs(args):
-    for result in query(args.sqlite, args.query):
+    results = None
+    if args.socket is not None:
+        client = QueryClient(args.socket)
+        try:
+            results = client.query(args.query)
+        except OSError as e:
+            brotab_logger.warning('Cannot query search server %s, querying %s: %s',
+                                  args.socket, args.sqlite, e)
+        finally:
+            client.close()
+    if results is None:
+        results = query(args.sqlite, args.query)
+    for result in results:
         print('\t'.join([result.tab_id, result.title, result.snippet]))
 
 
@@ -202,21 +265,55 @@ def query_tabs(args):
         print(tab)
 
 
+def watch_index(args):
+    lock_file = acquire_watch_lock(args.sqlite)
+    if lock_file is None:
+        brotab_logger.info('Index %s is being watched by another process', args.sqlite)
+        return 0
+    # text is cleaned up by text_records, after it's hashed
+    args.cleanup = False
+
+    def discover():
+        return [api for api in create_clients(args.target_hosts) if api.ready]
+
+    def extract(tab_ids):
+        api = MultipleMediatorsAPI(watcher.apis)
+        iterator = partial(api.iter_text, hashes=text_hashes(args.sqlite, tab_ids))
+        return text_records(iter_text_or_html(
+            iterator, Namespace(**dict(vars(args), tab_ids=tab_ids))))
+
+    watcher = IndexWatcher(discover, args.sqlite, extract, args.rate)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+    finally:
+        lock_file.close()
+
+
 def index_tabs(args):
-    if args.tsv is None:
-        args.tsv = in_temp_dir('tabs.tsv')
-        args.cleanup = True
-        brotab_logger.info(
-            'index_tabs: retrieving tabs from browser into file %s', args.tsv)
-        start = time.time()
-        get_text(args)
-        delta = time.time() - start
-        brotab_logger.info('getting text took %s', delta)
+    if not check_tab_ids(args.tab_ids):
+        return 1
+    if args.watch:
+        return watch_index(args)
 
     start = time.time()
-    index(args.sqlite, args.tsv)
+    if args.tsv is None:
+        brotab_logger.info('index_tabs: indexing text from browser')
+        # text is cleaned up by text_records, after it's hashed
+        args.cleanup = False
+        api = MultipleMediatorsAPI(create_clients(args.target_hosts))
+        # the browser doesn't send text that is in the index already, unless
+        # all of it is needed
+        hashes = None if args.full or args.save_tsv is not None else text_hashes(args.sqlite)
+        records = text_records(iter_text_or_html(partial(api.iter_text, hashes=hashes), args))
+        if args.save_tsv is not None:
+            records = save_records(records, args.save_tsv)
+        index_lines(args.sqlite, records, args.full)
+    else:
+        index(args.sqlite, args.tsv, args.full)
     delta = time.time() - start
-    brotab_logger.info('sqlite create took %s, size %s',
+    brotab_logger.info('sqlite update took %s, size %s',
                        delta, get_file_size(args.sqlite))
 
 
@@ -289,48 +386,98 @@ def get_words(args):
     # return tab.execute({javascript: "
     # [...new Set(document.body.innerText.match(/\w+/g))].sort().join('\n');
     # "})
+    if not check_tab_ids(args.tab_ids):
+        return 1
     start = time.time()
     brotab_logger.info('Get words from tabs: %s, match_regex=%s, join_with=%s',
                        args.tab_ids, args.match_regex, args.join_with)
     api = MultipleMediatorsAPI(create_clients(args.target_hosts))
-    words = api.get_words(args.tab_ids, args.match_regex, args.join_with)
+    words = api.get_words(args.tab_ids, args.match_regex, args.join_with,
+                          args.concurrency, args.script_timeout)
     print('\n'.join(words))
     delta = time.time() - start
     # print('DELTA TOTAL', delta, file=sys.stderr)
 
 
-def get_text_or_html(getter, args):
-    tabs = getter([], args.delimiter_regex, args.replace_with)
-    re_match_tabs = re.compile('|'.join(['^%s\t' % tab for tab in args.tab_ids]))
-    tabs = [tab for tab in tabs if re_match_tabs.match(tab)]
-
-    if args.cleanup:
-        pattern = re.compile(r'\s+')
-        old_tabs = tabs
-        tabs = []
-        for line in old_tabs:
+def iter_text_or_html(iterator, args):
+    """
+    Yield lines as they arrive from the mediators, so memory use doesn't
+    depend on the number of tabs.
+    """
+    lines = iterator(args.delimiter_regex, args.replace_with, args.tab_ids,
+                     args.concurrency, args.script_timeout)
+    # the browser only processes the requested tabs, the filtering below is
+    # for extensions that don't support tab_ids yet
+    re_match_tabs = re.compile('|'.join([
+        ('^%s\t' if tab.count('.') == 2 else '^%s\\.') % re.escape(tab)
+        for tab in args.tab_ids]))
+    for line in lines:
+        if not re_match_tabs.match(line):
+            continue
+        if args.cleanup:
             tab_id, title, url, text = line.split('\t')
-            text = re.sub(pattern, ' ', text)
-            tabs.append('\t'.join([tab_id, title, url, text]))
+            text = squeeze_whitespace(text)
+            line = '\t'.join([tab_id, title, url, text])
+        yield line
 
-    message = '\n'.join(tabs) + '\n'
+
+def text_records(lines):
+    """
+    Turn text lines into (tab_id, title, url, text, text_hash) records of
+    the index. text_hash is of the text as the browser sent it, the text is
+    cleaned up. Text that is UNCHANGED_MARKER is left for the index to
+    resolve.
+    """
+    for line in lines:
+        tab_id, title, url, text = line.split('\t')
+        if text == UNCHANGED_MARKER:
+            yield tab_id, title, url, text
+        else:
+            yield tab_id, title, url, squeeze_whitespace(text), text_hash(text)
+
+
+def save_records(records, filename):
+    """Pass records through, writing them to the file on the way."""
+    with open(filename, 'w', encoding='utf-8') as file_:
+        for record in records:
+            file_.write('\t'.join(record[:4]) + '\n')
+            yield record
+
+
+def get_text_or_html(iterator, args):
     if args.tsv is None:
-        stdout_buffer_write(message.encode('utf8'))
+        write = lambda message: stdout_buffer_write(message.encode('utf8'))
+        file_ = None
     else:
-        with open(args.tsv, 'w', encoding='utf-8') as file_:
-            file_.write(message)
+        file_ = open(args.tsv, 'w', encoding='utf-8')
+        write = file_.write
+
+    try:
+        written = 0
+        for line in iter_text_or_html(iterator, args):
+            write(line + '\n')
+            written += 1
+        if written == 0:
+            write('\n')
+    finally:
+        if file_ is not None:
+            file_.close()
 
 
 def get_text(args):
+    if not check_tab_ids(args.tab_ids):
+        return 1
     brotab_logger.info('Get text from tabs')
     api = MultipleMediatorsAPI(create_clients(args.target_hosts))
-    return get_text_or_html(api.get_text, args)
+    return get_text_or_html(api.iter_text, args)
 
 
 def get_html(args):
+    if not check_tab_ids(args.tab_ids):
+        return 1
     brotab_logger.info('Get html from tabs')
     api = MultipleMediatorsAPI(create_clients(args.target_hosts))
-    return get_text_or_html(api.get_html, args)
+    return get_text_or_html(api.iter_html, args)
 
 
 def show_duplicates(args):
@@ -371,6 +518,12 @@ def show_clients(args):
         print(client)
 
 
+def show_stats(args):
+    brotab_logger.info('Showing stats')
+    api = MultipleMediatorsAPI(create_clients(args.target_hosts))
+    stdout_buffer_write((dumps(api.get_stats(), indent=2, sort_keys=True) + '\n').encode('utf8'))
+
+
 def install_mediator(args):
     brotab_logger.info('Installing mediators')
     bt_mediator_path = which('bt_mediator')
@@ -430,6 +583,15 @@ def no_command(parser, args):
     return 1
 
 
+def add_script_options(parser):
+    parser.add_argument(
+        '--concurrency', type=int, default=None,
+        help='Number of tabs the browser runs the script in at a time')
+    parser.add_argument(
+        '--script-timeout', type=float, default=None,
+        help='Seconds to wait for the script in a single tab before skipping it')
+
+
 def parse_args(args):
     parser = ArgumentParser(
         description='''
@@ -511,6 +673,10 @@ def parse_args(args):
     parser_search_tabs.set_defaults(func=search_tabs)
     parser_search_tabs.add_argument('--sqlite', type=str, default=in_temp_dir('tabs.sqlite'),
                                     help='sqlite DB filename')
+    parser_search_tabs.add_argument('--socket', type=str, nargs='?', default=None,
+                                    const=DEFAULT_QUERY_SOCKET,
+                                    help='ask the search server listening on this socket '
+                                         '(python -m brotab.search.query --serve)')
     parser_search_tabs.add_argument('query', type=str, help='Search query')
 
     parser_query_tabs = subparsers.add_parser(
@@ -583,17 +749,30 @@ def parse_args(args):
         ''')
     parser_index_tabs.set_defaults(func=index_tabs)
     parser_index_tabs.add_argument('tab_ids', type=str, nargs='*',
-                                   help='Tab IDs to get text from')
+                                   help='Tab IDs (or window IDs) to get text from')
     parser_index_tabs.add_argument('--sqlite', type=str, default=in_temp_dir('tabs.sqlite'),
                                    help='sqlite DB filename')
     parser_index_tabs.add_argument('--tsv', type=str, default=None,
-                                   help='get text from tabs and index the results')
+                                   help='index this tsv file instead of getting '
+                                        'text from tabs')
+    parser_index_tabs.add_argument('--save-tsv', type=str, default=None,
+                                   help='also save text from tabs to this tsv file')
+    parser_index_tabs.add_argument('--full', action='store_true', default=False,
+                                   help='drop the index and build it from scratch instead '
+                                        'of updating only the tabs that changed')
+    parser_index_tabs.add_argument('--watch', action='store_true', default=False,
+                                   help='keep running and index tabs as they are opened, '
+                                        'navigated and closed')
+    parser_index_tabs.add_argument('--rate', type=float, default=DEFAULT_WATCH_RATE,
+                                   help='with --watch, get text from at most this many '
+                                        'tabs per second')
     parser_index_tabs.add_argument(
         '--delimiter-regex', type=str, default=DEFAULT_GET_TEXT_DELIMITER_REGEX,
         help='Regex that is used to match delimiters in the page text')
     parser_index_tabs.add_argument(
         '--replace-with', type=str, default=DEFAULT_GET_TEXT_REPLACE_WITH,
         help='String that is used to replaced matched delimiters')
+    add_script_options(parser_index_tabs)
 
     parser_new_tab = subparsers.add_parser(
         'new',
@@ -699,6 +878,7 @@ def parse_args(args):
     parser_get_words.add_argument(
         '--join-with', type=str, default=DEFAULT_GET_WORDS_JOIN_WITH,
         help='String that is used to join matched words')
+    add_script_options(parser_get_words)
 
     parser_get_text = subparsers.add_parser(
         'text',
@@ -707,7 +887,7 @@ def parse_args(args):
         ''')
     parser_get_text.set_defaults(func=get_text)
     parser_get_text.add_argument('tab_ids', type=str, nargs='*',
-                                 help='Tab IDs to get text from')
+                                 help='Tab IDs (or window IDs) to get text from')
     parser_get_text.add_argument('--tsv', type=str, default=None,
                                  help='tsv file to save results to')
     parser_get_text.add_argument('--cleanup', action='store_true',
@@ -719,6 +899,7 @@ def parse_args(args):
     parser_get_text.add_argument(
         '--replace-with', type=str, default=DEFAULT_GET_TEXT_REPLACE_WITH,
         help='String that is used to replaced matched delimiters')
+    add_script_options(parser_get_text)
 
     parser_get_html = subparsers.add_parser(
         'html',
@@ -727,7 +908,7 @@ def parse_args(args):
         ''')
     parser_get_html.set_defaults(func=get_html)
     parser_get_html.add_argument('tab_ids', type=str, nargs='*',
-                                 help='Tab IDs to get text from')
+                                 help='Tab IDs (or window IDs) to get text from')
     parser_get_html.add_argument('--tsv', type=str, default=None,
                                  help='tsv file to save results to')
     parser_get_html.add_argument('--cleanup', action='store_true',
@@ -739,6 +920,7 @@ def parse_args(args):
     parser_get_html.add_argument(
         '--replace-with', type=str, default=DEFAULT_GET_HTML_REPLACE_WITH,
         help='String that is used to replaced matched delimiters')
+    add_script_options(parser_get_html)
 
     parser_show_duplicates = subparsers.add_parser(
         'dup',
@@ -763,6 +945,14 @@ def parse_args(args):
         ''')
     parser_show_clients.set_defaults(func=show_clients)
 
+    parser_show_stats = subparsers.add_parser(
+        'stats',
+        help='''
+        display statistics of the scripts the browsers ran in tabs (get_text,
+        get_html, get_words) and of the cache of their results, as JSON
+        ''')
+    parser_show_stats.set_defaults(func=show_stats)
+
     parser_install_mediator = subparsers.add_parser(
         'install',
         help='''
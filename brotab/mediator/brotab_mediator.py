@@ -5,16 +5,22 @@ import logging.handlers
 import os
 import re
 import socket
+import time
+from threading import Thread
 
 from brotab.env import http_iface
 from brotab.env import load_dotenv
 from brotab.inout import get_mediator_ports
 from brotab.inout import is_port_accepting_connections
+from brotab.mediator import registry
 from brotab.mediator import sig
 from brotab.mediator.const import DEFAULT_SHUTDOWN_POLL_INTERVAL
+from brotab.mediator.const import DEFAULT_TAB_RESYNC_INTERVAL
 from brotab.mediator.http_server import MediatorHttpServer
 from brotab.mediator.log import disable_click_echo
 from brotab.mediator.log import mediator_logger
+from brotab.mediator.log import set_log_level_from_env
+from brotab.mediator.remote_api import BrowserRemoteAPI
 from brotab.mediator.remote_api import default_remote_api
 from brotab.mediator.transport import default_transport
 
@@ -37,7 +43,6 @@ from brotab.mediator.transport import default_transport
 # TODO: all commands should be synchronous and should only terminate after
 #       the action has been actually executed in the browser.
 # TODO: logs from main and mediator should go into different files
-# TODO: bt html may cause "Uncaught (in promise) Error: Message length exceeded maximum allowed length."
 
 
 def monkeypatch_socket_bind_allow_port_reuse():
@@ -63,11 +68,49 @@ def blacklist_loggers():
             logger.propagate = False
 
 
+def publish_in_background(host: str, port: int, remote_api: BrowserRemoteAPI) -> None:
+    """Publish the registry entry once the browser has told its name."""
+
+    def publish():
+        try:
+            browser = remote_api.get_browser()
+        except Exception as e:
+            mediator_logger.exception('Cannot get browser name, not publishing registry entry: %s', e)
+            return
+        try:
+            registry.publish(registry.make_entry(host, port, browser))
+        except OSError as e:
+            # clients find the mediator by port scan then
+            mediator_logger.error('Cannot publish registry entry: %s', e)
+
+    thread = Thread(target=publish)
+    thread.daemon = True
+    thread.start()
+
+
+def resync_tabs_in_background(remote_api: BrowserRemoteAPI, interval: float) -> None:
+    """Periodically replace the tab model with a full snapshot to fix drift."""
+
+    def resync():
+        while True:
+            try:
+                remote_api.request_tab_snapshot()
+            except Exception as e:
+                mediator_logger.exception('Cannot request tab snapshot, stop resyncing: %s', e)
+                return
+            time.sleep(interval)
+
+    thread = Thread(target=resync)
+    thread.daemon = True
+    thread.start()
+
+
 def mediator_main():
     monkeypatch_socket_bind_allow_port_reuse()
     disable_click_echo()
 
     load_dotenv()
+    set_log_level_from_env()
     port_range = list(get_mediator_ports())
     transport = default_transport()
     # transport = transport_with_timeout(sys.stdin.buffer, sys.stdout.buffer, DEFAULT_TRANSPORT_TIMEOUT)
@@ -84,8 +127,11 @@ def mediator_main():
             server = MediatorHttpServer(host, port, remote_api, poll_interval)
             thread = server.run.in_thread()
             sig.setup(lambda: server.run.shutdown(join=False))
+            publish_in_background(host, port, remote_api)
+            resync_tabs_in_background(remote_api, DEFAULT_TAB_RESYNC_INTERVAL)
             # server.run.parent_watcher(thread.is_alive, interval=1.0)
             thread.join()
+            registry.unpublish(port, os.getpid())
             mediator_logger.info('Exiting mediator pid=%s on %s:%s...', os.getpid(), host, port)
             break
         except OSError as e:
@@ -95,6 +141,7 @@ def mediator_main():
             # TODO: probably also won't work with processes, also a race
             mediator_logger.exception('Pipe has been closed (%s)', e)
             server.run.shutdown(join=True)
+            registry.unpublish(port, os.getpid())
             break
 
     else:
@@ -6,8 +6,18 @@ from brotab.const import DEFAULT_GET_WORDS_JOIN_WITH
 from brotab.const import DEFAULT_GET_WORDS_MATCH_REGEX
 from brotab.utils import encode_query
 
+# longest wait for the reply to a command, scripts get more, see
+# BrowserRemoteAPI._script_timeout
 DEFAULT_TRANSPORT_TIMEOUT = 60.0
+# defaults of the extension for scripts (DEFAULT_SCRIPT_* in background.js)
+DEFAULT_SCRIPT_CONCURRENCY = 8
+DEFAULT_SCRIPT_TIMEOUT = 5.0
+# tabs a script is assumed to run in when the tab model doesn't know yet
+MAX_SCRIPT_TABS = 5000
 DEFAULT_SHUTDOWN_POLL_INTERVAL = 1.0
+DEFAULT_TAB_RESYNC_INTERVAL = 60.0
+# longest a /list_tabs?since=N&wait=S request waits for a change
+MAX_LIST_TABS_WAIT = 60.0
 DEFAULT_HTTP_IFACE = '127.0.0.1'
 DEFAULT_MIN_HTTP_PORT = 4625
 DEFAULT_MAX_HTTP_PORT = DEFAULT_MIN_HTTP_PORT + 10
@@ -1,24 +1,35 @@
+import math
 import os
 from json import loads
 from threading import Thread
 from urllib.parse import unquote_plus
-from wsgiref.simple_server import make_server
 
 from flask import Flask
+from flask import Response
+from flask import abort
+from flask import jsonify
 from flask import request
 
+from brotab.compression import CompressionMiddleware
+from brotab.const import TAB_COLUMNS_MIMETYPE
 from brotab.mediator.const import DEFAULT_GET_HTML_DELIMITER_REGEX
 from brotab.mediator.const import DEFAULT_GET_HTML_REPLACE_WITH
 from brotab.mediator.const import DEFAULT_GET_TEXT_DELIMITER_REGEX
 from brotab.mediator.const import DEFAULT_GET_TEXT_REPLACE_WITH
 from brotab.mediator.const import DEFAULT_GET_WORDS_JOIN_WITH
 from brotab.mediator.const import DEFAULT_GET_WORDS_MATCH_REGEX
+from brotab.mediator.const import MAX_LIST_TABS_WAIT
 from brotab.mediator.log import mediator_logger
+from brotab.mediator.log import payload
 from brotab.mediator.remote_api import BrowserRemoteAPI
 from brotab.mediator.runner import Runner
 from brotab.mediator.support import is_valid_integer
+from brotab.mediator.support import parse_integer_list
+from brotab.mediator.transport import ReplyTimeoutError
 from brotab.mediator.transport import TransportError
+from brotab.mediator.wsgi import make_keepalive_server
 from brotab.utils import decode_query
+from brotab.utils import fast_json_dumps
 
 
 class MediatorHttpServer:
@@ -28,7 +39,9 @@ class MediatorHttpServer:
         self.remote_api: BrowserRemoteAPI = remote_api
         self.pid: int = os.getpid()
         self.app = Flask(__name__)
-        self.http_server = make_server(host=host, port=port, app=self.app)
+        # clients on other machines get compressed responses if they ask
+        self.http_server = make_keepalive_server(host=host, port=port,
+                                                 app=CompressionMiddleware(self.app))
         self._setup_routes()
 
         def serve():
@@ -55,6 +68,8 @@ class MediatorHttpServer:
         self.app.register_error_handler(TimeoutError, self.error_handler)
         self.app.register_error_handler(ValueError, self.error_handler)
         self.app.register_error_handler(TransportError, self.error_handler)
+        # the browser is still there, only this request failed
+        self.app.register_error_handler(ReplyTimeoutError, self.reply_timeout_handler)
         self.app.route('/', methods=['GET'])(self.root_handler)
         self.app.route('/shutdown', methods=['GET'])(self.shutdown)
         self.app.route('/list_tabs', methods=['GET'])(self.list_tabs)
@@ -70,10 +85,12 @@ class MediatorHttpServer:
         self.app.route('/get_screenshot', methods=['GET'])(self.get_screenshot)
         self.app.route('/get_words/<string:tab_id>', methods=['GET'])(self.get_words)
         self.app.route('/get_words', methods=['GET'])(self.get_words)
-        self.app.route('/get_text', methods=['GET'])(self.get_text)
-        self.app.route('/get_html', methods=['GET'])(self.get_html)
+        # POST carries hashes of the text the client has in a JSON body
+        self.app.route('/get_text', methods=['GET', 'POST'])(self.get_text)
+        self.app.route('/get_html', methods=['GET', 'POST'])(self.get_html)
         self.app.route('/get_pid', methods=['GET'])(self.get_pid)
         self.app.route('/get_browser', methods=['GET'])(self.get_browser)
+        self.app.route('/get_stats', methods=['GET'])(self.get_stats)
         self.app.route('/echo', methods=['GET'])(self.echo)
 
     def error_handler(self, e: Exception):
@@ -83,6 +100,10 @@ class MediatorHttpServer:
         self.run.shutdown(join=False)
         return '<ERROR>'
 
+    def reply_timeout_handler(self, e: ReplyTimeoutError):
+        mediator_logger.error('%s %s: %s', request.method, request.path, e)
+        return '<ERROR> %s' % e, 504
+
     def root_handler(self):
         links = []
         for rule in self.app.url_map.iter_rules():
@@ -98,13 +119,58 @@ class MediatorHttpServer:
         return 'OK'
 
     def list_tabs(self):
+        since = self._number_arg('since', int)
+        if since is not None:
+            wait = self._number_arg('wait', float)
+            if wait is not None:
+                wait = min(wait, MAX_LIST_TABS_WAIT)
+            return jsonify(self.remote_api.list_tabs_delta(since, wait))
+        if self._accepts_columns():
+            return self._columns_response(self.remote_api.list_tab_columns())
         tabs = self.remote_api.list_tabs()
         return '\n'.join(tabs)
 
     def query_tabs(self, query_info):
+        if self._accepts_columns():
+            return self._columns_response(self.remote_api.query_tab_columns(query_info))
         tabs = self.remote_api.query_tabs(query_info)
         return '\n'.join(tabs)
 
+    @staticmethod
+    def _number_arg(name: str, type_, positive: bool = False):
+        """
+        Query argument converted with `type_`, None if it's not given. A
+        value that is not a finite non-negative (or positive) number is
+        answered with 400, it must not reach the ValueError handler.
+        """
+        value = request.args.get(name)
+        if value is None:
+            return None
+        try:
+            number = type_(value)
+        except ValueError:
+            number = None
+        if number is None or not math.isfinite(number) or number < 0 or (positive and number == 0):
+            abort(400, 'Invalid %s: %s' % (name, value))
+        return number
+
+    @staticmethod
+    def _integer_list_arg(name: str):
+        """Comma-separated ids of tabs or windows, None if not given, 400 if malformed."""
+        value = request.args.get(name)
+        if value is not None and not all(is_valid_integer(item) for item in value.split(',') if item):
+            abort(400, 'Invalid %s: %s' % (name, value))
+        return parse_integer_list(value)
+
+    @staticmethod
+    def _accepts_columns():
+        """A client that accepts it gets tabs in the columnar form, see brotab.tab.tab_columns."""
+        return TAB_COLUMNS_MIMETYPE in request.headers.get('Accept', '')
+
+    @staticmethod
+    def _columns_response(columns):
+        return Response(fast_json_dumps(columns), mimetype=TAB_COLUMNS_MIMETYPE)
+
     def move_tabs(self, move_triplets):
         return self.remote_api.move_tabs(unquote_plus(move_triplets))
 
@@ -113,9 +179,9 @@ class MediatorHttpServer:
         if urls is None:
             return 'ERROR: Please provide urls file in the request'
         urls = urls.stream.read().decode('utf8').splitlines()
-        mediator_logger.info('Open urls (window_id = %s): %s', window_id, urls)
+        mediator_logger.info('Open urls (window_id = %s): %s', window_id, payload(urls))
         result = self.remote_api.open_urls(urls, window_id)
-        mediator_logger.info('Open urls result: %s', str(result))
+        mediator_logger.info('Open urls result: %s', payload(result))
         return '\n'.join(result)
 
     def update_tabs(self):
@@ -123,9 +189,9 @@ class MediatorHttpServer:
         if updates is None:
             return 'ERROR: Please provide updates in the request'
         updates = loads(updates.stream.read().decode('utf8'))
-        mediator_logger.info('Sending tab updates: %s', updates)
+        mediator_logger.info('Sending tab updates: %s', payload(updates))
         result = self.remote_api.update_tabs(updates)
-        mediator_logger.info('Update tabs result: %s', str(result))
+        mediator_logger.info('Update tabs result: %s', payload(result))
         return '\n'.join(result)
 
     def close_tabs(self, tab_ids):
@@ -149,27 +215,69 @@ class MediatorHttpServer:
         tab_id = int(tab_id) if is_valid_integer(tab_id) else None
         match_regex = request.args.get('match_regex', DEFAULT_GET_WORDS_MATCH_REGEX)
         join_with = request.args.get('join_with', DEFAULT_GET_WORDS_JOIN_WITH)
+        # /get_words?tab_ids=1,2,3 gets words of many tabs at once
+        tab_ids = self._integer_list_arg('tab_ids')
         words = self.remote_api.get_words(tab_id,
                                           decode_query(match_regex),
-                                          decode_query(join_with))
-        mediator_logger.info('words for tab_id %s (match_regex %s, join_with %s): %s',
-                             tab_id, match_regex, join_with, words)
+                                          decode_query(join_with),
+                                          *self._script_options(),
+                                          tab_ids=tab_ids)
+        mediator_logger.info('words for tab_id %s, tab_ids %s (match_regex %s, join_with %s): %s',
+                             tab_id, payload(tab_ids), match_regex, join_with, payload(words))
         return '\n'.join(words)
 
     def get_text(self):
         delimiter_regex = request.args.get('delimiter_regex', DEFAULT_GET_TEXT_DELIMITER_REGEX)
         replace_with = request.args.get('replace_with', DEFAULT_GET_TEXT_REPLACE_WITH)
+        stream = bool(request.args.get('stream', False))
         lines = self.remote_api.get_text(decode_query(delimiter_regex),
-                                         decode_query(replace_with))
+                                         decode_query(replace_with),
+                                         self._integer_list_arg('tab_ids'),
+                                         self._integer_list_arg('window_ids'),
+                                         *self._script_options(),
+                                         stream=stream,
+                                         hashes=self._hashes())
+        if stream:
+            return self._stream_lines(lines)
         return '\n'.join(lines)
 
     def get_html(self):
         delimiter_regex = request.args.get('delimiter_regex', DEFAULT_GET_HTML_DELIMITER_REGEX)
         replace_with = request.args.get('replace_with', DEFAULT_GET_HTML_REPLACE_WITH)
+        stream = bool(request.args.get('stream', False))
         lines = self.remote_api.get_html(decode_query(delimiter_regex),
-                                         decode_query(replace_with))
+                                         decode_query(replace_with),
+                                         self._integer_list_arg('tab_ids'),
+                                         self._integer_list_arg('window_ids'),
+                                         *self._script_options(),
+                                         stream=stream,
+                                         hashes=self._hashes())
+        if stream:
+            return self._stream_lines(lines)
         return '\n'.join(lines)
 
+    @staticmethod
+    def _hashes():
+        body = request.get_json(silent=True) if request.method == 'POST' else None
+        if not isinstance(body, dict):
+            return None
+        return body.get('hashes') or None
+
+    @staticmethod
+    def _stream_lines(lines):
+        """
+        Relay lines as soon as the browser sends them. The response has no
+        length, so it's sent chunked.
+        """
+        return Response((line + '\n' for line in lines), mimetype='text/plain')
+
+    def _script_options(self):
+        return (self._number_arg('concurrency', int, positive=True),
+                self._number_arg('timeout', float, positive=True))
+
+    def get_stats(self):
+        return jsonify(self.remote_api.get_stats())
+
     def get_pid(self):
         mediator_logger.info('getting pid')
         return str(os.getpid())
@@ -1,9 +1,60 @@
+"""
+Logs of brotab and of the mediator.
+
+Records are written to the files by a background thread: a logging call
+only puts the formatted record into a queue, so a slow disk doesn't slow
+down requests. The level is INFO unless the LOG_LEVEL environment variable
+says otherwise (DEBUG, INFO, WARNING, ...).
+
+Payloads (urls, text, replies of the browser) are logged with payload():
+at INFO only their type and size are logged. At DEBUG a preview of
+LOG_PREVIEW characters is added, for a large payload only for one in
+LOG_SAMPLE of them.
+"""
+import atexit
 import logging
 import logging.handlers
+import os
+import reprlib
+from itertools import count
+from queue import SimpleQueue
 from traceback import format_stack
 
 from brotab.files import in_temp_dir
 
+DEFAULT_LOG_LEVEL = 'INFO'
+DEFAULT_LOG_PREVIEW = 200
+DEFAULT_LOG_SAMPLE = 100
+
+
+def _positive_int_from_env(name: str, default: int) -> int:
+    try:
+        value = int(os.environ.get(name, default))
+    except ValueError:
+        return default
+    return value if value > 0 else default
+
+
+# characters of a payload that are logged at DEBUG
+LOG_PREVIEW = _positive_int_from_env('LOG_PREVIEW', DEFAULT_LOG_PREVIEW)
+# a payload is large when it has this many characters, bytes or items
+LARGE_PAYLOAD = 4096
+# a preview of one in this many large payloads is logged
+LOG_SAMPLE = _positive_int_from_env('LOG_SAMPLE', DEFAULT_LOG_SAMPLE)
+
+_listeners = []
+
+
+def log_level() -> int:
+    name = os.environ.get('LOG_LEVEL', DEFAULT_LOG_LEVEL).upper()
+    level = logging.getLevelName(name)
+    return level if isinstance(level, int) else logging.INFO
+
+
+def set_log_level_from_env() -> None:
+    """Apply LOG_LEVEL, e.g. after it was loaded from the .env file."""
+    logging.getLogger('brotab').setLevel(log_level())
+
 
 def _init_logger(tag, filename: str):
     FORMAT = '%(asctime)-15s %(process)-5d %(levelname)-8s %(filename)s:%(lineno)d:%(funcName)s %(message)s'
@@ -11,18 +62,94 @@ def _init_logger(tag, filename: str):
     LOG_BACKUP_COUNT = 1
 
     log = logging.getLogger('brotab')
-    log.setLevel(logging.DEBUG)
+    log.setLevel(log_level())
     handler = logging.handlers.RotatingFileHandler(
         filename=filename,
         maxBytes=MAX_LOG_SIZE,
         backupCount=LOG_BACKUP_COUNT,
     )
     handler.setFormatter(logging.Formatter(FORMAT))
-    log.addHandler(handler)
+    queue = SimpleQueue()
+    listener = logging.handlers.QueueListener(queue, handler)
+    listener.start()
+    _listeners.append(listener)
+    log.addHandler(logging.handlers.QueueHandler(queue))
     log.info('Logger has been created (%s)', tag)
     return log
 
 
+def _stop_listeners():
+    # records that are still queued are written before exit
+    for listener in _listeners:
+        listener.stop()
+    _listeners.clear()
+
+
+def _restart_listeners():
+    # the listener threads of the parent don't exist in a forked child, new
+    # listeners take over the queues and handlers
+    for i, listener in enumerate(_listeners):
+        _listeners[i] = logging.handlers.QueueListener(
+            listener.queue, *listener.handlers,
+            respect_handler_level=listener.respect_handler_level)
+        _listeners[i].start()
+
+
+atexit.register(_stop_listeners)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_listeners)
+
+
+class _PayloadRepr(reprlib.Repr):
+    def __init__(self):
+        super().__init__()
+        self.maxstring = self.maxother = LOG_PREVIEW
+        self.maxlist = self.maxtuple = self.maxdict = self.maxset = 10
+        self.maxlevel = 3
+
+
+_payload_repr = _PayloadRepr()
+_large_payloads = count()
+
+
+class Payload:
+    """
+    Argument of a logging call that is formatted as the type and size of
+    `value`, plus its preview if DEBUG is enabled. Nothing is computed
+    unless the record is logged.
+    """
+    __slots__ = ('_value',)
+
+    def __init__(self, value):
+        self._value = value
+
+    def __str__(self):
+        value = self._value
+        try:
+            size = len(value)
+        except TypeError:
+            size = None
+        unit = 'bytes' if isinstance(value, (bytes, bytearray, memoryview)) else \
+            'chars' if isinstance(value, str) else 'items'
+        meta = '<%s>' % type(value).__name__ if size is None else \
+            '<%s, %d %s>' % (type(value).__name__, size, unit)
+        if not logging.getLogger('brotab').isEnabledFor(logging.DEBUG):
+            return meta
+        if size is not None and size >= LARGE_PAYLOAD and next(_large_payloads) % LOG_SAMPLE:
+            return meta
+        if isinstance(value, (str, bytes, bytearray, memoryview)):
+            preview = repr(bytes(value[:LOG_PREVIEW])
+                           if not isinstance(value, str) else value[:LOG_PREVIEW])
+        else:
+            preview = _payload_repr.repr(value)
+        return '%s %s' % (meta, preview)
+
+
+def payload(value) -> Payload:
+    """Wrap `value` for a logging call, see Payload."""
+    return Payload(value)
+
+
 def init_brotab_logger(tag: str):
     return _init_logger(tag, in_temp_dir('brotab.log'))
 
@@ -0,0 +1,120 @@
+"""
+Registry of running mediators.
+
+Every mediator publishes a small JSON file that describes it (host, port,
+pid, browser name and start time) into a directory of its user in the temp
+dir. Clients read these files instead of asking every mediator for its pid
+and browser name, only the ports that no live entry accounts for are
+scanned.
+
+Mediators that crashed can't clean up after themselves, so an entry is only
+trusted while its process is alive and is not younger than the entry itself
+(pids get reused). Stale entries are removed by the reader.
+"""
+import getpass
+import json
+import os
+import time
+from collections import namedtuple
+from typing import List
+
+import psutil
+
+from brotab.files import in_temp_dir
+from brotab.mediator.log import mediator_logger
+
+REGISTRY_DIR_NAME = 'brotab_mediators'
+# process start time and the time the entry was written are measured
+# differently, allow some slack
+CREATE_TIME_SLACK = 1.0
+
+MediatorEntry = namedtuple('MediatorEntry', 'host port pid browser started')
+
+
+def registry_dir() -> str:
+    """
+    The temp dir is shared by all users, each of them has its own registry
+    there, readable only by that user.
+    """
+    user = os.getuid() if hasattr(os, 'getuid') else getpass.getuser()
+    return in_temp_dir('%s-%s' % (REGISTRY_DIR_NAME, user))
+
+
+def _entry_filename(directory: str, port: int) -> str:
+    return os.path.join(directory, '%s.json' % port)
+
+
+def publish(entry: MediatorEntry, directory: str = None) -> None:
+    directory = registry_dir() if directory is None else directory
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    filename = _entry_filename(directory, entry.port)
+    temp_filename = '%s.%s.tmp' % (filename, entry.pid)
+    with open(temp_filename, 'w', encoding='utf-8') as file_:
+        json.dump(entry._asdict(), file_)
+    # readers never see a half-written entry
+    os.replace(temp_filename, filename)
+    mediator_logger.info('Published mediator entry %s into %s', entry, filename)
+
+
+def unpublish(port: int, pid: int, directory: str = None) -> None:
+    """Remove the entry for the port unless another mediator has taken it."""
+    directory = registry_dir() if directory is None else directory
+    filename = _entry_filename(directory, port)
+    entry = _load_entry(filename)
+    if entry is not None and entry.pid == pid:
+        _remove(filename)
+
+
+def is_alive(entry: MediatorEntry) -> bool:
+    try:
+        create_time = psutil.Process(entry.pid).create_time()
+    except (psutil.NoSuchProcess, psutil.AccessDenied, ValueError):
+        return False
+    return create_time <= entry.started + CREATE_TIME_SLACK
+
+
+def read_entries(directory: str = None) -> List[MediatorEntry]:
+    """Return entries of live mediators sorted by port, prune the rest."""
+    directory = registry_dir() if directory is None else directory
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+
+    entries = []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        filename = os.path.join(directory, name)
+        entry = _load_entry(filename)
+        if entry is not None and is_alive(entry):
+            entries.append(entry)
+        else:
+            mediator_logger.info('Removing stale mediator entry %s: %s', filename, entry)
+            _remove(filename)
+    return sorted(entries, key=lambda e: e.port)
+
+
+def make_entry(host: str, port: int, browser: str) -> MediatorEntry:
+    return MediatorEntry(host=host, port=port, pid=os.getpid(),
+                         browser=browser, started=time.time())
+
+
+def _load_entry(filename: str):
+    try:
+        with open(filename, encoding='utf-8') as file_:
+            return MediatorEntry(**json.load(file_))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError) as e:
+        mediator_logger.info('Cannot read mediator entry %s: %s', filename, e)
+        return None
+
+
+def _remove(filename: str) -> None:
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        mediator_logger.info('Cannot remove mediator entry %s: %s', filename, e)
@@ -1,8 +1,20 @@
+import math
+import time
+from typing import Dict
 from typing import List
 from urllib.parse import quote_plus
 
+from brotab.mediator.const import DEFAULT_SCRIPT_CONCURRENCY
+from brotab.mediator.const import DEFAULT_SCRIPT_TIMEOUT
+from brotab.mediator.const import DEFAULT_TRANSPORT_TIMEOUT
+from brotab.mediator.const import MAX_SCRIPT_TABS
 from brotab.mediator.log import mediator_logger
+from brotab.mediator.log import payload
+from brotab.mediator.stats import ScriptStats
+from brotab.mediator.tab_model import TabModel
+from brotab.mediator.transport import Multiplexer
 from brotab.mediator.transport import Transport
+from brotab.tab import tab_columns
 
 
 class BrowserRemoteAPI:
@@ -13,31 +25,130 @@ class BrowserRemoteAPI:
 
     def __init__(self, transport: Transport):
         self._transport: Transport = transport
+        # kept up to date by the events the extension pushes
+        self.tab_model = TabModel()
+        self.script_stats = ScriptStats()
+        # HTTP requests are served in parallel threads, replies are matched
+        # to the requests by id
+        self._multiplexer = Multiplexer(transport, on_event=self._on_event)
+
+    def _on_event(self, message: dict) -> None:
+        if message['event'] == 'script_stats':
+            self.script_stats.record(message['stats'])
+        else:
+            self.tab_model.apply_event(message)
+
+    def _send(self, command: dict) -> None:
+        self._multiplexer.notify(command)
+
+    def _call(self, command: dict, timeout: float = DEFAULT_TRANSPORT_TIMEOUT):
+        """
+        Send the command and return its reply, raise ReplyTimeoutError if
+        it doesn't come in `timeout` seconds.
+        """
+        start = time.monotonic()
+        result = self._multiplexer.call(command, timeout)
+        mediator_logger.info('%s took %.1f ms: %s', command['name'],
+                             1000 * (time.monotonic() - start), payload(result))
+        return result
+
+    def _call_script(self, command: dict, stream: bool = False):
+        if not stream:
+            return self._call(command, self._script_timeout(command))
+        command['stream'] = True
+        # a chunk arrives whenever a tab is done, and that doesn't take
+        # longer than the time a script is given in a tab
+        per_tab = command.get('timeout') or DEFAULT_SCRIPT_TIMEOUT
+        return self._multiplexer.stream(command, DEFAULT_TRANSPORT_TIMEOUT + per_tab)
+
+    def _script_timeout(self, command: dict) -> float:
+        """
+        Longest wait for the reply to a script command: the script runs in
+        at most `concurrency` tabs at a time and up to `timeout` seconds in
+        each of them.
+        """
+        if 'tab_ids' in command:
+            tabs = len(command['tab_ids'])
+        elif command['name'] == 'get_words':
+            # the given or the active tab
+            tabs = 1
+        else:
+            count = self.tab_model.tab_count()
+            tabs = MAX_SCRIPT_TABS if count is None else count
+        concurrency = command.get('concurrency') or DEFAULT_SCRIPT_CONCURRENCY
+        per_tab = command.get('timeout') or DEFAULT_SCRIPT_TIMEOUT
+        return DEFAULT_TRANSPORT_TIMEOUT + math.ceil(tabs / concurrency) * per_tab
+
+    @staticmethod
+    def _add_script_options(command: dict, concurrency: int, timeout: float) -> dict:
+        """
+        Scripts run in at most `concurrency` tabs at a time, a tab that
+        doesn't answer in `timeout` seconds is skipped. The extension has
+        its own defaults for the options that are not given.
+        """
+        if concurrency is not None:
+            command['concurrency'] = concurrency
+        if timeout is not None:
+            command['timeout'] = timeout
+        return command
 
     def list_tabs(self):
+        tabs = self.tab_model.list_tabs()
+        if tabs is not None:
+            return tabs
         command = {'name': 'list_tabs'}
-        self._transport.send(command)
-        return self._transport.recv()
+        return self._call(command)
+
+    def list_tabs_delta(self, since: int, wait: float = None) -> dict:
+        """
+        Return tabs changed since the version, see TabModel.delta. Without a
+        synced model all tabs are returned with version 0. With `wait` the
+        call blocks up to that many seconds until something changes.
+        """
+        if wait:
+            self.tab_model.wait_for_change(since, wait)
+        delta = self.tab_model.delta(since)
+        if delta is not None:
+            return delta
+        changed = []
+        window_sizes = {}
+        for line in self.list_tabs():
+            window_id = line.split('.', 1)[0]
+            index = window_sizes.get(window_id, 0)
+            window_sizes[window_id] = index + 1
+            changed.append({'line': line, 'index': index, 'status': None})
+        return {'version': 0, 'full': True, 'changed': changed, 'removed': []}
 
     def query_tabs(self, query_info: str):
         mediator_logger.info('query info: %s', query_info)
+        tabs = self.tab_model.query_tabs(query_info)
+        if tabs is not None:
+            return tabs
         command = {'name': 'query_tabs', 'query_info': query_info}
-        self._transport.send(command)
-        return self._transport.recv()
+        return self._call(command)
+
+    def list_tab_columns(self) -> dict:
+        """list_tabs in the columnar form, see brotab.tab.tab_columns."""
+        columns = self.tab_model.list_tab_columns()
+        return tab_columns(self.list_tabs()) if columns is None else columns
+
+    def query_tab_columns(self, query_info: str) -> dict:
+        """query_tabs in the columnar form, see brotab.tab.tab_columns."""
+        columns = self.tab_model.query_tab_columns(query_info)
+        return tab_columns(self.query_tabs(query_info)) if columns is None else columns
 
     def move_tabs(self, move_triplets: str):
         """
         :param move_triplets: Comma-separated list of:
             <tabID> <windowID> <newIndex>
         """
-        mediator_logger.info('move_tabs, move_triplets: %s', move_triplets)
+        mediator_logger.info('move_tabs, move_triplets: %s', payload(move_triplets))
 
         triplets = [list(map(int, triplet.split(' ')))
                     for triplet in move_triplets.split(',')]
-        mediator_logger.info('moving tab ids: %s', triplets)
+        mediator_logger.info('moving tab ids: %s', payload(triplets))
         command = {'name': 'move_tabs', 'move_triplets': triplets}
-        self._transport.send(command)
-        return self._transport.recv()
+        return self._call(command)
 
     def open_urls(self, urls: List[str], window_id=None):
         """
@@ -45,13 +156,12 @@ class BrowserRemoteAPI:
 
         If window_id is None, currently active window is used.
         """
-        mediator_logger.info('open urls: %s', urls)
+        mediator_logger.info('open urls: %s', payload(urls))
 
         command = {'name': 'open_urls', 'urls': urls}
         if window_id is not None:
             command['window_id'] = window_id
-        self._transport.send(command)
-        return self._transport.recv()
+        return self._call(command)
 
     def update_tabs(self, updates: [object]):
         """
@@ -64,83 +174,151 @@ class BrowserRemoteAPI:
         } ]
         see https://developer.mozilla.org/en-US/docs/Mozilla/Add-ons/WebExtensions/API/tabs/update
         """
-        mediator_logger.info('update tabs: %s', updates)
+        mediator_logger.info('update tabs: %s', payload(updates))
         command = {'name': 'update_tabs', 'updates': updates}
-        self._transport.send(command)
-        return self._transport.recv()
+        return self._call(command)
 
     def close_tabs(self, tab_ids: str):
         """
         :param tab_ids: Comma-separated list of tab IDs to close.
         """
         int_tab_ids = [int(id_) for id_ in tab_ids.split(',')]
-        mediator_logger.info('closing tab ids: %s', int_tab_ids)
+        mediator_logger.info('closing tab ids: %s', payload(int_tab_ids))
         command = {'name': 'close_tabs', 'tab_ids': int_tab_ids}
-        self._transport.send(command)
-        return self._transport.recv()
+        return self._call(command)
 
     def new_tab(self, query: str):
         url = "https://www.google.com/search?q=%s" % quote_plus(query)
         mediator_logger.info('opening url: %s', url)
         command = {'name': 'new_tab', 'url': url}
-        self._transport.send(command)
-        return self._transport.recv()
+        return self._call(command)
 
     def activate_tab(self, tab_id: int, focused: bool):
         mediator_logger.info('activating tab id: %s', tab_id)
         command = {'name': 'activate_tab', 'tab_id': tab_id, 'focused': focused}
-        self._transport.send(command)
+        self._send(command)
 
     def get_active_tabs(self) -> str:
         mediator_logger.info('getting active tabs')
         command = {'name': 'get_active_tabs'}
-        self._transport.send(command)
-        return self._transport.recv()
+        return self._call(command)
 
     def get_screenshot(self) -> str:
         mediator_logger.info('getting screemsjpt')
         command = {'name': 'get_screenshot'}
-        self._transport.send(command)
-        return self._transport.recv()
+        return self._call(command)
 
-    def get_words(self, tab_id: str, match_regex: str, join_with: str):
-        mediator_logger.info('getting tab words: %s', tab_id)
+    def get_words(self, tab_id: str, match_regex: str, join_with: str,
+                  concurrency: int = None, timeout: float = None,
+                  tab_ids: List[int] = None):
+        """
+        Words of the tab, of the active tab if it's None. With `tab_ids`
+        words of all these tabs are returned, without duplicates.
+        """
+        mediator_logger.info('getting tab words: %s, tab_ids=%s', tab_id, payload(tab_ids))
+        if tab_ids is not None and not self._multiplexer.replies_have_ids:
+            return self._get_words_per_tab(tab_ids, match_regex, concurrency, timeout)
         command = {
             'name': 'get_words',
             'tab_id': tab_id,
             'match_regex': match_regex,
             'join_with': join_with,
         }
-        self._transport.send(command)
-        return self._transport.recv()
+        if tab_ids is not None:
+            command['tab_ids'] = tab_ids
+        return self._call_script(self._add_script_options(command, concurrency, timeout))
+
+    def _get_words_per_tab(self, tab_ids: List[int], match_regex: str,
+                           concurrency: int, timeout: float) -> List[str]:
+        """
+        Extensions that reply without ids don't know `tab_ids` either and
+        would return words of the active tab, so every tab is asked on its
+        own. Words come one per line like in a batch reply.
+        """
+        words = set()
+        for tab_id in tab_ids:
+            command = {
+                'name': 'get_words',
+                'tab_id': tab_id,
+                'match_regex': match_regex,
+                'join_with': '"\\n"',
+            }
+            for item in self._call_script(self._add_script_options(command, concurrency, timeout)):
+                words.update(word for word in item.split('\n') if word)
+        return sorted(words)
+
+    def get_text(self, delimiter_regex: str, replace_with: str,
+                 tab_ids: List[int] = None, window_ids: List[int] = None,
+                 concurrency: int = None, timeout: float = None, stream: bool = False,
+                 hashes: Dict[str, str] = None):
+        """
+        Only tabs listed in tab_ids or belonging to windows in window_ids
+        are processed if any of them is given, all tabs otherwise.
 
-    def get_text(self, delimiter_regex: str, replace_with: str):
-        mediator_logger.info('getting text, delimiter_regex=%s, replace_with=%s',
-                             delimiter_regex, replace_with)
+        With `stream` an iterator is returned that yields lines as the
+        browser sends them, instead of a list of all of them.
+
+        `hashes` maps tab ids to hashes of the text the client has, the
+        text of these tabs is replaced with UNCHANGED_MARKER if it's the same.
+        """
+        mediator_logger.info('getting text, delimiter_regex=%s, replace_with=%s, tab_ids=%s, window_ids=%s',
+                             delimiter_regex, replace_with, payload(tab_ids), payload(window_ids))
         command = {
             'name': 'get_text',
             'delimiter_regex': delimiter_regex,
             'replace_with': replace_with,
         }
-        self._transport.send(command)
-        return self._transport.recv()
+        if tab_ids is not None:
+            command['tab_ids'] = tab_ids
+        if window_ids is not None:
+            command['window_ids'] = window_ids
+        if hashes:
+            command['hashes'] = hashes
+        return self._call_script(self._add_script_options(command, concurrency, timeout), stream)
+
+    def get_html(self, delimiter_regex: str, replace_with: str,
+                 tab_ids: List[int] = None, window_ids: List[int] = None,
+                 concurrency: int = None, timeout: float = None, stream: bool = False,
+                 hashes: Dict[str, str] = None):
+        """
+        Only tabs listed in tab_ids or belonging to windows in window_ids
+        are processed if any of them is given, all tabs otherwise.
 
-    def get_html(self, delimiter_regex: str, replace_with: str):
-        mediator_logger.info('getting html, delimiter_regex=%s, replace_with=%s',
-                             delimiter_regex, replace_with)
+        With `stream` an iterator is returned that yields lines as the
+        browser sends them, instead of a list of all of them.
+
+        `hashes` maps tab ids to hashes of the text the client has, the
+        text of these tabs is replaced with UNCHANGED_MARKER if it's the same.
+        """
+        mediator_logger.info('getting html, delimiter_regex=%s, replace_with=%s, tab_ids=%s, window_ids=%s',
+                             delimiter_regex, replace_with, payload(tab_ids), payload(window_ids))
         command = {
             'name': 'get_html',
             'delimiter_regex': delimiter_regex,
             'replace_with': replace_with,
         }
-        self._transport.send(command)
-        return self._transport.recv()
+        if tab_ids is not None:
+            command['tab_ids'] = tab_ids
+        if window_ids is not None:
+            command['window_ids'] = window_ids
+        if hashes:
+            command['hashes'] = hashes
+        return self._call_script(self._add_script_options(command, concurrency, timeout), stream)
+
+    def request_tab_snapshot(self) -> None:
+        """Ask the extension to push all tabs to the tab model."""
+        mediator_logger.info('requesting tab snapshot')
+        command = {'name': 'push_tab_snapshot'}
+        self._send(command)
+
+    def get_stats(self) -> dict:
+        return {'scripts': self.script_stats.as_dict(),
+                'script_cache': self.script_stats.cache_as_dict()}
 
     def get_browser(self):
         mediator_logger.info('getting browser name')
         command = {'name': 'get_browser'}
-        self._transport.send(command)
-        return self._transport.recv()
+        return self._call(command)
 
 
 def default_remote_api(transport: Transport) -> BrowserRemoteAPI:
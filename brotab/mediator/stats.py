@@ -0,0 +1,45 @@
+"""
+Statistics of the scripts the extension runs in tabs (get_text, get_html,
+get_words). The extension sends them as a "script_stats" event after every
+run, the mediator keeps totals and the last run of every command and serves
+them on /get_stats, together with the latest counters of the extension's
+cache of script results.
+"""
+from threading import Lock
+
+# timings of this many slowest tabs of the last run are kept
+MAX_SLOWEST_TABS = 10
+
+
+class ScriptStats:
+    def __init__(self):
+        self._lock = Lock()
+        self._totals = {}
+        self._last = {}
+        self._cache = None
+
+    def record(self, stats: dict) -> None:
+        command = stats.get('command', 'unknown')
+        timings = stats.get('timings', [])
+        slowest = sorted(timings, key=lambda timing: timing[1], reverse=True)[:MAX_SLOWEST_TABS]
+        with self._lock:
+            totals = self._totals.setdefault(command, {
+                'runs': 0, 'tabs': 0, 'failed': 0, 'timed_out': 0, 'cached': 0, 'elapsed': 0})
+            totals['runs'] += 1
+            for key in ('tabs', 'failed', 'timed_out', 'cached', 'elapsed'):
+                totals[key] += stats.get(key, 0)
+            if 'cache' in stats:
+                self._cache = stats['cache']
+            last = {key: value for key, value in stats.items() if key not in ('timings', 'cache')}
+            last['slowest'] = slowest
+            self._last[command] = last
+
+    def cache_as_dict(self) -> dict:
+        """Hits, misses, evictions, entries, size and max_size, None if unknown."""
+        with self._lock:
+            return None if self._cache is None else dict(self._cache)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {command: {'totals': dict(totals), 'last': dict(self._last[command])}
+                    for command, totals in self._totals.items()}
@@ -2,4 +2,11 @@ def is_valid_integer(str_value):
     try:
         return int(str_value) >= 0
     except (ValueError, TypeError):
-        return False
\ No newline at end of file
+        return False
+
+
+def parse_integer_list(str_value):
+    """Parse comma-separated integers, None stays None."""
+    if str_value is None:
+        return None
+    return [int(item) for item in str_value.split(',') if item]
@@ -0,0 +1,266 @@
+"""
+In-memory model of the tabs of the browser the mediator is attached to.
+
+The extension pushes tab events (created, updated, moved, attached, removed)
+to the mediator as they happen and, on request, a full snapshot of all tabs.
+The model keeps tabs ordered by their index within every window, so
+list_tabs and most of query_tabs can be answered without a round trip to
+the browser.
+
+Until the first snapshot arrives the model is not synced and callers must
+ask the browser instead. Events can be lost (e.g. while the extension is
+reloading), so the mediator requests a snapshot periodically.
+
+Every change increments the version of the model. A tab remembers the
+version it last changed at (a change of its index counts, so tabs shifted
+by an insert are reported too) and removed tabs leave a tombstone, so
+clients that mirror the tab list can ask only for what changed since the
+version they have, and can wait for the next change instead of polling.
+"""
+import json
+from collections import OrderedDict
+from threading import Condition
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from brotab.mediator.log import mediator_logger
+from brotab.utils import decode_query
+
+INTEGER_QUERY_KEYS = ('windowId', 'index')
+BOOLEAN_QUERY_KEYS = ('active', 'pinned', 'audible', 'muted', 'discarded')
+# when there are more tombstones than this, the oldest are forgotten and
+# clients asking for changes since before them get the full list
+MAX_TOMBSTONES = 10000
+
+
+class TabModel:
+    def __init__(self, max_tombstones: int = MAX_TOMBSTONES):
+        self._lock = Condition()
+        self._tabs: Dict[int, dict] = {}
+        # window id -> tab ids in the order of their index
+        self._windows: Dict[int, List[int]] = {}
+        self._synced = False
+        self._version = 0
+        # changes since versions before this one are incomplete
+        self._min_version = 0
+        # tab id -> version of its last change
+        self._versions: Dict[int, int] = {}
+        # tab id -> (version of removal, window id), oldest first
+        self._removed: OrderedDict = OrderedDict()
+        self._max_tombstones = max_tombstones
+
+    @property
+    def synced(self) -> bool:
+        return self._synced
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def apply_event(self, message: dict) -> None:
+        event = message.get('event')
+        with self._lock:
+            self._version += 1
+            if event == 'tab_snapshot':
+                self._reset(message['tabs'])
+            elif event == 'tab_updated':
+                self._upsert(message['tab'])
+            elif event == 'tab_removed':
+                self._remove(message['tab_id'])
+            else:
+                mediator_logger.error('Unknown tab event: %.200s', message)
+            self._lock.notify_all()
+
+    def wait_for_change(self, since: int, timeout: float) -> bool:
+        """
+        Block until the model is synced and its version is not `since`, or
+        the timeout expires. Return True if it changed.
+        """
+        with self._lock:
+            return self._lock.wait_for(
+                lambda: self._synced and self._version != since, timeout)
+
+    def tab_count(self) -> Optional[int]:
+        """Number of tabs, None if not synced."""
+        if not self._synced:
+            return None
+        with self._lock:
+            return len(self._tabs)
+
+    def list_tabs(self) -> Optional[List[str]]:
+        """Return tab lines like the extension does, None if not synced."""
+        tabs = self._select({})
+        return None if tabs is None else [self._line(tab) for tab in tabs]
+
+    def query_tabs(self, query_info: str) -> Optional[List[str]]:
+        """
+        Return lines of the tabs matching the query, None if not synced or
+        the query uses keys the model doesn't track (these have to be
+        answered by the browser).
+        """
+        tabs = self._select(parse_query(query_info))
+        return None if tabs is None else [self._line(tab) for tab in tabs]
+
+    def list_tab_columns(self) -> Optional[dict]:
+        """list_tabs in the columnar form of brotab.tab.tab_columns."""
+        tabs = self._select({})
+        return None if tabs is None else self._columns(tabs)
+
+    def query_tab_columns(self, query_info: str) -> Optional[dict]:
+        """query_tabs in the columnar form of brotab.tab.tab_columns."""
+        tabs = self._select(parse_query(query_info))
+        return None if tabs is None else self._columns(tabs)
+
+    def _select(self, query: Optional[dict]) -> Optional[List[dict]]:
+        if not self._synced or query is None:
+            return None
+        with self._lock:
+            return [tab for tab in self._iter_tabs()
+                    if all(tab.get(key) == value for key, value in query.items())]
+
+    def delta(self, since: int) -> Optional[dict]:
+        """
+        Return tabs that changed and ids of tabs that were removed after
+        version `since`, None if not synced. If the changes since that
+        version are not known (the version is too old, or it is from
+        before the mediator was restarted), all tabs are returned and
+        "full" is set: the client must replace its list.
+        """
+        if not self._synced:
+            return None
+        with self._lock:
+            full = since <= 0 or since > self._version or since < self._min_version
+            changed = [{'line': self._line(tab), 'index': tab['index'],
+                        'status': tab.get('status')}
+                       for tab in self._iter_tabs()
+                       if full or self._versions[tab['id']] > since]
+            removed = [] if full else [
+                '%s.%s' % (window_id, tab_id)
+                for tab_id, (version, window_id) in self._removed.items()
+                if version > since]
+            return {'version': self._version, 'full': full,
+                    'changed': changed, 'removed': removed}
+
+    def _reset(self, tabs: List[dict]) -> None:
+        old_tabs = self._tabs
+        self._tabs = {}
+        self._windows = {}
+        for tab in sorted(tabs, key=lambda t: (t['windowId'], t['index'])):
+            window = self._windows.setdefault(tab['windowId'], [])
+            tab['index'] = len(window)
+            window.append(tab['id'])
+            self._tabs[tab['id']] = tab
+            if old_tabs.get(tab['id']) != tab:
+                self._touch(tab['id'])
+        for tab_id, tab in old_tabs.items():
+            if tab_id not in self._tabs:
+                self._bury(tab)
+        self._synced = True
+        mediator_logger.info('Tab model synced: %s tabs in %s windows, version %s',
+                             len(self._tabs), len(self._windows), self._version)
+
+    def _upsert(self, tab: dict) -> None:
+        old = self._tabs.get(tab['id'])
+        self._detach(tab['id'])
+        window = self._windows.setdefault(tab['windowId'], [])
+        index = min(tab['index'], len(window))
+        window.insert(index, tab['id'])
+        tab['index'] = index
+        if old != tab:
+            self._touch(tab['id'])
+        self._tabs[tab['id']] = tab
+        if tab.get('active'):
+            # activating a tab deactivates the others, no event is sent for them
+            for tab_id in window:
+                other = self._tabs[tab_id]
+                if tab_id != tab['id'] and other['active']:
+                    other['active'] = False
+                    self._touch(tab_id)
+        self._reindex(tab['windowId'])
+        if old is not None and old['windowId'] != tab['windowId']:
+            self._reindex(old['windowId'])
+
+    def _remove(self, tab_id: int) -> None:
+        tab = self._tabs.get(tab_id)
+        if tab is None:
+            return
+        self._detach(tab_id)
+        del self._tabs[tab_id]
+        self._bury(tab)
+        self._reindex(tab['windowId'])
+
+    def _detach(self, tab_id: int) -> None:
+        tab = self._tabs.get(tab_id)
+        if tab is None:
+            return
+        window = self._windows.get(tab['windowId'], [])
+        if tab_id in window:
+            window.remove(tab_id)
+        if not window:
+            self._windows.pop(tab['windowId'], None)
+
+    def _reindex(self, window_id: int) -> None:
+        """Update indices of the tabs of the window after an insert or removal."""
+        for index, tab_id in enumerate(self._windows.get(window_id, [])):
+            tab = self._tabs[tab_id]
+            if tab['index'] != index:
+                tab['index'] = index
+                self._touch(tab_id)
+
+    def _touch(self, tab_id: int) -> None:
+        self._versions[tab_id] = self._version
+        self._removed.pop(tab_id, None)
+
+    def _bury(self, tab: dict) -> None:
+        self._versions.pop(tab['id'], None)
+        self._removed[tab['id']] = (self._version, tab['windowId'])
+        while len(self._removed) > self._max_tombstones:
+            _tab_id, (version, _window_id) = self._removed.popitem(last=False)
+            self._min_version = version
+
+    def _iter_tabs(self):
+        for window_id in sorted(self._windows):
+            for tab_id in self._windows[window_id]:
+                yield self._tabs[tab_id]
+
+    @staticmethod
+    def _line(tab: dict) -> str:
+        return '%s.%s\t%s\t%s' % (tab['windowId'], tab['id'], tab['title'], tab['url'])
+
+    @staticmethod
+    def _columns(tabs: List[dict]) -> dict:
+        return {'window_ids': [tab['windowId'] for tab in tabs],
+                'tab_ids': [tab['id'] for tab in tabs],
+                'titles': [tab['title'] for tab in tabs],
+                'urls': [tab['url'] for tab in tabs]}
+
+
+def parse_query(query_info: str) -> Optional[dict]:
+    """
+    Decode query_tabs argument and convert values the same way the
+    extension does. Return None if a key is not supported by the model.
+    """
+    try:
+        query = json.loads(decode_query(query_info))
+    except ValueError:
+        return None
+    if not isinstance(query, dict):
+        return None
+
+    result = {}
+    for key, value in query.items():
+        if key in INTEGER_QUERY_KEYS:
+            try:
+                result[key] = int(value)
+            except (TypeError, ValueError):
+                return None
+        elif key in BOOLEAN_QUERY_KEYS:
+            if isinstance(value, str) and value.lower() in ('true', 'false'):
+                value = value.lower() == 'true'
+            if not isinstance(value, bool):
+                return None
+            result[key] = value
+        else:
+            return None
+    return result
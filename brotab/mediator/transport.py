@@ -1,13 +1,41 @@
 import json
+import os
 import struct
 import sys
+import time
 from abc import ABC
 from abc import abstractmethod
+from collections import OrderedDict
+from itertools import count
+from queue import Empty
+from queue import Queue
+from threading import Event
+from threading import Lock
+from threading import Semaphore
+from threading import Thread
 from typing import BinaryIO
+from typing import Callable
+from typing import Iterator
+from typing import Optional
 from typing import Union
 
 from brotab.inout import TimeoutIO
 from brotab.mediator.log import mediator_logger
+from brotab.mediator.log import payload
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# size of the read buffer of StdTransport, it grows to fit larger messages
+INITIAL_BUFFER = 64 * 1024
+# a buffer that grew larger than this is not kept for the next message
+MAX_RETAINED_BUFFER = 16 * 1024 * 1024
+# a message whose fragments haven't all arrived in this many seconds is
+# dropped, as is the least recently active one beyond this many
+FRAGMENT_TIMEOUT = 60.0
+MAX_INCOMPLETE_MESSAGES = 16
 
 
 class Transport(ABC):
@@ -37,38 +65,462 @@ class TransportError(Exception):
     pass
 
 
+class ReplyTimeoutError(TimeoutError):
+    """The browser didn't reply to a command in time."""
+
+
+class FragmentError(TransportError):
+    """
+    A message split into fragments can't be joined, it's dropped. `id` is
+    the id of the command it replies to, None if it's not known.
+    """
+
+    def __init__(self, message: str, id_: int = None):
+        super().__init__(message)
+        self.id = id_
+
+
 class StdTransport(Transport):
-    def __init__(self, input_file: BinaryIO, output_file: BinaryIO):
+    """
+    Native messaging framing: every message is a 4-byte length in native
+    byte order followed by that many bytes of UTF-8 JSON.
+
+    Messages are read into a buffer that is reused and only grows for a
+    larger message (a buffer grown beyond MAX_RETAINED_BUFFER is dropped
+    after the message), JSON is decoded straight from it. A frame is sent
+    with one vectored write when the output is a file descriptor. orjson is
+    used when it's installed, unless `fast_json` is False.
+
+    A message the extension had to split into fragments is joined back,
+    recv() returns it whole, see Fragments.
+    """
+
+    def __init__(self, input_file: BinaryIO, output_file: BinaryIO, fast_json: bool = None):
         self._in = input_file
         self._out = output_file
+        self._buffer = bytearray(INITIAL_BUFFER)
+        self._fragments = Fragments()
+        fast_json = orjson is not None if fast_json is None else fast_json
+        if fast_json and orjson is None:
+            raise ValueError('fast_json needs orjson to be installed')
+        self._dumps = _orjson_dumps if fast_json else _json_dumps
+        self._loads = orjson.loads if fast_json else _json_loads
 
     def reset(self):
         self._in.seek(0)
         self._out.seek(0)
 
     def send(self, command: dict) -> None:
-        encoded = self._encode(command)
-        mediator_logger.info('StdTransport SENDING: %s', command)
-        self._out.write(encoded['length'])
-        self._out.write(encoded['content'])
-        self._out.flush()
-        mediator_logger.info('StdTransport SENDING DONE: %s', command)
+        start = time.monotonic()
+        data = self._dumps(command)
+        self._write_frame(struct.pack('@I', len(data)), data)
+        mediator_logger.info('StdTransport SENT %d bytes in %.1f ms: %s',
+                             len(data), 1000 * (time.monotonic() - start), payload(command))
 
     def recv(self) -> dict:
-        mediator_logger.info('StdTransport RECEIVING')
-        raw_length = self._in.read(4)
-        if len(raw_length) == 0:
+        while True:
+            message = self._recv_frame()
+            if not (isinstance(message, dict) and 'fragment' in message):
+                return message
+            text = self._fragments.add(message)
+            if text is None:
+                continue
+            try:
+                return self._loads(text)
+            except ValueError as e:
+                raise FragmentError('Message %s is not valid JSON: %s'
+                                    % (message['fragment'], e), message.get('id'))
+
+    def _recv_frame(self):
+        header = self._read_exact(4)
+        if header is None:
             raise TransportError('StdTransport: cannot read, raw_length is empty')
-        message_length = struct.unpack('@I', raw_length)[0]
-        message = self._in.read(message_length).decode('utf8')
-        mediator_logger.info('StdTransport RECEIVED: %s', message.encode('utf8'))
-        return json.loads(message)
+        message_length = struct.unpack('@I', header)[0]
+        start = time.monotonic()
+        view = self._read_exact(message_length)
+        if view is None:
+            raise TransportError('StdTransport: end of input, expected %d bytes' % message_length)
+        try:
+            message = self._loads(view)
+        finally:
+            view.release()
+            if len(self._buffer) > MAX_RETAINED_BUFFER:
+                self._buffer = bytearray(INITIAL_BUFFER)
+        mediator_logger.info('StdTransport RECEIVED %d bytes in %.1f ms: %s',
+                             message_length, 1000 * (time.monotonic() - start), payload(message))
+        return message
+
+    def _read_exact(self, size: int) -> Optional[memoryview]:
+        """
+        Read exactly `size` bytes into the buffer and return a view of them.
+        Return None at the end of input before the first byte, raise
+        TransportError if the input ends in the middle.
+        """
+        if len(self._buffer) < size:
+            self._buffer = bytearray(max(size, 2 * len(self._buffer)))
+        view = memoryview(self._buffer)[:size]
+        readinto = getattr(self._in, 'readinto', None)
+        done = 0
+        while done < size:
+            if readinto is not None:
+                read = readinto(view[done:])
+            else:
+                chunk = self._in.read(size - done)
+                read = len(chunk)
+                view[done:done + read] = chunk
+            if not read:
+                view.release()
+                if done == 0:
+                    return None
+                raise TransportError('StdTransport: end of input after %d of %d bytes'
+                                     % (done, size))
+            done += read
+        return view
 
-    def _encode(self, message):
-        encoded_content = json.dumps(message).encode('utf8')
-        encoded_length = struct.pack('@I', len(encoded_content))
-        return {'length': encoded_length, 'content': encoded_content}
+    def _write_frame(self, header: bytes, payload: bytes) -> None:
+        fd = _fileno(self._out)
+        if fd is None or not hasattr(os, 'writev'):
+            self._out.write(header + payload)
+            self._out.flush()
+            return
+        # whatever is buffered goes out first
+        self._out.flush()
+        written = os.writev(fd, [header, payload])
+        total = len(header) + len(payload)
+        if written < total:
+            rest = memoryview(header + payload)[written:]
+            while rest:
+                rest = rest[os.write(fd, rest):]
 
     def close(self):
         self._in.close()
         self._out.close()
+
+
+class Fragments:
+    """
+    Messages larger than the browser lets the extension send are split into
+    fragments of their JSON text:
+
+        {"fragment": <message id>, "seq": <0, 1, ...>,
+         "length": <length of the text>, "data": <part of the text>}
+
+    The length is in UTF-16 code units, like lengths of JavaScript strings.
+    Fragments of a reply also carry the "id" of the command.
+
+    A message that can't be joined is dropped with FragmentError, the other
+    messages are not affected. Messages that stay incomplete are dropped
+    after `timeout` seconds, or when more than `max_incomplete` of them
+    are waiting for their fragments (the one that got a fragment least
+    recently goes first).
+    """
+
+    def __init__(self, timeout: float = FRAGMENT_TIMEOUT,
+                 max_incomplete: int = MAX_INCOMPLETE_MESSAGES):
+        self._timeout = timeout
+        self._max_incomplete = max_incomplete
+        # message id -> (parts, characters received, time of the first part)
+        self._pending: OrderedDict = OrderedDict()
+
+    def add(self, fragment: dict) -> Optional[str]:
+        """Return the JSON text of the message when its last fragment is added."""
+        id_, data, length = fragment['fragment'], fragment['data'], fragment['length']
+        seq, reply_id = fragment['seq'], fragment.get('id')
+        now = time.monotonic()
+        self._evict(now)
+        if seq == 0 and id_ in self._pending:
+            # ids start over when the extension is reloaded
+            self._drop(id_, 'a new message has the same id')
+        parts, received, started = self._pending.pop(id_, ([], 0, now))
+        if seq != len(parts):
+            raise FragmentError('Fragment %s of message %s is out of order, expected %s'
+                                % (seq, id_, len(parts)), reply_id)
+        parts.append(data)
+        received += _utf16_length(data)
+        if received < length:
+            self._pending[id_] = (parts, received, started)
+            while len(self._pending) > self._max_incomplete:
+                self._drop(next(iter(self._pending)), 'too many incomplete messages')
+            return None
+        if received > length:
+            raise FragmentError('Message %s has %d characters, expected %d'
+                                % (id_, received, length), reply_id)
+        return ''.join(parts)
+
+    def _evict(self, now: float) -> None:
+        for id_, (_parts, _received, started) in list(self._pending.items()):
+            if now - started > self._timeout:
+                self._drop(id_, 'incomplete for %.0f seconds' % (now - started))
+
+    def _drop(self, id_, reason: str) -> None:
+        parts, received, _started = self._pending.pop(id_)
+        mediator_logger.error('Dropping message %s after %d fragments, %d characters: %s',
+                              id_, len(parts), received, reason)
+
+
+def _utf16_length(text: str) -> int:
+    if text.isascii():
+        return len(text)
+    return len(text.encode('utf-16-le', 'surrogatepass')) // 2
+
+
+def _fileno(file_) -> Optional[int]:
+    try:
+        return file_.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _json_dumps(message) -> bytes:
+    return json.dumps(message).encode('utf8')
+
+
+def _json_loads(data: Union[memoryview, str]):
+    return json.loads(data if isinstance(data, str) else str(data, 'utf8'))
+
+
+def _orjson_dumps(message) -> bytes:
+    try:
+        return orjson.dumps(message)
+    except TypeError:
+        # e.g. integers beyond 64 bits or keys that are not strings
+        return _json_dumps(message)
+
+
+class PendingReply:
+    def __init__(self):
+        self._event = Event()
+        self._value = None
+        self._error = None
+
+    def set(self, value) -> None:
+        self._value = value
+        self._event.set()
+
+    def fail(self, error: Exception) -> None:
+        self._error = error
+        self._event.set()
+
+    def wait(self, timeout: float = None):
+        if not self._event.wait(timeout):
+            raise ReplyTimeoutError('No reply from the browser in %s seconds' % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class PendingStream:
+    """Chunks of a streamed reply, followed by the final result."""
+
+    _END = object()
+
+    def __init__(self):
+        self._queue = Queue()
+
+    def push(self, chunk) -> None:
+        self._queue.put((chunk, None))
+
+    def set(self, value) -> None:
+        self._queue.put((self._END, value))
+
+    def fail(self, error: Exception) -> None:
+        self._queue.put((self._END, error))
+
+    def iter(self, timeout: float = None) -> Iterator:
+        """
+        Yield chunks as they arrive. A final result that is a list is
+        yielded item by item: that's how an extension that can't stream
+        replies. `timeout` is applied to every chunk.
+        """
+        while True:
+            try:
+                chunk, value = self._queue.get(timeout=timeout)
+            except Empty:
+                raise ReplyTimeoutError('No reply from the browser in %s seconds' % timeout)
+            if chunk is not self._END:
+                yield chunk
+                continue
+            if isinstance(value, Exception):
+                raise value
+            if isinstance(value, list):
+                yield from value
+            return
+
+
+class Multiplexer:
+    """
+    Lets many threads talk to the browser over a single transport at the
+    same time.
+
+    Every command is sent with a unique "id" and the extension replies with
+    {"id": <id>, "result": <result>}. A dedicated reader thread receives all
+    messages and hands every reply to the thread that waits for it, so a
+    slow command doesn't hold up the others.
+
+    Extensions that don't know about ids reply with a bare result that can
+    only be matched by order. Until the first reply with an id arrives
+    commands are therefore sent one at a time, each after the previous one
+    got its reply (or timed out), and a bare reply goes to the only waiting
+    command.
+
+    Messages the extension sends on its own, {"event": <name>, ...}, are
+    passed to `on_event` in the reader thread.
+
+    A streamed reply is any number of {"id": <id>, "chunk": <chunk>}
+    messages followed by the usual {"id": <id>, "result": <result>}.
+    """
+
+    def __init__(self, transport: Transport, on_event: Callable[[dict], None] = None):
+        self._transport: Transport = transport
+        self._on_event = on_event
+        self._ids = count(1)
+        self._pending: OrderedDict = OrderedDict()
+        self._lock = Lock()
+        self._send_lock = Lock()
+        # held by the command in flight while the extension may not know
+        # about ids, released when the command is done
+        self._lockstep = Semaphore(1)
+        self._lockstep_ids = set()
+        self._ids_seen = False
+        self._error = None
+        self._reader = Thread(target=self._read_forever, name='transport-reader')
+        self._reader.daemon = True
+        self._reader.start()
+
+    @property
+    def replies_have_ids(self) -> bool:
+        """True once the extension is known to reply with ids."""
+        return self._ids_seen
+
+    def call(self, command: dict, timeout: float = None):
+        """Send a command and wait for its reply."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        id_, pending = self._register(PendingReply(), timeout)
+        try:
+            self._send(dict(command, id=id_))
+            return pending.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+        finally:
+            self._forget(id_)
+
+    def stream(self, command: dict, timeout: float = None) -> Iterator:
+        """
+        Send a command and return an iterator over the chunks of its reply.
+        `timeout` is the longest wait for a single chunk.
+        """
+        id_, pending = self._register(PendingStream(), timeout)
+        try:
+            self._send(dict(command, id=id_))
+        except Exception:
+            self._forget(id_)
+            raise
+        return self._iter_stream(id_, pending, timeout)
+
+    def _iter_stream(self, id_: int, pending: PendingStream, timeout: float) -> Iterator:
+        try:
+            yield from pending.iter(timeout)
+        finally:
+            self._forget(id_)
+
+    def _register(self, pending, timeout: float):
+        """Assign an id to the command, wait for its turn if replies have no ids yet."""
+        lockstep = not self._ids_seen
+        if lockstep and not self._lockstep.acquire(timeout=timeout):
+            raise ReplyTimeoutError('The browser is busy with another command for %s seconds'
+                                    % timeout)
+        with self._lock:
+            if self._error is not None:
+                if lockstep:
+                    self._lockstep.release()
+                raise self._error
+            id_ = next(self._ids)
+            self._pending[id_] = pending
+            if lockstep:
+                self._lockstep_ids.add(id_)
+        return id_, pending
+
+    def _forget(self, id_: int) -> Union[PendingReply, PendingStream, None]:
+        """Remove the command from the waiting ones, return its pending reply."""
+        with self._lock:
+            pending = self._pending.pop(id_, None)
+            lockstep = id_ in self._lockstep_ids
+            self._lockstep_ids.discard(id_)
+        if lockstep:
+            self._lockstep.release()
+        return pending
+
+    def notify(self, command: dict) -> None:
+        """Send a command the browser doesn't reply to."""
+        if self._error is not None:
+            raise self._error
+        self._send(command)
+
+    def _send(self, command: dict) -> None:
+        with self._send_lock:
+            self._transport.send(command)
+
+    def _read_forever(self) -> None:
+        while True:
+            try:
+                message = self._transport.recv()
+            except FragmentError as e:
+                # only the call the message replies to fails
+                mediator_logger.error('Dropping message: %s', e)
+                pending = None if e.id is None else self._forget(e.id)
+                if pending is not None:
+                    pending.fail(e)
+                continue
+            except Exception as e:
+                mediator_logger.exception('Transport reader stopped: %s', e)
+                self._fail_all(e if isinstance(e, TransportError) else TransportError(str(e)))
+                return
+            self._dispatch(message)
+
+    def _dispatch(self, message) -> None:
+        if isinstance(message, dict) and 'event' in message and 'id' not in message:
+            self._dispatch_event(message)
+            return
+        if isinstance(message, dict) and 'id' in message and 'chunk' in message:
+            self._dispatch_chunk(message)
+            return
+        if isinstance(message, dict) and 'id' in message and 'result' in message:
+            self._ids_seen = True
+            pending = self._forget(message['id'])
+            value = message['result']
+        else:
+            with self._lock:
+                # only one command can be waiting, see _register
+                id_ = next(iter(self._pending), None) if not self._ids_seen else None
+            pending = None if id_ is None else self._forget(id_)
+            value = message
+        if pending is None:
+            mediator_logger.error('Dropping reply nobody is waiting for: %.200s', message)
+            return
+        pending.set(value)
+
+    def _dispatch_chunk(self, message: dict) -> None:
+        self._ids_seen = True
+        with self._lock:
+            pending = self._pending.get(message['id'])
+        if not isinstance(pending, PendingStream):
+            mediator_logger.error('Dropping chunk nobody is waiting for: %.200s', message)
+            return
+        pending.push(message['chunk'])
+
+    def _dispatch_event(self, message: dict) -> None:
+        if self._on_event is None:
+            mediator_logger.info('Dropping event nobody listens to: %s', payload(message))
+            return
+        try:
+            self._on_event(message)
+        except Exception as e:
+            mediator_logger.exception('Cannot handle event %.200s: %s', message, e)
+
+    def _fail_all(self, error: Exception) -> None:
+        with self._lock:
+            self._error = error
+            pending, self._pending = list(self._pending.values()), OrderedDict()
+            lockstep, self._lockstep_ids = self._lockstep_ids, set()
+        for _id in lockstep:
+            self._lockstep.release()
+        for reply in pending:
+            reply.fail(error)
@@ -0,0 +1,169 @@
+"""
+Small threaded WSGI server that keeps HTTP/1.1 connections alive.
+
+wsgiref serves exactly one request per connection and werkzeug's development
+server always replies with "Connection: close", so neither lets the client
+reuse a TCP connection between requests.
+"""
+import logging
+import socket
+import sys
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from io import BytesIO
+from threading import Lock
+from urllib.parse import unquote
+
+from brotab.mediator.log import mediator_logger
+
+DEFAULT_KEEPALIVE_TIMEOUT = 30.0
+
+
+class KeepAliveRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Idle keep-alive connections are closed after this many seconds
+    timeout = DEFAULT_KEEPALIVE_TIMEOUT
+    # headers and body are written separately, with Nagle enabled the body
+    # would wait for the client's delayed ACK of the headers
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._run_wsgi()
+
+    def do_POST(self):
+        self._run_wsgi()
+
+    def do_HEAD(self):
+        self._run_wsgi()
+
+    def log_message(self, format, *args):
+        if mediator_logger.isEnabledFor(logging.DEBUG):
+            mediator_logger.debug('%s - %s', self.address_string(), format % args)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        # the body is always drained, otherwise the next request on this
+        # connection would start in the middle of it
+        return self.rfile.read(length) if length > 0 else b''
+
+    def _make_environ(self, body: bytes) -> dict:
+        path, _, query = self.path.partition('?')
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, 'iso-8859-1'),
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': self.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str(self.server.server_port),
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for key, value in self.headers.items():
+            key = key.upper().replace('-', '_')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                continue
+            key = 'HTTP_' + key
+            environ[key] = ('%s,%s' % (environ[key], value)) if key in environ else value
+        return environ
+
+    def _run_wsgi(self):
+        environ = self._make_environ(self._read_body())
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = status
+            response['headers'] = headers
+            return write
+
+        def send_headers():
+            code, _, message = response['status'].partition(' ')
+            self.send_response(int(code), message)
+            names = set()
+            for name, value in response['headers']:
+                self.send_header(name, value)
+                names.add(name.lower())
+            bodyless = self.command == 'HEAD' or code in ('204', '304')
+            if 'content-length' not in names and not bodyless:
+                if self.request_version >= 'HTTP/1.1':
+                    response['chunked'] = True
+                    self.send_header('Transfer-Encoding', 'chunked')
+                else:
+                    self.close_connection = True
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            self.end_headers()
+            response['sent'] = True
+
+        def write(data: bytes):
+            if not response.get('sent'):
+                send_headers()
+            if not data:
+                return
+            if response.get('chunked'):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            else:
+                self.wfile.write(data)
+            self.wfile.flush()
+
+        result = self.server.app(environ, start_response)
+        try:
+            for data in result:
+                write(data)
+            if not response.get('sent'):
+                send_headers()
+            if response.get('chunked'):
+                self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+class KeepAliveWSGIServer(ThreadingHTTPServer):
+    """
+    Serves every connection in its own daemon thread. Open keep-alive
+    connections are tracked so that server_close() can drop them, otherwise
+    their threads would keep answering requests after shutdown.
+    """
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int, app):
+        self.app = app
+        self._connections = set()
+        self._connections_lock = Lock()
+        super().__init__((host, port), KeepAliveRequestHandler)
+
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            self._connections.add(request)
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        with self._connections_lock:
+            self._connections.discard(request)
+        super().shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        with self._connections_lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def make_keepalive_server(host: str, port: int, app) -> KeepAliveWSGIServer:
+    return KeepAliveWSGIServer(host, port, app)
@@ -1,25 +1,233 @@
+"""
+Calls to many mediators at once.
+
+All calls run on one worker pool per process. It's created on first use
+and has a bounded number of threads that are reused between calls, so a
+long-running process or a library user can make any number of calls
+without paying for thread setup or leaking threads. Its threads are joined
+at exit like those of any ThreadPoolExecutor; shutdown() stops it earlier,
+the next call creates a new one.
+
+scatter_gather blocks, scatter_gather_async is the same for asyncio code.
+merge_iterators and merge_async_iterators yield lines of many mediators
+as they come.
+"""
+import asyncio
+import os
+import time
+from collections import namedtuple
 from concurrent.futures import ThreadPoolExecutor
-from asyncio import get_event_loop, gather
+from concurrent.futures import wait
+from queue import Full
+from queue import Queue
+from threading import Event
+from threading import Lock
+
+# threads of the worker pool, calls beyond that wait for a free thread
+MAX_WORKERS = 32
+# items of merged iterators that wait to be taken by the consumer
+MERGE_BUFFER_SIZE = 1024
+
+# result of a call to one mediator: `value` is what the call returned,
+# `error` is the exception it raised (TimeoutError if it didn't finish in
+# time), `elapsed` is its latency in seconds
+MediatorResult = namedtuple('MediatorResult', 'api value error elapsed')
+
+_executor = None
+_executor_lock = Lock()
+
+
+def executor() -> ThreadPoolExecutor:
+    """The worker pool of the process, created on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                                           thread_name_prefix='brotab-worker')
+        return _executor
+
+
+def shutdown(wait=True):
+    """
+    Shut the worker pool down, calls that haven't started are cancelled.
+    The next call creates a new pool.
+    """
+    global _executor
+    with _executor_lock:
+        pool, _executor = _executor, None
+    if pool is not None:
+        pool.shutdown(wait=wait, cancel_futures=True)
+
+
+def _forget_executor():
+    # threads of the parent don't exist in a forked child
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_executor)
 
 
 def call_parallel(functions):
     """
-    Call functions in multiple threads.
+    Call functions (without parameters, wrap them with partial or lambda)
+    on the worker pool, return their results in order.
+    """
+    futures = [executor().submit(function) for function in functions]
+    return [future.result() for future in futures]
+
+
+def _call(function, api):
+    start = time.monotonic()
+    try:
+        return MediatorResult(api, function(api), None, time.monotonic() - start)
+    except Exception as e:
+        return MediatorResult(api, None, e, time.monotonic() - start)
+
+
+def _timed_out(api, timeout):
+    return MediatorResult(api, None, TimeoutError(
+        'No reply from %s in %s seconds' % (api, timeout)), timeout)
 
-    Create a pool of thread as large as the number of functions.
-    Functions should accept no parameters (wrap then with partial or lambda).
+
+def scatter_gather(apis, function, timeout=None):
     """
-    loop = get_event_loop()
-    executor = ThreadPoolExecutor(max_workers=len(functions))
+    Call function(api) for every api on the worker pool and wait up to
+    `timeout` seconds (forever if None) for all of them.
+
+    Return a MediatorResult per api, in the order of `apis`. A call that
+    raised or didn't finish in time doesn't affect the others: it gets the
+    error and no value. A call that is still running is left to finish in
+    the background, its result is dropped.
 
+    `function` must not call scatter_gather itself, it could wait for a
+    thread of the pool forever.
+    """
+    apis = list(apis)
+    futures = [executor().submit(_call, function, api) for api in apis]
+    wait(futures, timeout)
+    results = []
+    for api, future in zip(apis, futures):
+        if future.done():
+            results.append(future.result())
+        else:
+            future.cancel()
+            results.append(_timed_out(api, timeout))
+    return results
+
+
+async def scatter_gather_async(apis, function, timeout=None):
+    """
+    Like scatter_gather, for asyncio code. A coroutine function is awaited
+    on the running loop, a regular function runs on the worker pool.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def call(api):
+        start = time.monotonic()
+        try:
+            if asyncio.iscoroutinefunction(function):
+                value = await asyncio.wait_for(function(api), timeout)
+            else:
+                value = await asyncio.wait_for(
+                    loop.run_in_executor(executor(), function, api), timeout)
+        except asyncio.TimeoutError:
+            return _timed_out(api, timeout)
+        except Exception as e:
+            return MediatorResult(api, None, e, time.monotonic() - start)
+        return MediatorResult(api, value, None, time.monotonic() - start)
+
+    return list(await asyncio.gather(*[call(api) for api in apis]))
+
+
+_DONE = object()
+
+
+def _put(queue: Queue, item, stopped: Event) -> bool:
+    """Put the item into the queue unless the consumer is gone."""
+    while not stopped.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _read_into(queue: Queue, iterator, stopped: Event) -> None:
     try:
-        tasks = [
-            loop.run_in_executor(executor, function)
-            for function in functions
-        ]
-        result = loop.run_until_complete(gather(*tasks))
+        for item in iterator:
+            if not _put(queue, (item, None), stopped):
+                return
+    except Exception as e:
+        _put(queue, (_DONE, e), stopped)
+        return
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+    _put(queue, (_DONE, None), stopped)
+
+
+def merge_iterators(iterators, buffer_size=MERGE_BUFFER_SIZE):
+    """
+    Yield items of all iterators as they come, every iterator is read on
+    the worker pool. Items of one iterator keep their order. An exception
+    of an iterator is raised after the items that came before it.
 
+    At most `buffer_size` items wait to be taken. When the merge is closed
+    the iterators are closed at their next item. Like in scatter_gather
+    the iterators must not call scatter_gather themselves.
+    """
+    iterators = list(iterators)
+    if len(iterators) == 1:
+        yield from iterators[0]
+        return
+    queue = Queue(buffer_size)
+    stopped = Event()
+    for iterator in iterators:
+        executor().submit(_read_into, queue, iterator, stopped)
+    remaining = len(iterators)
+    try:
+        while remaining:
+            item, error = queue.get()
+            if item is not _DONE:
+                yield item
+                continue
+            remaining -= 1
+            if error is not None:
+                raise error
     finally:
-        loop.close()
+        stopped.set()
 
-    return result
+
+async def merge_async_iterators(iterators, buffer_size=MERGE_BUFFER_SIZE):
+    """Like merge_iterators, for async iterators on the running loop."""
+    iterators = list(iterators)
+    queue = asyncio.Queue(buffer_size)
+
+    async def read(iterator):
+        try:
+            async for item in iterator:
+                await queue.put((item, None))
+        except Exception as e:
+            await queue.put((_DONE, e))
+            return
+        await queue.put((_DONE, None))
+
+    tasks = [asyncio.ensure_future(read(iterator)) for iterator in iterators]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            item, error = await queue.get()
+            if item is not _DONE:
+                yield item
+                continue
+            remaining -= 1
+            if error is not None:
+                raise error
+    finally:
+        for task in tasks:
+            task.cancel()
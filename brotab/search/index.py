@@ -1,21 +1,52 @@
 """
 This module contains helpers to work with an index of text from a browser.
+
+The index is updated incrementally: every row of the full-text table "tabs"
+has a companion row in "tabs_meta" keyed by tab id and URL that keeps the
+hash of the indexed title and text. Only rows that are new, changed or gone
+are written, so reindexing a browser whose tabs didn't change is cheap. The
+database is in WAL mode and the update is a single transaction, so queries
+can run while it's being updated.
+
+Rows are streamed from the tsv reader into batched statements, the file is
+never held in memory as a whole.
+
+"tabs_meta" also keeps text_hash of the text as the browser sent it. The
+indexer passes these hashes to get_text, the browser replies with
+UNCHANGED_MARKER instead of the text that is still the same, and the text
+is taken from the index.
 """
 import argparse
 import csv
 import ctypes
+import hashlib
 import logging
+import os
 import sqlite3
 import sys
+import time
+from collections import namedtuple
 from contextlib import suppress
 
+from brotab.const import UNCHANGED_MARKER
+
 MAX_FIELD_LEN = 131072
+# rows are written with one executemany when there are this many of them
+# or when their text takes this many bytes
+BATCH_SIZE = 500
+BATCH_BYTES = 8 * 1024 * 1024
 
 
 logger = logging.getLogger('brotab')
 
+IndexStats = namedtuple('IndexStats', 'inserted updated deleted unchanged')
+
 
-def index(sqlite_filename, tsv_filename):
+def content_hash(title, body):
+    return hashlib.sha1(('%s\t%s' % (title, body)).encode('utf-8')).hexdigest()
+
+
+def iter_tsv(tsv_filename):
     logger.info('Reading tsv file %s', tsv_filename)
     # https://stackoverflow.com/questions/15063936/csv-error-field-larger-than-field-limit-131072
     # https://github.com/balta2ar/brotab/issues/25
@@ -23,31 +54,237 @@ def index(sqlite_filename, tsv_filename):
     csv.field_size_limit(int(ctypes.c_ulong(-1).value // 2))
 
     with open(tsv_filename, encoding='utf-8') as tsv_file:
-        lines = [tuple(line) for line in csv.reader(tsv_file, delimiter='\t',
-                                                    quoting=csv.QUOTE_NONE)]
+        for line in csv.reader(tsv_file, delimiter='\t', quoting=csv.QUOTE_NONE):
+            # an empty result of get_text is a single empty line
+            if line:
+                yield tuple(line)
 
-    logger.info(
-        'Creating sqlite DB filename %s from tsv %s (%s lines)',
-        sqlite_filename, tsv_filename, len(lines))
-    conn = sqlite3.connect(sqlite_filename)
-    cursor = conn.cursor()
+
+def _create_tables(cursor):
     with suppress(sqlite3.OperationalError):
         cursor.execute('drop table tabs;')
+    with suppress(sqlite3.OperationalError):
+        cursor.execute('drop table tabs_meta;')
     cursor.execute(
         'create virtual table tabs using fts5('
         '    tab_id, title, url, body, tokenize="porter unicode61");')
-    cursor.executemany('insert into tabs values (?, ?, ?, ?)', lines)
-    conn.commit()
-    conn.close()
+    cursor.execute(
+        'create table tabs_meta('
+        '    tab_id text not null, url text not null, body_hash text not null,'
+        '    tabs_rowid integer not null, text_hash text, primary key (tab_id, url));')
+
+
+def _has_meta(cursor):
+    cursor.execute("select 1 from sqlite_master where name = 'tabs_meta';")
+    return cursor.fetchone() is not None
+
+
+def _has_text_hash(cursor):
+    columns = [row[1] for row in cursor.execute('pragma table_info(tabs_meta);')]
+    return 'text_hash' in columns
+
+
+def _add_text_hash(cursor):
+    """
+    Indexes created before text hashes were kept get the column. Only
+    writers call it, in their transaction.
+    """
+    if not _has_text_hash(cursor):
+        cursor.execute('alter table tabs_meta add column text_hash text;')
+
+
+def index(sqlite_filename, tsv_filename, full=False):
+    """
+    Update the index from the tsv file (tab_id, title, url, body per line).
+    With `full` the index is dropped and built from scratch.
+    """
+    logger.info('Updating sqlite DB filename %s from tsv %s',
+                sqlite_filename, tsv_filename)
+    return index_lines(sqlite_filename, iter_tsv(tsv_filename), full)
+
+
+def index_lines(sqlite_filename, lines, full=False):
+    """
+    Update the index from an iterable of (tab_id, title, url, body) or
+    (tab_id, title, url, body, text_hash) tuples. The iterable is consumed
+    once, in batches. A body that is UNCHANGED_MARKER is taken from the
+    index.
+    """
+    return _write(sqlite_filename, lambda cursor: _update(cursor, lines), full)
+
+
+def update_tabs(sqlite_filename, lines, removed_tab_ids=()):
+    """
+    Row-level update: replace rows of the tabs in `lines` (a tab that
+    navigated to another URL loses its old row), delete rows of the removed
+    tabs and keep all other rows.
+    """
+    lines = list(lines)
+    tab_ids = {line[0] for line in lines} | set(removed_tab_ids)
+    return _write(sqlite_filename, lambda cursor: _update(cursor, lines, tab_ids=tab_ids))
+
+
+def text_hashes(sqlite_filename, tab_ids=None):
+    """Return {tab_id: text_hash} of the indexed tabs (of `tab_ids` if given)."""
+    if not os.path.isfile(sqlite_filename):
+        return {}
+    conn = sqlite3.connect(sqlite_filename)
+    try:
+        cursor = conn.cursor()
+        # an index of an older version has no hashes, the next write adds them
+        if not _has_meta(cursor) or not _has_text_hash(cursor):
+            return {}
+        return {tab_id: text_hash for tab_id, text_hash
+                in cursor.execute('select tab_id, text_hash from tabs_meta '
+                                  'where text_hash is not null;')
+                if tab_ids is None or tab_id in tab_ids}
+    finally:
+        conn.close()
+
+
+def indexed_tabs(sqlite_filename):
+    """Return (tab_id, url) of the indexed tabs."""
+    if not os.path.isfile(sqlite_filename):
+        return []
+    conn = sqlite3.connect(sqlite_filename)
+    try:
+        cursor = conn.cursor()
+        if not _has_meta(cursor):
+            return []
+        return cursor.execute('select tab_id, url from tabs_meta;').fetchall()
+    finally:
+        conn.close()
+
+
+def _write(sqlite_filename, update, full=False):
+    start = time.time()
+    conn = sqlite3.connect(sqlite_filename, isolation_level=None)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('pragma journal_mode=wal;')
+        cursor.execute('begin immediate;')
+        if full or not _has_meta(cursor):
+            logger.info('Rebuilding index %s', sqlite_filename)
+            _create_tables(cursor)
+        _add_text_hash(cursor)
+        stats = update(cursor)
+        cursor.execute('commit;')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('rollback;')
+        raise
+    finally:
+        conn.close()
+    delta = time.time() - start
+    rows = sum(stats)
+    logger.info('Index %s updated in %.3f s, %d rows, %.0f rows/s: %s',
+                sqlite_filename, delta, rows, rows / delta if delta else 0, stats)
+    return stats
+
+
+def _update(cursor, lines, batch_size=BATCH_SIZE, tab_ids=None):
+    """
+    Make the index contain exactly `lines`, or with `tab_ids` only touch
+    rows of these tabs.
+    """
+    known = {(tab_id, url): (body_hash, rowid, text_hash)
+             for tab_id, url, body_hash, rowid, text_hash
+             in cursor.execute('select tab_id, url, body_hash, tabs_rowid, text_hash '
+                               'from tabs_meta;')
+             if tab_ids is None or tab_id in tab_ids}
+    # rows of the tabs whose text the browser may report as unchanged
+    hashed = {key[0]: (rowid, text_hash) for key, (_body_hash, rowid, text_hash)
+              in known.items() if text_hash is not None}
+    cursor.execute('select coalesce(max(rowid), 0) from tabs;')
+    # rowids are assigned here so that inserts can be batched too
+    next_rowid = cursor.fetchone()[0] + 1
+    batch = _Batch(cursor)
+    inserted = updated = unchanged = 0
+    seen = set()
+    for line in lines:
+        tab_id, title, url, body = line[:4]
+        text_hash = line[4] if len(line) > 4 else None
+        key = (tab_id, url)
+        if key in seen:
+            continue
+        if body == UNCHANGED_MARKER:
+            if tab_id not in hashed:
+                logger.error('Unchanged text of tab %s is not in the index', tab_id)
+                continue
+            rowid, text_hash = hashed[tab_id]
+            cursor.execute('select body from tabs where rowid = ?;', (rowid,))
+            body = cursor.fetchone()[0]
+        seen.add(key)
+        body_hash = content_hash(title, body)
+        old = known.get(key)
+        if old is None:
+            batch.inserts.append((next_rowid, tab_id, title, url, body))
+            batch.size += len(title) + len(body)
+            batch.meta_inserts.append((tab_id, url, body_hash, next_rowid, text_hash))
+            next_rowid += 1
+            inserted += 1
+        elif old[0] != body_hash:
+            batch.updates.append((title, body, old[1]))
+            batch.size += len(title) + len(body)
+            batch.meta_updates.append((body_hash, text_hash, tab_id, url))
+            updated += 1
+        else:
+            if text_hash is not None and old[2] != text_hash:
+                batch.meta_updates.append((body_hash, text_hash, tab_id, url))
+            unchanged += 1
+        if len(batch) >= batch_size or batch.size >= BATCH_BYTES:
+            batch.flush()
+
+    deleted = 0
+    for key, (_body_hash, rowid, _text_hash) in known.items():
+        if key in seen:
+            continue
+        batch.deletes.append((rowid,))
+        batch.meta_deletes.append(key)
+        deleted += 1
+        if len(batch) >= batch_size:
+            batch.flush()
+    batch.flush()
+    return IndexStats(inserted, updated, deleted, unchanged)
+
+
+class _Batch:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.size = 0
+        self.inserts, self.meta_inserts = [], []
+        self.updates, self.meta_updates = [], []
+        self.deletes, self.meta_deletes = [], []
+
+    def __len__(self):
+        return len(self.inserts) + len(self.updates) + len(self.deletes)
+
+    def flush(self):
+        execute = self._cursor.executemany
+        execute('insert into tabs(rowid, tab_id, title, url, body) values (?, ?, ?, ?, ?);',
+                self.inserts)
+        execute('insert into tabs_meta(tab_id, url, body_hash, tabs_rowid, text_hash) '
+                'values (?, ?, ?, ?, ?);', self.meta_inserts)
+        execute('update tabs set title = ?, body = ? where rowid = ?;', self.updates)
+        execute('update tabs_meta set body_hash = ?, text_hash = ? where tab_id = ? and url = ?;',
+                self.meta_updates)
+        execute('delete from tabs where rowid = ?;', self.deletes)
+        execute('delete from tabs_meta where tab_id = ? and url = ?;', self.meta_deletes)
+        for rows in (self.inserts, self.meta_inserts, self.updates,
+                     self.meta_updates, self.deletes, self.meta_deletes):
+            rows.clear()
+        self.size = 0
 
 
 def main():
     parser = argparse.ArgumentParser(description='Index text from tabs')
     parser.add_argument('sqlite', help='output sqlite DB file name')
     parser.add_argument('tsv', help='input tsv file name')
+    parser.add_argument('--full', action='store_true', default=False,
+                        help='drop the index and build it from scratch')
     args = parser.parse_args()
 
-    index(args.sqlite, args.tsv)
+    index(args.sqlite, args.tsv, args.full)
 
 
 if __name__ == '__main__':
@@ -1,17 +1,136 @@
 """
 This module contains helpers that query the indexed database of text from a
 browser.
+
+QueryEngine keeps a read-only connection to the index open between queries,
+so repeated queries (e.g. from a launcher, on every keystroke) don't pay for
+opening the database and warming up its cache. Results of recent queries are
+cached until the index changes. QueryServer serves an engine on a Unix
+socket so that short-lived processes (bt search) can share one; QueryClient
+talks to it.
 """
 
 import argparse
-import sqlite3
+import json
 import logging
+import os
+import socket
+import socketserver
+import sqlite3
+from collections import OrderedDict
 from collections import namedtuple
+from threading import Lock
+
+from brotab.files import in_temp_dir
 
 logger = logging.getLogger('brotab')
 
 QueryResult = namedtuple('QueryResult', 'tab_id title snippet')
 
+DEFAULT_QUERY_SOCKET = in_temp_dir('brotab_search.sock')
+# number of recent queries whose results are kept
+DEFAULT_RESULT_CACHE_SIZE = 256
+# read-optimized settings of the connection
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 16 * 1024
+
+# all options are parameters, so sqlite3 prepares the statement once and
+# reuses it from its statement cache
+QUERY_SQL = """
+    select
+        rank,
+        tab_id,
+        title,
+        snippet(tabs, ?, ?, ?, ?, ?) body
+    from tabs where tabs match ? order by rank limit ?;
+"""
+
+
+class QueryEngine:
+    def __init__(self, sqlite_filename, cache_size=DEFAULT_RESULT_CACHE_SIZE):
+        self.sqlite_filename = sqlite_filename
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        self._conn = None
+        # (st_dev, st_ino) of the open file, the index may be replaced
+        self._file_id = None
+        self._data_version = None
+
+    def query(self, user_query,
+              text_column_index=3,
+              max_tokens=30,
+              max_results=10,
+              marker_start='<b>',
+              marker_end='</b>',
+              marker_cut='...'):
+        key = (user_query, text_column_index, max_tokens, max_results,
+               marker_start, marker_end, marker_cut)
+        with self._lock:
+            try:
+                self._validate()
+            except (OSError, sqlite3.Error) as e:
+                logger.error('Cannot open sqlite db %s: %s', self.sqlite_filename, e)
+                self._close()
+                return []
+
+            results = self._cache.get(key)
+            if results is not None:
+                self._cache.move_to_end(key)
+                return list(results)
+
+            logger.info('Executing sqlite db %s query "%s"',
+                        self.sqlite_filename, user_query)
+            results = []
+            try:
+                for (_rank, tab_id, title, snippet) in self._conn.execute(QUERY_SQL, (
+                        text_column_index, marker_start, marker_end, marker_cut,
+                        max_tokens, user_query, max_results)):
+                    results.append(QueryResult(tab_id, title, snippet))
+            except sqlite3.OperationalError as e:
+                logger.exception('Error: %s', e)
+                return results
+
+            if self._cache_size > 0:
+                self._cache[key] = results
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+            return list(results)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = None
+        self._file_id = None
+        self._data_version = None
+        self._cache.clear()
+
+    def _validate(self):
+        """(Re)open the database if needed, drop cached results if it changed."""
+        stat = os.stat(self.sqlite_filename)
+        file_id = (stat.st_dev, stat.st_ino)
+        if self._conn is None or file_id != self._file_id:
+            self._close()
+            self._conn = self._connect()
+            self._file_id = file_id
+        data_version = self._conn.execute('pragma data_version;').fetchone()[0]
+        if data_version != self._data_version:
+            self._cache.clear()
+            self._data_version = data_version
+
+    def _connect(self):
+        logger.info('Opening sqlite db %s for queries', self.sqlite_filename)
+        conn = sqlite3.connect('file:%s?mode=ro' % self.sqlite_filename, uri=True,
+                               check_same_thread=False)
+        conn.execute('pragma query_only = 1;')
+        conn.execute('pragma mmap_size = %d;' % MMAP_SIZE)
+        conn.execute('pragma cache_size = -%d;' % CACHE_SIZE_KIB)
+        return conn
+
 
 def query(sqlite_filename, user_query,
           text_column_index=3,
@@ -20,40 +139,115 @@ def query(sqlite_filename, user_query,
           marker_start='<b>',
           marker_end='</b>',
           marker_cut='...'):
-    logger.info('Executing sqlite db %s query "%s"',
-                sqlite_filename, user_query)
-    conn = sqlite3.connect(sqlite_filename)
-    cursor = conn.cursor()
-    query = """
-    select
-        rank,
-        tab_id,
-        title,
-        snippet(tabs,
-                {text_column_index},
-                '{marker_start}',
-                '{marker_end}',
-                '{marker_cut}',
-                {max_tokens}) body
-    from tabs where tabs match ? order by rank limit {max_results};
-""".format_map(locals())
-    results = []
+    """Run a single query, use QueryEngine to run many."""
+    engine = QueryEngine(sqlite_filename, cache_size=0)
     try:
-        for (_rank, tab_id, title, snippet) in cursor.execute(query, (user_query,)):
-            results.append(QueryResult(tab_id, title, snippet))
-    except sqlite3.OperationalError as e:
-        logger.exception('Error: %s', e)
+        return engine.query(user_query, text_column_index, max_tokens, max_results,
+                            marker_start, marker_end, marker_cut)
+    finally:
+        engine.close()
+
+
+class _QueryRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                results = self.server.engine.query(**request)
+            except (ValueError, TypeError) as e:
+                logger.error('Bad query request %.200r: %s', line, e)
+                results = []
+            self.wfile.write(json.dumps(results).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
 
-    conn.close()
-    return results
+class QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serve queries to an engine on a Unix socket. The protocol is a JSON
+    object of QueryEngine.query arguments per line, the reply is a JSON list
+    of [tab_id, title, snippet] per line.
+    """
+    daemon_threads = True
+
+    def __init__(self, engine, socket_path=DEFAULT_QUERY_SOCKET):
+        self.engine = engine
+        self.socket_path = socket_path
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, _QueryRequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.engine.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class QueryClient:
+    """Query a QueryServer, keeps the connection open between queries."""
+
+    def __init__(self, socket_path=DEFAULT_QUERY_SOCKET, timeout=5.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._socket = None
+        self._file = None
+
+    def query(self, user_query, **kwargs):
+        request = dict(kwargs, user_query=user_query)
+        if self._socket is None:
+            self._connect()
+        try:
+            self._file.write(json.dumps(request).encode('utf-8') + b'\n')
+            self._file.flush()
+            line = self._file.readline()
+        except OSError:
+            self.close()
+            raise
+        if not line:
+            self.close()
+            raise ConnectionError('Query server %s closed the connection' % self.socket_path)
+        return [QueryResult(*result) for result in json.loads(line)]
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+        self._socket = None
+        self._file = None
+
+    def _connect(self):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(self.timeout)
+        try:
+            self._socket.connect(self.socket_path)
+        except OSError:
+            self._socket.close()
+            self._socket = None
+            raise
+        self._file = self._socket.makefile('rwb')
 
 
 def main():
     parser = argparse.ArgumentParser(description='Query text DB')
     parser.add_argument('sqlite', help='sqlite DB filename')
-    parser.add_argument('query', help='sqlite query')
+    parser.add_argument('query', nargs='?', help='sqlite query')
+    parser.add_argument('--serve', metavar='SOCKET', nargs='?', const=DEFAULT_QUERY_SOCKET,
+                        help='serve queries on a Unix socket instead')
     args = parser.parse_args()
 
+    if args.serve is not None:
+        server = QueryServer(QueryEngine(args.sqlite), args.serve)
+        logger.info('Serving queries to %s on %s', args.sqlite, args.serve)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    if args.query is None:
+        parser.error('query is required')
     for result in query(args.sqlite, args.query):
         print('\t'.join([result.tab_id, result.title, result.snippet]))
 
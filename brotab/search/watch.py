@@ -0,0 +1,214 @@
+"""
+Keep the index of text from tabs up to date while the browser runs
+(bt index --watch).
+
+Every mediator is long-polled for changes of its tab list. Text is extracted
+again only from tabs that are new, navigated to another URL or finished
+loading, and only the rows of these tabs are updated. Rows of closed tabs
+are deleted. At most `rate` tabs per second are extracted, so that a burst
+of loading tabs (e.g. a restored session) doesn't keep the browser busy.
+
+The watcher usually starts before any browser does and runs longer than
+any of them, so mediators are discovered again every DISCOVERY_INTERVAL
+seconds: new and restarted ones are polled, gone ones are not.
+"""
+import logging
+import time
+from collections import OrderedDict
+from threading import Condition
+from threading import Event
+from threading import Thread
+
+from brotab.search.index import indexed_tabs
+from brotab.search.index import update_tabs
+
+logger = logging.getLogger('brotab')
+
+# how long a mediator holds a request for changes
+DEFAULT_WATCH_WAIT = 30.0
+# tabs per second to extract text from
+DEFAULT_WATCH_RATE = 2.0
+# pause after a mediator could not be reached
+RETRY_INTERVAL = 5.0
+# how often mediators are discovered again
+DISCOVERY_INTERVAL = 10.0
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def acquire_watch_lock(sqlite_filename):
+    """
+    Return an open lock file if no other watcher updates this index, None
+    otherwise. The lock is held until the file is closed. Where file
+    locking is not available, the lock always succeeds.
+    """
+    lock_file = open(sqlite_filename + '.watch.lock', 'w')
+    if fcntl is None:
+        return lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def browser_tab_id(tab_id):
+    """a.1.2 -> a.2: the tab keeps this id when it moves to another window."""
+    prefix, _window_id, id_ = tab_id.split('.')
+    return '%s.%s' % (prefix, id_)
+
+
+class IndexWatcher:
+    def __init__(self, discover, sqlite_filename, extract,
+                 rate=DEFAULT_WATCH_RATE, wait=DEFAULT_WATCH_WAIT,
+                 discovery_interval=DISCOVERY_INTERVAL):
+        """
+        :param discover: function that returns SingleMediatorAPI of every
+            mediator to watch, it's called every `discovery_interval` seconds
+        :param extract: function of a list of tab ids that returns records
+            of them as index_lines takes them, it can use `apis`
+        """
+        self._discover = discover
+        self._sqlite_filename = sqlite_filename
+        self._extract = extract
+        self._rate = rate
+        self._wait = wait
+        self._discovery_interval = discovery_interval
+        # mediators being polled
+        self.apis = []
+        # str(api) (prefix, address, pid and browser) -> event that stops its
+        # polling; a restarted mediator has another pid, it's polled anew
+        self._polls = {}
+        self._stopped = Event()
+        self._changed = Condition()
+        # browser tab id -> (tab id, url, status) of every known tab
+        self._tabs = {}
+        # tab ids to extract text from, in the order they changed
+        self._pending = OrderedDict()
+        # tab ids whose rows are to be deleted
+        self._removed = set()
+
+    def run(self):
+        self.load_index()
+        next_discovery = time.monotonic()
+        while not self._stopped.is_set():
+            if time.monotonic() >= next_discovery:
+                self.discover()
+                next_discovery = time.monotonic() + self._discovery_interval
+            self.process(timeout=max(next_discovery - time.monotonic(), 0))
+
+    def stop(self):
+        self._stopped.set()
+        for stopped in self._polls.values():
+            stopped.set()
+        with self._changed:
+            self._changed.notify_all()
+
+    def discover(self):
+        """Start polling new and restarted mediators, stop polling gone ones."""
+        try:
+            apis = {str(api): api for api in self._discover()}
+        except (OSError, ValueError) as e:
+            logger.error('Cannot discover mediators: %s', e)
+            return
+        for key in list(self._polls):
+            if key not in apis:
+                logger.info('Watcher stops polling %s', key)
+                self._polls.pop(key).set()
+        for key, api in apis.items():
+            if key not in self._polls:
+                logger.info('Watcher starts polling %s', key)
+                stopped = self._polls[key] = Event()
+                Thread(target=self._poll, args=(api, stopped), daemon=True).start()
+        self.apis = list(apis.values())
+
+    def load_index(self):
+        """Tabs that are in the index already are not extracted again."""
+        with self._changed:
+            for tab_id, url in indexed_tabs(self._sqlite_filename):
+                self._tabs[browser_tab_id(tab_id)] = (tab_id, url, 'complete')
+
+    def apply_delta(self, api, delta):
+        with self._changed:
+            if delta['full']:
+                current = {browser_tab_id(change['tab'].split('\t')[0])
+                           for change in delta['changed']}
+                for key, (tab_id, _url, _status) in list(self._tabs.items()):
+                    if api.prefix_match(tab_id) and key not in current:
+                        self._remove(tab_id)
+            for tab_id in delta['removed']:
+                self._remove(tab_id)
+            for change in delta['changed']:
+                fields = change['tab'].split('\t')
+                self._update(fields[0], fields[-1], change['status'])
+            self._changed.notify_all()
+
+    def process(self, timeout=None):
+        """
+        Index a batch of changed tabs, wait up to `timeout` for changes if
+        there are none. Return stats of the update, None if nothing changed.
+        """
+        with self._changed:
+            if not self._pending and not self._removed:
+                self._changed.wait(timeout)
+            removed, self._removed = self._removed, set()
+            batch = []
+            while self._pending and len(batch) < max(1, int(self._rate)):
+                batch.append(self._pending.popitem(last=False)[0])
+        if not removed and not batch:
+            return None
+
+        start = time.time()
+        lines = list(self._extract(batch)) if batch else []
+        # tabs that failed to give text lose their old rows, the page is not
+        # what was indexed anymore
+        removed |= set(batch) - {line[0] for line in lines}
+        stats = update_tabs(self._sqlite_filename, lines, removed)
+        logger.info('Watcher indexed %s tabs, removed %s: %s', len(batch), len(removed), stats)
+        # throttle extraction to `rate` tabs per second
+        self._stopped.wait(len(batch) / self._rate - (time.time() - start))
+        return stats
+
+    def _update(self, tab_id, url, status):
+        key = browser_tab_id(tab_id)
+        old = self._tabs.get(key)
+        self._tabs[key] = (tab_id, url, status)
+        if old is not None and old[0] != tab_id:
+            # moved to another window, the row has the old id
+            self._removed.add(old[0])
+            self._pending.pop(old[0], None)
+            old = None
+        if status == 'loading':
+            # the text is extracted when the page is loaded
+            self._pending.pop(tab_id, None)
+            return
+        # status is None when the extension doesn't report it, then only a
+        # change of URL is noticed
+        if old is None or old[1] != url or old[2] == 'loading':
+            self._pending[tab_id] = None
+
+    def _remove(self, tab_id):
+        old = self._tabs.pop(browser_tab_id(tab_id), None)
+        if old is not None:
+            tab_id = old[0]
+        self._pending.pop(tab_id, None)
+        self._removed.add(tab_id)
+
+    def _poll(self, api, stopped):
+        since = 0
+        while not stopped.is_set():
+            try:
+                delta = api.list_tabs_delta(since, wait=self._wait)
+            except (OSError, ValueError) as e:
+                logger.error('Cannot get changes of tabs from %s: %s', api, e)
+                stopped.wait(RETRY_INTERVAL)
+                continue
+            if stopped.is_set():
+                # the mediator is gone or has been replaced meanwhile
+                break
+            since = delta['version']
+            self.apply_delta(api, delta)
@@ -1,4 +1,9 @@
+from itertools import islice
+
+
 class Tab:
+    __slots__ = ('prefix', 'window_id', 'tab_id', 'title', 'url')
+
     def __init__(self, prefix, window_id, tab_id, title, url):
         self.prefix = prefix
         self.window_id = window_id
@@ -44,6 +49,32 @@ def parse_tab_lines(tab_lines):
     return [Tab.from_line(line) for line in tab_lines]
 
 
+def tab_columns(tab_lines) -> dict:
+    """
+    Columnar form of tab lines (<window_id>.<tab_id>\t<title>\t<url>):
+
+        {"window_ids": [...], "tab_ids": [...], "titles": [...], "urls": [...]}
+
+    A mediator replies with it to a client that accepts TAB_COLUMNS_MIMETYPE.
+    """
+    window_ids, tab_ids, titles, urls = [], [], [], []
+    for line in tab_lines:
+        ids, title, url = line.split('\t', 2)
+        window_id, tab_id = ids.split('.')
+        window_ids.append(int(window_id))
+        tab_ids.append(int(tab_id))
+        titles.append(title)
+        urls.append(url)
+    return {'window_ids': window_ids, 'tab_ids': tab_ids, 'titles': titles, 'urls': urls}
+
+
+def tabs_from_columns(prefix, columns: dict, limit=None):
+    """Tab objects of the columnar form, at most `limit` of them."""
+    rows = zip(columns['window_ids'], columns['tab_ids'], columns['titles'], columns['urls'])
+    return [Tab(prefix, window_id, tab_id, title, url)
+            for window_id, tab_id, title, url in islice(rows, limit)]
+
+
 def iter_window_tabs(left: [Tab], right: [Tab]):
     # get_window_id = attrgetter('window_id')
     # left = sorted(left, key=get_window_id)
@@ -0,0 +1,266 @@
+"""
+Microbenchmarks. They are not collected by pytest, run them by hand:
+
+    python -m brotab.tests.bench --help
+    python -m brotab.tests.bench http_client
+    python -m brotab.tests.bench index --count 2000
+    python -m brotab.tests.bench parallel --count 10000
+    python -m brotab.tests.bench transport --count 200
+    python -m brotab.tests.bench tabs --count 10000
+    python -m brotab.tests.bench tabs --count 50000
+    python -m brotab.tests.bench compression --count 1000
+"""
+import io
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from http.client import HTTPConnection
+from urllib.request import Request
+from urllib.request import urlopen
+
+from brotab.api import HttpClient
+from brotab.files import in_temp_dir
+from brotab.http_pool import ConnectionPool
+from brotab.main import run_commands
+from brotab.mediator import transport
+from brotab.mediator.transport import StdTransport
+from brotab.parallel import scatter_gather
+from brotab.search.index import index
+from brotab.tab import parse_tab_lines
+from brotab.tests.test_main import DummyBrowserRemoteAPI
+from brotab.tests.test_main import MockedMediator
+
+
+def _report(name, count, delta):
+    print('%-32s %8d requests %10.3f s %10.3f ms/request' % (
+        name, count, delta, 1000.0 * delta / count))
+
+
+def bench_http_client(count):
+    """
+    Per-request latency of a fresh TCP connection per request (urllib, how
+    HttpClient used to work) versus pooled keep-alive connections.
+    """
+    with MockedMediator('a', remote_api=DummyBrowserRemoteAPI()) as mediator:
+        url = 'http://localhost:%s/get_pid' % mediator.port
+
+        start = time.time()
+        for _ in range(count):
+            with urlopen(Request(url=url, method='GET'), timeout=10.0) as response:
+                response.read()
+        _report('urllib, new connection', count, time.time() - start)
+
+        client = HttpClient(port=mediator.port, pool=ConnectionPool())
+        start = time.time()
+        for _ in range(count):
+            client.get('/get_pid')
+        _report('HttpClient, keep-alive pool', count, time.time() - start)
+
+
+class ManyTabsRemoteAPI(DummyBrowserRemoteAPI):
+    """A browser with `count` tabs of about 8 KB of text each."""
+
+    def __init__(self, count):
+        self._count = count
+        self._body = ' '.join('word%d' % i for i in range(1024))[:8192]
+
+    def get_text(self, delimiter_regex, replace_with, tab_ids=None, window_ids=None,
+                 concurrency=None, timeout=None, stream=False, hashes=None):
+        for tab_id in range(self._count):
+            yield '1.%d\ttitle %d\thttps://example.com/%d\t%s' % (
+                tab_id, tab_id, tab_id, self._body)
+
+
+def _measure(name, count, func):
+    tracemalloc.start()
+    start = time.time()
+    try:
+        func()
+        delta = time.time() - start
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    print('%-32s %8d tabs %10.3f s %10.1f MB peak' % (name, count, delta, peak / 2 ** 20))
+
+
+def bench_index(count):
+    """
+    bt index of a mocked browser: text saved to a tsv file and parsed back
+    (how bt index used to work) versus text piped into the index.
+    """
+    sqlite_filename = in_temp_dir('bench_index.sqlite')
+    tsv_filename = in_temp_dir('bench_index.tsv')
+    with MockedMediator('a', remote_api=ManyTabsRemoteAPI(count)) as mediator:
+        target = ['--target', 'localhost:%s' % mediator.port]
+
+        def through_tsv():
+            run_commands(target + ['text', '--cleanup', '--tsv', tsv_filename])
+            index(sqlite_filename, tsv_filename, full=True)
+
+        def pipeline():
+            run_commands(target + ['index', '--full', '--sqlite', sqlite_filename])
+
+        try:
+            _measure('bt text --tsv, index tsv', count, through_tsv)
+            _measure('bt index, pipeline', count, pipeline)
+        finally:
+            for filename in (sqlite_filename, sqlite_filename + '-wal',
+                             sqlite_filename + '-shm', tsv_filename):
+                if os.path.isfile(filename):
+                    os.remove(filename)
+
+
+def bench_parallel(count):
+    """
+    Fan-out to 4 mediators `count` times: a new thread pool per call (how
+    call_parallel used to work) versus the worker pool of the process.
+    Threads alive afterwards show whether any are leaked.
+    """
+    apis = ['a', 'b', 'c', 'd']
+
+    def new_pool_per_call():
+        executor = ThreadPoolExecutor(max_workers=len(apis))
+        try:
+            wait([executor.submit(str.upper, api) for api in apis])
+        finally:
+            executor.shutdown(wait=False)
+
+    for name, call in [('new pool per call', new_pool_per_call),
+                       ('worker pool', lambda: scatter_gather(apis, str.upper))]:
+        # threads that are created once are not a leak
+        for _ in range(100):
+            call()
+        threads = threading.active_count()
+        start = time.time()
+        for _ in range(count):
+            call()
+        delta = time.time() - start
+        print('%-32s %8d calls %10.3f s %10.3f us/call %4d threads more' % (
+            name, count, delta, 1e6 * delta / count, threading.active_count() - threads))
+
+
+def bench_tabs(count):
+    """
+    Tab objects of a mediator with `count` tabs in its tab model: tab lines
+    parsed with parse_tab_lines (how the client got them before) versus the
+    columnar reply decoded by list_tab_records. Time is the best of 5 runs.
+    """
+    with MockedMediator('a') as mediator:
+        mediator.remote_api.tab_model.apply_event({'event': 'tab_snapshot', 'tabs': [
+            {'id': tab_id, 'windowId': tab_id % 100, 'index': tab_id,
+             'title': 'Some page title number %d' % tab_id,
+             'url': 'https://example.com/page/%d?q=1' % tab_id} for tab_id in range(count)]})
+        api = mediator.api
+        args = [str(count)]
+        for name, func in [('lines, parse_tab_lines', lambda: parse_tab_lines(api.list_tabs(args))),
+                           ('columns, list_tab_records', lambda: api.list_tab_records(args))]:
+            assert count == len(func())
+            best = min(_timed(func) for _ in range(5))
+            tracemalloc.start()
+            try:
+                func()
+                _current, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            print('%-32s %8d tabs %10.3f s %10.1f MB peak' % (name, count, best, peak / 2 ** 20))
+
+
+def _timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def bench_compression(count):
+    """
+    Bytes on the wire and time of get_text of a mocked browser with `count`
+    tabs of about 8 KB of text each, plain and with every encoding.
+    """
+    with MockedMediator('a', remote_api=ManyTabsRemoteAPI(count)) as mediator:
+        for path in ('/get_text', '/get_text?stream=1'):
+            for encoding in ('identity', 'gzip', 'deflate'):
+                connection = HTTPConnection('localhost', mediator.port)
+                start = time.time()
+                connection.request('GET', path, headers={'Accept-Encoding': encoding})
+                size = len(connection.getresponse().read())
+                delta = time.time() - start
+                connection.close()
+                print('%-20s %-10s %8d tabs %10.3f s %10.1f MB' % (
+                    path, encoding, count, delta, size / 2 ** 20))
+
+
+class OldStdTransport(StdTransport):
+    """Framing of StdTransport before the read buffer and vectored writes."""
+
+    def send(self, command):
+        content = json.dumps(command).encode('utf8')
+        self._out.write(struct.pack('@I', len(content)))
+        self._out.write(content)
+        self._out.flush()
+
+    def recv(self):
+        message_length = struct.unpack('@I', self._in.read(4))[0]
+        return json.loads(self._in.read(message_length).decode('utf8'))
+
+
+def bench_transport(count):
+    """
+    Throughput of native messaging framing over a pipe: `count` get_text
+    replies of about 4 MB each, sent by one thread and received by another.
+    """
+    line = '1.%d\ttitle\thttps://example.com\t' + ' '.join('word%d' % i for i in range(1024))
+    message = {'id': 1, 'result': [line % i for i in range(512)]}
+    size = len(json.dumps(message).encode('utf8'))
+    variants = [('old framing, json', OldStdTransport, {}),
+                ('new framing, json', StdTransport, {'fast_json': False})]
+    if transport.orjson is not None:
+        variants.append(('new framing, orjson', StdTransport, {'fast_json': True}))
+    for name, cls, kwargs in variants:
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'rb') as input_, open(write_fd, 'wb') as output:
+            sender = cls(io.BytesIO(), output, **kwargs)
+            receiver = cls(input_, io.BytesIO(), **kwargs)
+
+            def send_all():
+                for _ in range(count):
+                    sender.send(message)
+
+            thread = threading.Thread(target=send_all)
+            start = time.time()
+            thread.start()
+            for _ in range(count):
+                receiver.recv()
+            thread.join()
+            delta = time.time() - start
+        print('%-32s %8d messages %10.3f s %10.1f MB/s' % (
+            name, count, delta, count * size / delta / 2 ** 20))
+
+
+BENCHMARKS = {
+    'http_client': bench_http_client,
+    'index': bench_index,
+    'parallel': bench_parallel,
+    'tabs': bench_tabs,
+    'compression': bench_compression,
+    'transport': bench_transport,
+}
+
+
+def main():
+    parser = ArgumentParser(description='brotab microbenchmarks')
+    parser.add_argument('name', choices=sorted(BENCHMARKS), help='benchmark to run')
+    parser.add_argument('--count', type=int, default=1000, help='number of iterations')
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args.count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
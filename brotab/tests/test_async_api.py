@@ -0,0 +1,157 @@
+import asyncio
+import time
+from unittest import TestCase
+from urllib.error import URLError
+
+from brotab.async_api import AsyncHttpClient
+from brotab.async_api import AsyncMultipleMediatorsAPI
+from brotab.async_api import AsyncSingleMediatorAPI
+from brotab.async_api import _Connection
+from brotab.tests.test_main import DummyBrowserRemoteAPI
+from brotab.tests.test_main import MockedMediator
+
+
+class SlowRemoteAPI(DummyBrowserRemoteAPI):
+    def __init__(self, delay):
+        self._delay = delay
+
+    def list_tabs(self):
+        time.sleep(self._delay)
+        return super().list_tabs()
+
+
+class UpdatingRemoteAPI(DummyBrowserRemoteAPI):
+    def update_tabs(self, updates):
+        return ['%s.%s' % (1, update['tab_id']) for update in updates]
+
+
+class TestAsyncSingleMediatorAPI(TestCase):
+    def setUp(self):
+        self.mediator = MockedMediator('a', remote_api=UpdatingRemoteAPI())
+
+    def tearDown(self):
+        self.mediator.join()
+
+    def test_methods(self):
+        async def run():
+            api = await AsyncSingleMediatorAPI.create('a', port=self.mediator.port)
+            try:
+                assert 'mocked' == api.browser
+                assert ['a.1.1\ttitle\turl'] == await api.list_tabs([])
+                assert ['a.1.1\ttitle\turl'] == [tab.line for tab in await api.list_tab_records([])]
+                assert ['a.1.1\ttitle\turl\tbody'] == await api.get_text([], '/x/', '" "')
+                assert ['a.1.1\ttitle\turl\tbody'] == [
+                    line async for line in api.iter_text('/x/', '" "')]
+                assert ['a.1.2'] == await api.update_tabs(
+                    api.own_updates([{'tab_id': 'a.1.2', 'properties': {'url': 'url'}},
+                                     {'tab_id': 'b.1.3', 'properties': {'url': 'url'}}]))
+            finally:
+                await api.close()
+
+        asyncio.run(run())
+
+    def test_connection_is_reused(self):
+        async def run():
+            client = AsyncHttpClient(port=self.mediator.port)
+            try:
+                assert 'mocked' == await client.get('/get_browser')
+                connection = client._idle[0]
+                for _ in range(10):
+                    assert 'mocked' == await client.get('/get_browser')
+                assert [connection] == client._idle
+            finally:
+                await client.close()
+
+        asyncio.run(run())
+
+
+    def test_sent_request_is_retried_only_if_idempotent(self):
+        requests = []
+
+        async def drop(reader, writer):
+            # read the request and close the connection without a reply
+            head = await reader.readuntil(b'\r\n\r\n')
+            requests.append(head.split(b' ', 1)[0])
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(drop, 'localhost', 0)
+            port = server.sockets[0].getsockname()[1]
+            client = AsyncHttpClient(port=port)
+
+            async def idle_connection():
+                client._idle.append(_Connection(*await asyncio.open_connection('localhost', port)))
+
+            try:
+                # the mediator might have got the POST, a second open_urls
+                # would open the tabs twice
+                await idle_connection()
+                with self.assertRaises(URLError):
+                    await client.post_json('/open_urls', {'urls': ['https://example.com']})
+                assert [b'POST'] == requests
+                await idle_connection()
+                with self.assertRaises(URLError):
+                    await client.get('/get_browser')
+                assert [b'POST', b'GET', b'GET'] == requests
+            finally:
+                await client.close()
+                server.close()
+                await server.wait_closed()
+
+        asyncio.run(run())
+
+
+class TestAsyncHttpClientDeadline(TestCase):
+    def setUp(self):
+        self.mediator = MockedMediator('a', remote_api=SlowRemoteAPI(0.5))
+
+    def tearDown(self):
+        self.mediator.join()
+
+    def test_deadline_and_cancellation_close_connection(self):
+        async def run():
+            client = AsyncHttpClient(port=self.mediator.port, timeout=0.1)
+            try:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await client.get('/list_tabs')
+                assert [] == client._idle
+
+                task = asyncio.ensure_future(client.get('/list_tabs', timeout=5.0))
+                await asyncio.sleep(0.1)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                assert [] == client._idle
+
+                assert 'mocked' == await client.get('/get_browser')
+            finally:
+                await client.close()
+
+        asyncio.run(run())
+
+
+class TestAsyncMultipleMediatorsAPI(TestCase):
+    def setUp(self):
+        self.fast = MockedMediator('a', remote_api=DummyBrowserRemoteAPI())
+        self.slow = MockedMediator('b', remote_api=SlowRemoteAPI(1.0))
+
+    def tearDown(self):
+        self.fast.join()
+        self.slow.join()
+
+    def test_slow_mediator_is_left_out(self):
+        async def run():
+            api = AsyncMultipleMediatorsAPI([
+                await AsyncSingleMediatorAPI.create('a', port=self.fast.port),
+                await AsyncSingleMediatorAPI.create('b', port=self.slow.port),
+            ], timeout=0.3)
+            try:
+                start = time.monotonic()
+                assert ['a.1.1\ttitle\turl'] == await api.list_tabs([])
+                assert ['a.1.1\ttitle\turl'] == [tab.line for tab in await api.list_tab_records([])]
+                assert time.monotonic() - start < 0.9
+                assert ['a', 'b'] == sorted(api.latencies)
+            finally:
+                await api.close()
+
+        asyncio.run(run())
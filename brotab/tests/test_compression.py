@@ -0,0 +1,131 @@
+import asyncio
+import gzip
+import zlib
+from http.client import HTTPConnection
+from unittest import TestCase
+
+from brotab.api import HttpClient
+from brotab.async_api import AsyncHttpClient
+from brotab.compression import CompressionMiddleware
+from brotab.compression import LineSplitter
+from brotab.compression import accepted_encoding
+from brotab.compression import is_local_host
+from brotab.http_pool import ConnectionPool
+from brotab.tests.test_main import DummyBrowserRemoteAPI
+from brotab.tests.test_main import MockedMediator
+
+LINES = ['1.%d\ttitle %d\thttps://example.com/%d\t%s' % (i, i, i, 'some words ' * 100)
+         for i in range(50)]
+
+
+class ManyLinesRemoteAPI(DummyBrowserRemoteAPI):
+    def get_text(self, delimiter_regex, replace_with, tab_ids=None, window_ids=None,
+                 concurrency=None, timeout=None, stream=False, hashes=None):
+        return iter(LINES) if stream else LINES
+
+
+class TestHelpers(TestCase):
+    def test_line_splitter(self):
+        splitter = LineSplitter()
+        assert [] == splitter.feed(b'fir')
+        assert [] == splitter.feed(b'st')
+        assert [b'first', b'second'] == splitter.feed(b'\nsecond\nthi')
+        assert [b'third', b''] == splitter.feed(b'rd\n\n')
+        assert [] == splitter.finish()
+        assert [] == splitter.feed(b'last')
+        assert [b'last'] == splitter.finish()
+
+    def test_accepted_encoding(self):
+        assert 'gzip' == accepted_encoding('gzip, deflate')
+        assert 'deflate' == accepted_encoding('br, Deflate;q=0.5')
+        assert 'deflate' == accepted_encoding('gzip;q=0, deflate')
+        assert accepted_encoding('') is None
+        assert accepted_encoding('br') is None
+
+    def test_is_local_host(self):
+        assert is_local_host('localhost')
+        assert is_local_host('127.0.0.1')
+        assert is_local_host('::1')
+        assert not is_local_host('192.168.1.10')
+        assert not is_local_host('workstation-7')
+
+
+class TestMiddleware(TestCase):
+    def _call(self, app):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'], response['headers'] = status, dict(headers)
+
+        environ = {'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'}
+        body = b''.join(CompressionMiddleware(app, min_size=10)(environ, start_response))
+        return response['headers'], body
+
+    def test_body_passed_to_write(self):
+        def app(environ, start_response):
+            write = start_response('200 OK', [('Content-Length', '50')])
+            write(b'x' * 20)
+            write(b'y' * 20)
+            return [b'z' * 10]
+
+        headers, body = self._call(app)
+        assert 'gzip' == headers['Content-Encoding']
+        assert b'x' * 20 + b'y' * 20 + b'z' * 10 == gzip.decompress(body)
+        assert str(len(body)) == headers['Content-Length']
+
+    def test_body_passed_to_write_is_not_compressed_when_small(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '5')])(b'small')
+            return []
+
+        headers, body = self._call(app)
+        assert 'Content-Encoding' not in headers
+        assert b'small' == body
+
+
+class TestCompression(TestCase):
+    def setUp(self):
+        self.mediator = MockedMediator('a', remote_api=ManyLinesRemoteAPI())
+
+    def tearDown(self):
+        self.mediator.join()
+
+    def _raw_get(self, path, accept_encoding):
+        connection = HTTPConnection('localhost', self.mediator.port, timeout=5)
+        try:
+            connection.request('GET', path, headers={'Accept-Encoding': accept_encoding})
+            response = connection.getresponse()
+            return response.getheader('Content-Encoding'), response.read()
+        finally:
+            connection.close()
+
+    def test_large_response_is_compressed(self):
+        encoding, body = self._raw_get('/get_text', 'gzip')
+        assert 'gzip' == encoding
+        assert '\n'.join(LINES) == gzip.decompress(body).decode('utf8')
+        assert len(body) < len('\n'.join(LINES)) / 10
+
+        encoding, body = self._raw_get('/get_text?stream=1', 'deflate')
+        assert 'deflate' == encoding
+        assert ''.join(line + '\n' for line in LINES) == zlib.decompress(body).decode('utf8')
+
+    def test_small_response_is_not_compressed(self):
+        assert (None, b'mocked') == self._raw_get('/get_browser', 'gzip')
+
+    def test_client(self):
+        client = HttpClient(port=self.mediator.port, pool=ConnectionPool(), compress=True)
+        assert '\n'.join(LINES) == client.get('/get_text')
+        assert LINES == list(client.iter_lines('/get_text?stream=1'))
+        assert 'mocked' == client.get('/get_browser')
+
+    def test_async_client(self):
+        async def run():
+            client = AsyncHttpClient(port=self.mediator.port, compress=True)
+            try:
+                assert '\n'.join(LINES) == await client.get('/get_text')
+                assert LINES == [line async for line in client.iter_lines('/get_text?stream=1')]
+                assert 'mocked' == await client.get('/get_browser')
+            finally:
+                await client.close()
+
+        asyncio.run(run())
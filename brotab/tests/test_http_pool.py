@@ -0,0 +1,92 @@
+import socket
+from http.client import RemoteDisconnected
+from unittest import TestCase
+
+from brotab.api import HttpClient
+from brotab.http_pool import ConnectionPool
+from brotab.tests.test_main import DummyBrowserRemoteAPI
+from brotab.tests.test_main import MockedMediator
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        self.mediator = MockedMediator('a', remote_api=DummyBrowserRemoteAPI())
+        self.pool = ConnectionPool(max_size=2, idle_timeout=60.0)
+        self.client = HttpClient(port=self.mediator.port, pool=self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+        self.mediator.join()
+
+    def _idle(self):
+        return self.pool._idle.get(('localhost', self.mediator.port), [])
+
+    def test_connection_is_reused(self):
+        assert self.client.get('/get_browser') == 'mocked'
+        assert 1 == len(self._idle())
+        _released_at, first = self._idle()[0]
+        assert self.client.get('/get_browser') == 'mocked'
+        assert [first] == [connection for _, connection in self._idle()]
+
+    def test_idle_connections_are_evicted(self):
+        pool = ConnectionPool(max_size=2, idle_timeout=0.0)
+        client = HttpClient(port=self.mediator.port, pool=pool)
+        client.get('/get_browser')
+        _connection, reused = pool.acquire('localhost', self.mediator.port, 1.0)
+        assert not reused
+        pool.close()
+
+    def test_pool_size_is_bounded(self):
+        connections = [self.pool.acquire('localhost', self.mediator.port, 1.0)[0]
+                       for _ in range(3)]
+        for connection in connections:
+            connection.connect()
+            self.pool.release(connection)
+        assert 2 == len(self._idle())
+        assert connections[2].sock is None
+
+    def test_retry_when_server_dropped_connection(self):
+        self.client.get('/get_browser')
+        server = self.mediator.server.http_server
+        for connection in list(server._connections):
+            connection.shutdown(socket.SHUT_RDWR)
+        assert self.client.get('/get_browser') == 'mocked'
+
+
+    def test_sent_request_is_retried_only_if_idempotent(self):
+        pool = DroppingPool()
+        client = HttpClient(port=self.mediator.port, pool=pool)
+        # the mediator might have got the POST, a second open_urls would
+        # open the tabs twice
+        with self.assertRaises(RemoteDisconnected):
+            client.post_json('/open_urls', {'urls': ['https://example.com']})
+        assert 1 == pool.requests
+        with self.assertRaises(RemoteDisconnected):
+            client.get('/get_browser')
+        assert 3 == pool.requests
+
+
+class DroppingConnection:
+    def __init__(self, pool):
+        self._pool = pool
+
+    def request(self, method, path, body=None, headers=None):
+        self._pool.requests += 1
+
+    def getresponse(self):
+        raise RemoteDisconnected('Remote end closed connection without response')
+
+    def close(self):
+        pass
+
+
+class DroppingPool:
+    """Every request goes out in full, the reply never comes."""
+
+    def __init__(self):
+        self.requests = 0
+        # whether the connections it hands out have been used before
+        self._reused = [True, True, False]
+
+    def acquire(self, host, port, timeout):
+        return DroppingConnection(self), self._reused.pop(0)
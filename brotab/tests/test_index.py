@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import tracemalloc
+from unittest import TestCase
+from uuid import uuid4
+
+from brotab.const import UNCHANGED_MARKER
+from brotab.files import in_temp_dir
+from brotab.search.index import IndexStats
+from brotab.search.index import index
+from brotab.search.index import index_lines
+from brotab.search.index import text_hashes
+from brotab.search.query import query
+from brotab.tests.utils import assert_file_absent
+from brotab.tests.utils import assert_sqlite3_table_contents
+
+
+class TestIncrementalIndex(TestCase):
+    def setUp(self):
+        self.sqlite_filename = in_temp_dir(uuid4().hex + '.sqlite')
+        assert_file_absent(self.sqlite_filename)
+        self.lines = [
+            ('a.1.1', 'title1', 'url1', 'first body'),
+            ('a.1.2', 'title2', 'url2', 'second body'),
+        ]
+        assert IndexStats(2, 0, 0, 0) == index_lines(self.sqlite_filename, self.lines)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            assert_file_absent(self.sqlite_filename + suffix)
+
+    def test_unchanged(self):
+        assert IndexStats(0, 0, 0, 2) == index_lines(self.sqlite_filename, self.lines)
+        assert_sqlite3_table_contents(
+            self.sqlite_filename, 'tabs',
+            'a.1.1\ttitle1\turl1\tfirst body\na.1.2\ttitle2\turl2\tsecond body')
+
+    def test_insert_update_delete(self):
+        lines = [
+            ('a.1.2', 'title2', 'url2', 'changed body'),
+            ('a.1.3', 'title3', 'url3', 'third body'),
+        ]
+        assert IndexStats(1, 1, 1, 0) == index_lines(self.sqlite_filename, lines)
+        assert_sqlite3_table_contents(
+            self.sqlite_filename, 'tabs',
+            'a.1.2\ttitle2\turl2\tchanged body\na.1.3\ttitle3\turl3\tthird body')
+        assert ['a.1.2'] == [result.tab_id for result in query(self.sqlite_filename, 'changed')]
+        assert [] == query(self.sqlite_filename, 'first')
+
+    def test_new_url_in_same_tab_replaces_row(self):
+        lines = [('a.1.1', 'title1', 'url1-new', 'first body'), self.lines[1]]
+        assert IndexStats(1, 0, 1, 1) == index_lines(self.sqlite_filename, lines)
+
+    def test_full_rebuild(self):
+        assert IndexStats(2, 0, 0, 0) == index_lines(self.sqlite_filename, self.lines, full=True)
+
+    def test_index_without_meta_is_rebuilt(self):
+        conn = sqlite3.connect(self.sqlite_filename)
+        conn.execute('drop table tabs_meta;')
+        conn.commit()
+        conn.close()
+        assert IndexStats(2, 0, 0, 0) == index_lines(self.sqlite_filename, self.lines)
+
+    def test_unchanged_marker_reuses_indexed_text(self):
+        lines = [self.lines[0] + ('hash1',), self.lines[1] + ('hash2',)]
+        assert IndexStats(0, 0, 0, 2) == index_lines(self.sqlite_filename, lines)
+        assert {'a.1.1': 'hash1', 'a.1.2': 'hash2'} == text_hashes(self.sqlite_filename)
+        lines = [
+            ('a.1.1', 'new title', 'url1-new', UNCHANGED_MARKER),
+            ('a.1.2', 'title2', 'url2', UNCHANGED_MARKER),
+            # not in the index, the browser shouldn't have sent the marker
+            ('a.1.3', 'title3', 'url3', UNCHANGED_MARKER),
+        ]
+        assert IndexStats(1, 0, 1, 1) == index_lines(self.sqlite_filename, lines)
+        assert_sqlite3_table_contents(
+            self.sqlite_filename, 'tabs',
+            'a.1.2\ttitle2\turl2\tsecond body\na.1.1\tnew title\turl1-new\tfirst body')
+        assert {'a.1.1': 'hash1'} == text_hashes(self.sqlite_filename, {'a.1.1'})
+
+    def test_index_without_text_hash_is_migrated(self):
+        conn = sqlite3.connect(self.sqlite_filename)
+        conn.execute('create table old_meta as select tab_id, url, body_hash, tabs_rowid from tabs_meta;')
+        conn.execute('drop table tabs_meta;')
+        conn.execute('alter table old_meta rename to tabs_meta;')
+        conn.commit()
+        conn.close()
+        assert {} == text_hashes(self.sqlite_filename)
+        conn = sqlite3.connect(self.sqlite_filename)
+        columns = [row[1] for row in conn.execute('pragma table_info(tabs_meta);')]
+        conn.close()
+        assert 'text_hash' not in columns
+        lines = [self.lines[0] + ('hash1',), self.lines[1]]
+        assert IndexStats(0, 0, 0, 2) == index_lines(self.sqlite_filename, lines)
+        assert {'a.1.1': 'hash1'} == text_hashes(self.sqlite_filename)
+
+
+def write_tsv(filename, size, body_size=32768):
+    """Write a tsv file of about `size` bytes, return the number of rows."""
+    body = ' '.join('word%d' % i for i in range(body_size // 8))[:body_size]
+    rows = 0
+    with open(filename, 'w', encoding='utf-8') as file_:
+        while file_.tell() < size:
+            file_.write('a.1.%d\ttitle %d\thttps://example.com/%d\t%s %d\n' % (
+                rows, rows, rows, body, rows))
+            rows += 1
+    return rows
+
+
+class TestStreamingIndex(TestCase):
+    # Python memory used by indexing must stay under this no matter how large
+    # the file is. Generate a 1 GB file with:
+    #     BROTAB_TEST_TSV_SIZE=1073741824 pytest brotab/tests/test_index.py
+    MEMORY_CEILING = 20 * 1024 * 1024
+    TSV_SIZE = int(os.environ.get('BROTAB_TEST_TSV_SIZE', 40 * 1024 * 1024))
+
+    def setUp(self):
+        name = uuid4().hex
+        self.sqlite_filename = in_temp_dir(name + '.sqlite')
+        self.tsv_filename = in_temp_dir(name + '.tsv')
+
+    def tearDown(self):
+        for filename in (self.tsv_filename, self.sqlite_filename,
+                         self.sqlite_filename + '-wal', self.sqlite_filename + '-shm'):
+            assert_file_absent(filename)
+
+    def test_memory_ceiling(self):
+        rows = write_tsv(self.tsv_filename, self.TSV_SIZE)
+        tracemalloc.start()
+        try:
+            stats = index(self.sqlite_filename, self.tsv_filename)
+            _current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert IndexStats(rows, 0, 0, 0) == stats
+        assert peak < self.MEMORY_CEILING, \
+            'peak %s bytes indexing %s bytes' % (peak, self.TSV_SIZE)
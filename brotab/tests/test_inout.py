@@ -1,8 +1,11 @@
 import os
+import socket
 from unittest import TestCase
 from unittest.mock import patch
 
 from brotab.inout import edit_tabs_in_editor
+from brotab.inout import get_available_tcp_port
+from brotab.inout import probe_ports
 
 
 class TestEditor(TestCase):
@@ -32,3 +35,19 @@ class TestEditor(TestCase):
         editor, filename = _run_editor_mock.call_args[0]
         assert editor == 'custom'
         assert not os.path.exists(filename)
+
+
+class TestProbePorts(TestCase):
+    def test_probe_ports(self):
+        listening = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listening.bind(('127.0.0.1', 0))
+        listening.listen(1)
+        port = listening.getsockname()[1]
+        closed_port = get_available_tcp_port(start=port + 1)
+        try:
+            result = probe_ports([('127.0.0.1', closed_port),
+                                  ('127.0.0.1', port),
+                                  ('no-such-host.invalid', port)])
+        finally:
+            listening.close()
+        assert [False, True, False] == result
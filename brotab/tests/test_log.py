@@ -0,0 +1,66 @@
+import logging
+import logging.handlers
+from queue import SimpleQueue
+from unittest import TestCase
+from unittest.mock import patch
+
+from brotab.mediator import log
+from brotab.mediator.log import payload
+
+
+class TestPayload(TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('brotab')
+        self.level = self.logger.level
+
+    def tearDown(self):
+        self.logger.setLevel(self.level)
+
+    def test_only_size_at_info(self):
+        self.logger.setLevel(logging.INFO)
+        assert '<list, 3 items>' == str(payload(['a', 'b', 'c']))
+        assert '<str, 5 chars>' == str(payload('hello'))
+        assert '<bytes, 2 bytes>' == str(payload(b'hi'))
+        assert '<NoneType>' == str(payload(None))
+
+    def test_preview_at_debug(self):
+        self.logger.setLevel(logging.DEBUG)
+        assert "<list, 2 items> ['a', 'b']" == str(payload(['a', 'b']))
+        text = str(payload('x' * (log.LARGE_PAYLOAD - 1)))
+        assert text.startswith('<str, %d chars> ' % (log.LARGE_PAYLOAD - 1))
+        assert len(text) < 2 * log.LOG_PREVIEW
+
+    def test_large_payloads_are_sampled(self):
+        self.logger.setLevel(logging.DEBUG)
+        large = ['line'] * log.LARGE_PAYLOAD
+        with patch.object(log, 'LOG_SAMPLE', 10):
+            previews = [str(payload(large)) for _ in range(100)]
+        assert 10 == sum(len(text) > len('<list, %d items>' % len(large)) for text in previews)
+
+    def test_level_from_env(self):
+        with patch.dict('os.environ', {'LOG_LEVEL': 'debug'}):
+            assert logging.DEBUG == log.log_level()
+        with patch.dict('os.environ', {'LOG_LEVEL': 'nonsense'}):
+            assert logging.INFO == log.log_level()
+
+    def test_bad_numbers_from_env(self):
+        with patch.dict('os.environ', {'LOG_PREVIEW': '50'}):
+            assert 50 == log._positive_int_from_env('LOG_PREVIEW', 200)
+        for value in ['many', '-1', '0']:
+            with patch.dict('os.environ', {'LOG_PREVIEW': value}):
+                assert 200 == log._positive_int_from_env('LOG_PREVIEW', 200)
+
+
+class TestListeners(TestCase):
+    def test_new_listener_after_fork(self):
+        queue = SimpleQueue()
+        handler = logging.handlers.BufferingHandler(10)
+        listener = logging.handlers.QueueListener(queue, handler)
+        with patch.object(log, '_listeners', [listener]):
+            log._restart_listeners()
+            restarted = log._listeners[0]
+            assert restarted is not listener
+            logging.handlers.QueueHandler(queue).handle(
+                logging.makeLogRecord({'msg': 'after fork'}))
+            restarted.stop()
+        assert ['after fork'] == [record.getMessage() for record in handler.buffer]
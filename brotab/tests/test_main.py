@@ -1,11 +1,22 @@
+import json
+import os
+import socket
+from io import StringIO
 from string import ascii_letters
+from threading import Condition
+from threading import Event
+from threading import Timer
+from time import monotonic
 from time import sleep
 from typing import List
 from unittest import TestCase
 from unittest.mock import patch
+from urllib.error import HTTPError
 from uuid import uuid4
 
 from brotab.api import SingleMediatorAPI
+from brotab.const import UNCHANGED_MARKER
+from brotab.discovery import discover_mediators
 from brotab.env import http_iface
 from brotab.env import min_http_port
 from brotab.files import in_temp_dir
@@ -14,22 +25,42 @@ from brotab.inout import get_available_tcp_port
 from brotab.main import create_clients
 from brotab.main import run_commands
 from brotab.mediator.http_server import MediatorHttpServer
+from brotab.mediator.registry import make_entry
 from brotab.mediator.remote_api import default_remote_api
+from brotab.mediator.transport import ReplyTimeoutError
 from brotab.mediator.transport import Transport
+from brotab.mediator.transport import TransportError
+from brotab.search.index import index_lines
+from brotab.search.index import text_hashes
+from brotab.tab import parse_tab_lines
+from brotab.tab import tab_columns
+from brotab.tests.test_tab_model import make_tab
 from brotab.tests.utils import assert_file_absent
 from brotab.tests.utils import assert_file_contents
 from brotab.tests.utils import assert_file_not_empty
 from brotab.tests.utils import assert_sqlite3_table_contents
+from brotab.utils import text_hash
 
 
 class MockedLoggingTransport(Transport):
+    """
+    Pretends to be the browser extension: every command that expects a reply
+    gets the next canned reply (None if there are no more), wrapped together
+    with the id of the command. Commands are logged without their ids.
+    """
+
     def __init__(self):
         self._sent = []
         self._received = []
+        self._ids = []
+        self._closed = False
+        self._condition = Condition()
 
     def reset(self):
-        self._sent = []
-        self._received = []
+        with self._condition:
+            self._sent = []
+            self._received = []
+            self._ids = []
 
     @property
     def sent(self):
@@ -40,18 +71,31 @@ class MockedLoggingTransport(Transport):
         return self._received
 
     def received_extend(self, values) -> None:
-        for value in values:
-            self._received.append(value)
+        with self._condition:
+            for value in values:
+                self._received.append(value)
+            self._condition.notify_all()
 
     def send(self, message) -> None:
-        self._sent.append(message)
+        message = dict(message)
+        with self._condition:
+            if 'id' in message:
+                self._ids.append(message.pop('id'))
+            self._sent.append(message)
+            self._condition.notify_all()
 
     def recv(self):
-        if self._received:
-            return self._received.pop(0)
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or self._ids)
+            if self._closed:
+                raise TransportError('MockedLoggingTransport is closed')
+            result = self._received.pop(0) if self._received else None
+            return {'id': self._ids.pop(0), 'result': result}
 
     def close(self):
-        pass
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
 
 
 class MockedMediator:
@@ -69,6 +113,7 @@ class MockedMediator:
     def join(self):
         self.server.shutdown()
         self.thread.join()
+        self.transport.close()
 
     def __enter__(self):
         return self
@@ -88,6 +133,12 @@ class DummyBrowserRemoteAPI:
     def query_tabs(self, query_info: str):
         raise NotImplementedError()
 
+    def list_tab_columns(self):
+        return tab_columns(self.list_tabs())
+
+    def query_tab_columns(self, query_info: str):
+        return tab_columns(self.query_tabs(query_info))
+
     def move_tabs(self, move_triplets: str):
         raise NotImplementedError()
 
@@ -106,13 +157,15 @@ class DummyBrowserRemoteAPI:
     def get_active_tabs(self) -> str:
         return '1.1'
 
-    def get_words(self, tab_id, match_regex, join_with):
+    def get_words(self, tab_id, match_regex, join_with, concurrency=None, timeout=None, tab_ids=None):
         return ['a', 'b']
 
-    def get_text(self, delimiter_regex, replace_with):
+    def get_text(self, delimiter_regex, replace_with, tab_ids=None, window_ids=None,
+                 concurrency=None, timeout=None, stream=False, hashes=None):
         return ['1.1\ttitle\turl\tbody']
 
-    def get_html(self, delimiter_regex, replace_with):
+    def get_html(self, delimiter_regex, replace_with, tab_ids=None, window_ids=None,
+                 concurrency=None, timeout=None, stream=False, hashes=None):
         return ['1.1\ttitle\turl\t<body>some body</body>']
 
     def get_browser(self):
@@ -183,6 +236,31 @@ class TestCreateClients(WithMediator):
         assert 1 == len(clients)
         assert self.mediator.port == clients[0]._port
 
+    def test_clients_from_registry(self):
+        entry = make_entry('127.0.0.1', self.mediator.port, 'firefox')
+        with patch('brotab.main.get_mediator_ports') as mocked_ports, \
+                patch('brotab.main.read_mediator_registry') as mocked_registry:
+            mocked_ports.side_effect = [range(self.mediator.port - 1, self.mediator.port + 1)]
+            mocked_registry.side_effect = [[entry]]
+            clients = create_clients()
+        assert 1 == len(clients)
+        assert 'b.' == clients[0]._prefix
+        assert self.mediator.port == clients[0]._port
+        assert 'firefox' == clients[0].browser
+        assert [] == self.mediator.transport.sent
+
+    def test_mediators_missing_from_registry_are_scanned(self):
+        # a mediator on the port before is published, this one isn't
+        entry = make_entry('127.0.0.1', self.mediator.port - 1, 'chrome')
+        with patch('brotab.main.get_mediator_ports') as mocked_ports, \
+                patch('brotab.main.read_mediator_registry') as mocked_registry:
+            mocked_ports.side_effect = [range(self.mediator.port - 1, self.mediator.port + 1)]
+            mocked_registry.side_effect = [[entry]]
+            clients = create_clients()
+        assert ['a.', 'b.'] == [client._prefix for client in clients]
+        assert 'chrome' == clients[0].browser
+        assert self.mediator.port == clients[1]._port
+
     def test_one_custom_target_hosts(self):
         clients = create_clients('127.0.0.1:%d' % self.mediator.port)
         assert 1 == len(clients)
@@ -195,6 +273,25 @@ class TestCreateClients(WithMediator):
         assert self.mediator.port == clients[0]._port
         assert self.mediator.port == clients[1]._port
 
+    def test_unresponsive_mediator_does_not_block_discovery(self):
+        # accepts connections but never replies
+        silent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(8)
+        silent_port = silent.getsockname()[1]
+        self.mediator.transport.received_extend(['mocked'])
+        try:
+            start = monotonic()
+            clients = discover_mediators(['a', 'b'], ['127.0.0.1', '127.0.0.1'],
+                                         [self.mediator.port, silent_port], timeout=0.5)
+            delta = monotonic() - start
+        finally:
+            silent.close()
+        assert delta < 1.0
+        assert ['a.', 'b.'] == [client._prefix for client in clients]
+        assert clients[0].ready
+        assert not clients[1].ready
+
 
 class TestActivate(WithMediator):
     def test_activate_ok(self):
@@ -212,7 +309,121 @@ class TestActivate(WithMediator):
         ]
 
 
+class TestListTabsDelta(WithMediator):
+    def test_without_tab_model(self):
+        self.mediator.transport.received_extend(['mocked', ['1.1\ttitle1\turl1', '2.2\ttitle2\turl2']])
+        api = create_clients('127.0.0.1:%d' % self.mediator.port)[0]
+        delta = api.list_tabs_delta()
+        assert {'version': 0, 'full': True, 'removed': [], 'changed': [
+            {'tab': 'a.1.1\ttitle1\turl1', 'index': 0, 'status': None},
+            {'tab': 'a.2.2\ttitle2\turl2', 'index': 0, 'status': None},
+        ]} == delta
+
+    def test_changes_since_version(self):
+        tab_model = self.mediator.remote_api.tab_model
+        tab_model.apply_event({'event': 'tab_snapshot', 'tabs': [
+            make_tab(1, 1, 0), make_tab(2, 1, 1, status='complete')]})
+        self.mediator.transport.received_extend(['mocked'])
+        api = create_clients('127.0.0.1:%d' % self.mediator.port)[0]
+        version = api.list_tabs_delta()['version']
+        tab_model.apply_event({'event': 'tab_removed', 'tab_id': 1})
+        assert {'version': version + 1, 'full': False, 'removed': ['a.1.1'], 'changed': [
+            {'tab': 'a.1.2\ttitle2\turl2', 'index': 0, 'status': 'complete'},
+        ]} == api.list_tabs_delta(version)
+
+    def test_wait_for_changes(self):
+        tab_model = self.mediator.remote_api.tab_model
+        tab_model.apply_event({'event': 'tab_snapshot', 'tabs': [make_tab(1, 1, 0)]})
+        self.mediator.transport.received_extend(['mocked'])
+        api = create_clients('127.0.0.1:%d' % self.mediator.port)[0]
+        version = api.list_tabs_delta()['version']
+        assert [] == api.list_tabs_delta(version, wait=0.05)['changed']
+
+        timer = Timer(0.1, tab_model.apply_event,
+                      [{'event': 'tab_updated', 'tab': make_tab(1, 1, 0, title='new')}])
+        timer.start()
+        delta = api.list_tabs_delta(version, wait=5.0)
+        timer.join()
+        assert ['a.1.1\tnew\turl1'] == [change['tab'] for change in delta['changed']]
+
+    def test_malformed_version_is_rejected(self):
+        api = create_clients('127.0.0.1:%d' % self.mediator.port)[0]
+        for path in ['/list_tabs?since=abc', '/list_tabs?since=-1', '/list_tabs?since=1&wait=soon']:
+            with self.assertRaises(HTTPError) as error:
+                api._client.get(path)
+            assert 400 == error.exception.code
+        self.mediator.transport.received_extend(['mocked'])
+        assert 'mocked' == api._client.get('/get_browser')
+
+
+class TestTabRecords(WithMediator):
+    def test_list_tab_records(self):
+        lines = ['1.1\ttitle1\turl1', '2.2\ttitle2\turl2']
+        self.mediator.transport.received_extend(['mocked', lines, lines])
+        api = create_clients('127.0.0.1:%d' % self.mediator.port)[0]
+        assert parse_tab_lines(['a.1.1\ttitle1\turl1']) == api.list_tab_records(['1'])
+        assert parse_tab_lines(['a.' + line for line in lines]) == api.list_tab_records([])
+
+    def test_query_tab_records_from_tab_model(self):
+        self.mediator.remote_api.tab_model.apply_event({'event': 'tab_snapshot', 'tabs': [
+            make_tab(1, 1, 0), make_tab(2, 1, 1, active=True)]})
+        self.mediator.transport.received_extend(['mocked'])
+        api = create_clients('127.0.0.1:%d' % self.mediator.port)[0]
+        assert parse_tab_lines(['a.1.2\ttitle2\turl2']) == api.query_tab_records('{"active": true}')
+
+    def test_mediator_without_columns(self):
+        self.mediator.transport.received_extend(['mocked'])
+        api = create_clients('127.0.0.1:%d' % self.mediator.port)[0]
+        # what a mediator replies if it ignores the Accept header
+        assert parse_tab_lines(['a.1.1\ttitle1\turl1']) == api._tab_records('1.1\ttitle1\turl1', 10)
+
+
+class TestWords(WithMediator):
+    def test_words_of_many_tabs_in_one_request(self):
+        self.mediator.transport.received_extend([
+            'mocked',
+            ['a', 'b', 'c'],
+        ])
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            self._run_commands(['words', 'a.1.2', 'a.1.3', 'b.1.4'])
+        self._assert_init()
+        assert self.mediator.transport.sent == [
+            {'name': 'get_words', 'tab_id': None, 'match_regex': '/\\w+/g', 'join_with': '"\\n"',
+             'tab_ids': [2, 3]},
+        ]
+        assert stdout.getvalue() == 'a\nb\nc\n'
+
+    def test_words_of_other_mediator_tabs_are_not_requested(self):
+        self.mediator.transport.received_extend(['mocked'])
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            self._run_commands(['words', 'b.1.4'])
+        self._assert_init()
+        assert self.mediator.transport.sent == []
+        assert stdout.getvalue() == '\n'
+
+    def test_malformed_tab_id_is_reported(self):
+        with patch('sys.stderr', new_callable=StringIO) as stderr:
+            assert 1 == self._run_commands(['words', 'a.1.2', 'a.1.x'])
+        assert 'Invalid tab or window id: a.1.x\n' == stderr.getvalue()
+        assert self.mediator.transport.sent == []
+
+
 class TestText(WithMediator):
+    def test_malformed_arguments_are_rejected(self):
+        api = SingleMediatorAPI('a', port=self.mediator.port, pid=1, browser='mocked')
+        for path in ['/get_text?tab_ids=1,x', '/get_html?window_ids=-1', '/get_words?tab_ids=a',
+                     '/get_text?concurrency=many', '/get_text?concurrency=0',
+                     '/get_html?timeout=-1', '/get_words?timeout=nan']:
+            with self.assertRaises(HTTPError) as error:
+                api._client.get(path)
+            assert 400 == error.exception.code
+        with self.assertRaises(ValueError):
+            api.get_text([], 'delimiter', 'replace', ['a.1.x'])
+        self.mediator.transport.received_extend(['mocked'])
+        assert 'mocked' == api._client.get('/get_browser')
+
     def test_text_no_arguments_ok(self):
         self.mediator.transport.received_extend([
             'mocked',
@@ -224,7 +435,7 @@ class TestText(WithMediator):
             self._run_commands(['text'])
         self._assert_init()
         assert self.mediator.transport.sent == [
-            {'delimiter_regex': '/\\n|\\r|\\t/g', 'name': 'get_text', 'replace_with': '" "'},
+            {'delimiter_regex': '/\\n|\\r|\\t/g', 'name': 'get_text', 'replace_with': '" "', 'stream': True},
         ]
         assert output == [b'a.1.1\ttitle\turl\tbody\n']
 
@@ -243,9 +454,138 @@ class TestText(WithMediator):
             self._run_commands(['text', 'a.1.2', 'a.1.3'])
         self._assert_init()
         assert self.mediator.transport.sent == [
-            {'delimiter_regex': '/\\n|\\r|\\t/g', 'name': 'get_text', 'replace_with': '" "'},
+            {'delimiter_regex': '/\\n|\\r|\\t/g', 'name': 'get_text', 'replace_with': '" "',
+             'tab_ids': [2, 3], 'stream': True},
+        ]
+        assert output == [b'a.1.2\ttitle\turl\tbody\n', b'a.1.3\ttitle\turl\tbody\n']
+
+    def test_text_with_window_id_ok(self):
+        self.mediator.transport.received_extend([
+            'mocked',
+            [
+                '1.1\ttitle\turl\tbody',
+                '2.2\ttitle\turl\tbody',
+            ],
+        ])
+
+        output = []
+        with patch('brotab.main.stdout_buffer_write', output.append):
+            self._run_commands(['text', 'a.1.2', 'a.2'])
+        self._assert_init()
+        assert self.mediator.transport.sent == [
+            {'delimiter_regex': '/\\n|\\r|\\t/g', 'name': 'get_text', 'replace_with': '" "',
+             'tab_ids': [2], 'window_ids': [2], 'stream': True},
         ]
-        assert output == [b'a.1.2\ttitle\turl\tbody\na.1.3\ttitle\turl\tbody\n']
+        assert output == [b'a.2.2\ttitle\turl\tbody\n']
+
+    def test_text_with_script_options(self):
+        self.mediator.transport.received_extend(['mocked', ['1.1\ttitle\turl\tbody']])
+
+        output = []
+        with patch('brotab.main.stdout_buffer_write', output.append):
+            self._run_commands(['text', '--concurrency', '2', '--script-timeout', '1.5'])
+        self._assert_init()
+        assert self.mediator.transport.sent == [
+            {'delimiter_regex': '/\\n|\\r|\\t/g', 'name': 'get_text', 'replace_with': '" "',
+             'concurrency': 2, 'timeout': 1.5, 'stream': True},
+        ]
+        assert output == [b'a.1.1\ttitle\turl\tbody\n']
+
+    def test_text_with_tab_id_of_other_mediator(self):
+        self.mediator.transport.received_extend(['mocked'])
+
+        output = []
+        with patch('brotab.main.stdout_buffer_write', output.append):
+            self._run_commands(['text', 'b.1.2'])
+        self._assert_init()
+        assert self.mediator.transport.sent == []
+        assert output == [b'\n']
+
+
+class TestStats(WithMediator):
+    def test_script_stats(self):
+        self.mediator.transport.received_extend(['mocked'])
+        api = create_clients('127.0.0.1:%d' % self.mediator.port)[0]
+        self.mediator.remote_api._on_event({'event': 'script_stats', 'stats': {
+            'command': 'get_text', 'tabs': 3, 'concurrency': 2, 'timeout': 5000,
+            'failed': 1, 'timed_out': 1, 'elapsed': 120,
+            'timings': [[1, 10, 'ok'], [2, 5, 'error'], [3, 100, 'timeout']],
+        }})
+        stats = api.get_stats()['scripts']['get_text']
+        assert {'runs': 1, 'tabs': 3, 'failed': 1, 'timed_out': 1, 'cached': 0,
+                'elapsed': 120} == stats['totals']
+        assert [[3, 100, 'timeout'], [1, 10, 'ok'], [2, 5, 'error']] == stats['last']['slowest']
+
+    def test_script_cache_stats(self):
+        self.mediator.transport.received_extend(['mocked'])
+        api = create_clients('127.0.0.1:%d' % self.mediator.port)[0]
+        assert api.get_stats()['script_cache'] is None
+        cache = {'hits': 2, 'misses': 1, 'evictions': 0, 'entries': 1,
+                 'size': 100, 'max_size': 1000}
+        self.mediator.remote_api._on_event({'event': 'script_stats', 'stats': {
+            'command': 'get_text', 'tabs': 3, 'cached': 2, 'timings': [], 'cache': cache}})
+        stats = api.get_stats()
+        assert cache == stats['script_cache']
+        assert 2 == stats['scripts']['get_text']['totals']['cached']
+        assert 'cache' not in stats['scripts']['get_text']['last']
+
+        self.mediator.transport.received_extend(['mocked'])
+        output = []
+        with patch('brotab.main.stdout_buffer_write', output.append):
+            self._run_commands(['stats'])
+        assert {'a': stats} == json.loads(b''.join(output))
+
+
+class StreamingRemoteAPI(DummyBrowserRemoteAPI):
+    """Sends the second line only after the client has received the first."""
+
+    def __init__(self):
+        self.first_received = Event()
+
+    def get_text(self, delimiter_regex, replace_with, tab_ids=None, window_ids=None,
+                 concurrency=None, timeout=None, stream=False, hashes=None):
+        assert stream
+        yield '1.1\ttitle\turl\tfirst'
+        assert self.first_received.wait(timeout=5.0)
+        yield '1.2\ttitle\turl\tsecond'
+
+
+class TestStreaming(TestCase):
+    def setUp(self):
+        self.remote_api = StreamingRemoteAPI()
+        self.mediator = MockedMediator('a', remote_api=self.remote_api)
+
+    def tearDown(self):
+        self.mediator.join()
+
+    def test_lines_arrive_before_response_is_complete(self):
+        api = SingleMediatorAPI('a', port=self.mediator.port, pid=1, browser='mocked')
+        lines = api.iter_text('delimiter', 'replace')
+        assert 'a.1.1\ttitle\turl\tfirst' == next(lines)
+        self.remote_api.first_received.set()
+        assert ['a.1.2\ttitle\turl\tsecond'] == list(lines)
+
+
+class SilentRemoteAPI(DummyBrowserRemoteAPI):
+    """The browser never replies to list_tabs."""
+
+    def list_tabs(self):
+        raise ReplyTimeoutError('No reply from the browser in 60.0 seconds')
+
+
+class TestReplyTimeout(TestCase):
+    def setUp(self):
+        self.mediator = MockedMediator('a', remote_api=SilentRemoteAPI())
+
+    def tearDown(self):
+        self.mediator.join()
+
+    def test_timeout_fails_only_the_request(self):
+        api = SingleMediatorAPI('a', port=self.mediator.port, pid=1, browser='mocked')
+        with self.assertRaises(HTTPError) as error:
+            api._client.get('/list_tabs')
+        assert 504 == error.exception.code
+        assert 'mocked' == api._client.get('/get_browser')
 
 
 class TestHtml(WithMediator):
@@ -260,7 +600,7 @@ class TestHtml(WithMediator):
             self._run_commands(['html'])
         self._assert_init()
         assert self.mediator.transport.sent == [
-            {'delimiter_regex': '/\\n|\\r|\\t/g', 'name': 'get_html', 'replace_with': '" "'},
+            {'delimiter_regex': '/\\n|\\r|\\t/g', 'name': 'get_html', 'replace_with': '" "', 'stream': True},
         ]
         assert output == [b'a.1.1\ttitle\turl\tbody\n']
 
@@ -279,9 +619,10 @@ class TestHtml(WithMediator):
             self._run_commands(['html', 'a.1.2', 'a.1.3'])
         self._assert_init()
         assert self.mediator.transport.sent == [
-            {'delimiter_regex': '/\\n|\\r|\\t/g', 'name': 'get_html', 'replace_with': '" "'},
+            {'delimiter_regex': '/\\n|\\r|\\t/g', 'name': 'get_html', 'replace_with': '" "',
+             'tab_ids': [2, 3], 'stream': True},
         ]
-        assert output == [b'a.1.2\ttitle\turl\tbody\na.1.3\ttitle\turl\tbody\n']
+        assert output == [b'a.1.2\ttitle\turl\tbody\n', b'a.1.3\ttitle\turl\tbody\n']
 
 
 class TestIndex(WithMediator):
@@ -301,14 +642,56 @@ class TestIndex(WithMediator):
         self._assert_init()
         assert self.mediator.transport.sent == [
             {'delimiter_regex': '/\\n|\\r|\\t/g',
-             'name': 'get_text', 'replace_with': '" "'},
+             'name': 'get_text', 'replace_with': '" "', 'stream': True},
         ]
         assert_file_not_empty(sqlite_filename)
-        assert_file_not_empty(tsv_filename)
-        assert_file_contents(tsv_filename, 'a.1.1\ttitle\turl\tbody\n')
+        # text goes from the browser straight into the index
+        assert not os.path.isfile(tsv_filename)
         assert_sqlite3_table_contents(
             sqlite_filename, 'tabs', 'a.1.1\ttitle\turl\tbody')
 
+    def test_index_save_tsv(self):
+        self.mediator.transport.received_extend([
+            'mocked',
+            ['1.1\ttitle\turl\tbody  with   spaces'],
+        ])
+
+        sqlite_filename = in_temp_dir(uuid4().hex + '.sqlite')
+        tsv_filename = in_temp_dir(uuid4().hex + '.tsv')
+        assert_file_absent(tsv_filename)
+        self._run_commands(
+            ['index', '--sqlite', sqlite_filename, '--save-tsv', tsv_filename])
+        assert_file_contents(tsv_filename, 'a.1.1\ttitle\turl\tbody with spaces\n')
+        assert_sqlite3_table_contents(
+            sqlite_filename, 'tabs', 'a.1.1\ttitle\turl\tbody with spaces')
+        assert_file_absent(sqlite_filename)
+        assert_file_absent(tsv_filename)
+
+    def test_index_sends_hashes_of_indexed_text(self):
+        sqlite_filename = in_temp_dir(uuid4().hex + '.sqlite')
+        index_lines(sqlite_filename, [
+            ('a.1.1', 'title', 'url', 'body', text_hash('raw  body')),
+            ('a.1.2', 'title', 'url', 'old body', text_hash('old  body')),
+        ])
+        self.mediator.transport.received_extend([
+            'mocked',
+            ['1.1\tnew title\turl\t' + UNCHANGED_MARKER, '1.2\ttitle\turl\tnew  body'],
+        ])
+
+        self._run_commands(['index', '--sqlite', sqlite_filename])
+        self._assert_init()
+        assert self.mediator.transport.sent == [
+            {'delimiter_regex': '/\\n|\\r|\\t/g', 'name': 'get_text', 'replace_with': '" "',
+             'stream': True,
+             'hashes': {'1': text_hash('raw  body'), '2': text_hash('old  body')}},
+        ]
+        assert_sqlite3_table_contents(
+            sqlite_filename, 'tabs', 'a.1.1\tnew title\turl\tbody\na.1.2\ttitle\turl\tnew body')
+        assert {'a.1.1': text_hash('raw  body'), 'a.1.2': text_hash('new  body')} == \
+            text_hashes(sqlite_filename)
+        for suffix in ('', '-wal', '-shm'):
+            assert_file_absent(sqlite_filename + suffix)
+
     def test_index_custom_filename(self):
         self.mediator.transport.received_extend([
             'mocked',
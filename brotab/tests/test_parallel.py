@@ -0,0 +1,176 @@
+import asyncio
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from brotab import parallel
+from brotab.api import MultipleMediatorsAPI
+from brotab.const import DEFAULT_MEDIATOR_TIMEOUT
+from brotab.env import mediator_timeout
+from brotab.parallel import call_parallel
+from brotab.parallel import merge_async_iterators
+from brotab.parallel import merge_iterators
+from brotab.parallel import scatter_gather
+from brotab.parallel import scatter_gather_async
+
+
+class FakeMediatorAPI:
+    ready = True
+
+    def __init__(self, prefix, delay=0.0, error=None):
+        self.prefix = prefix
+        self._delay = delay
+        self._error = error
+
+    def list_tabs_safe(self, args, print_error=False):
+        time.sleep(self._delay)
+        if self._error is not None:
+            raise self._error
+        return ['%s.1.1\ttitle\turl' % self.prefix]
+
+    def get_stats(self):
+        if self._error is not None:
+            raise self._error
+        return {'scripts': {}}
+
+    def __str__(self):
+        return self.prefix
+
+
+class TestScatterGather(TestCase):
+    def test_results_are_in_order_of_apis(self):
+        apis = [FakeMediatorAPI('a', delay=0.1), FakeMediatorAPI('b')]
+        results = scatter_gather(apis, lambda api: api.list_tabs_safe([]))
+        assert [['a.1.1\ttitle\turl'], ['b.1.1\ttitle\turl']] == [result.value for result in results]
+        assert [None, None] == [result.error for result in results]
+        assert results[0].elapsed >= 0.1
+
+    def test_slow_and_failing_apis_keep_partial_results(self):
+        apis = [FakeMediatorAPI('a', delay=1.0), FakeMediatorAPI('b', error=OSError('down')),
+                FakeMediatorAPI('c')]
+        start = time.monotonic()
+        results = scatter_gather(apis, lambda api: api.list_tabs_safe([]), timeout=0.2)
+        assert time.monotonic() - start < 0.9
+        assert isinstance(results[0].error, TimeoutError)
+        assert 0.2 == results[0].elapsed
+        assert isinstance(results[1].error, OSError)
+        assert ['c.1.1\ttitle\turl'] == results[2].value
+
+    def test_no_apis(self):
+        assert [] == scatter_gather([], lambda api: api.prefix)
+
+
+def slow_lines(prefix, delay, count=2):
+    for i in range(count):
+        time.sleep(delay)
+        yield '%s%d' % (prefix, i)
+
+
+class TestMergeIterators(TestCase):
+    def test_lines_come_as_they_are_ready(self):
+        start = time.monotonic()
+        lines = list(merge_iterators([slow_lines('a', 0.3), slow_lines('b', 0.3)]))
+        assert time.monotonic() - start < 0.9
+        assert ['a0', 'a1', 'b0', 'b1'] == sorted(lines)
+        assert lines.index('a0') < lines.index('a1')
+
+    def test_error_comes_after_lines(self):
+        def failing():
+            yield 'x'
+            raise OSError('down')
+
+        lines = []
+        with self.assertRaises(OSError):
+            for line in merge_iterators([failing(), slow_lines('a', 0.5)]):
+                lines.append(line)
+        assert ['x'] == lines
+
+    def test_closed_merge_closes_iterators(self):
+        closed = threading.Event()
+
+        def endless():
+            try:
+                while True:
+                    yield 'x'
+            finally:
+                closed.set()
+
+        merged = merge_iterators([endless(), endless()], buffer_size=1)
+        assert 'x' == next(merged)
+        merged.close()
+        assert closed.wait(timeout=1.0)
+
+    def test_async(self):
+        async def lines(prefix, delay):
+            for i in range(2):
+                await asyncio.sleep(delay)
+                yield '%s%d' % (prefix, i)
+
+        async def merge():
+            return [line async for line in merge_async_iterators(
+                [lines('a', 0.3), lines('b', 0.3)])]
+
+        start = time.monotonic()
+        assert ['a0', 'a1', 'b0', 'b1'] == sorted(asyncio.run(merge()))
+        assert time.monotonic() - start < 0.9
+
+
+class TestWorkerPool(TestCase):
+    def test_threads_are_reused(self):
+        apis = [FakeMediatorAPI(prefix) for prefix in 'abc']
+        pool = parallel.executor()
+        for _ in range(200):
+            scatter_gather(apis, lambda api: api.prefix)
+        workers = [thread for thread in threading.enumerate()
+                   if thread.name.startswith('brotab-worker')]
+        assert 0 < len(workers) <= parallel.MAX_WORKERS
+        assert pool is parallel.executor()
+
+    def test_pool_is_recreated_after_shutdown(self):
+        pool = parallel.executor()
+        parallel.shutdown()
+        assert [1, 2] == call_parallel([lambda: 1, lambda: 2])
+        assert pool is not parallel.executor()
+
+
+class TestScatterGatherAsync(TestCase):
+    def test_functions_and_coroutines(self):
+        async def slow(api):
+            await asyncio.sleep(1.0)
+
+        apis = [FakeMediatorAPI('a'), FakeMediatorAPI('b', error=OSError('down'))]
+        results = asyncio.run(scatter_gather_async(apis, lambda api: api.list_tabs_safe([])))
+        assert ['a.1.1\ttitle\turl'] == results[0].value
+        assert isinstance(results[1].error, OSError)
+
+        results = asyncio.run(scatter_gather_async(apis[:1], slow, timeout=0.1))
+        assert isinstance(results[0].error, TimeoutError)
+
+
+class TestMultipleMediatorsAPI(TestCase):
+    def test_mediators_are_called_in_parallel(self):
+        api = MultipleMediatorsAPI([FakeMediatorAPI('a', delay=0.3), FakeMediatorAPI('b', delay=0.3)])
+        start = time.monotonic()
+        tabs = api.list_tabs([])
+        assert time.monotonic() - start < 0.55
+        assert ['a.1.1\ttitle\turl', 'b.1.1\ttitle\turl'] == tabs
+        assert ['a', 'b'] == sorted(api.latencies)
+
+    def test_slow_mediator_is_left_out(self):
+        api = MultipleMediatorsAPI([FakeMediatorAPI('a', delay=1.0), FakeMediatorAPI('b')],
+                                   timeout=0.2)
+        assert ['b.1.1\ttitle\turl'] == api.list_tabs([])
+
+    def test_failed_stats_are_reported(self):
+        api = MultipleMediatorsAPI([FakeMediatorAPI('a'), FakeMediatorAPI('b', error=OSError('down'))])
+        with patch('brotab.api.print') as print_:
+            assert {'a': {'scripts': {}}} == api.get_stats()
+        assert 'down' in print_.call_args[0][0]
+
+    def test_default_timeout(self):
+        with patch.dict('os.environ', {'MEDIATOR_TIMEOUT': '2.5'}):
+            assert 2.5 == mediator_timeout()
+        for value in ['', 'soon', '-1', 'nan', 'inf']:
+            with patch.dict('os.environ', {'MEDIATOR_TIMEOUT': value}):
+                assert DEFAULT_MEDIATOR_TIMEOUT == mediator_timeout()
@@ -0,0 +1,83 @@
+import os
+from threading import Thread
+from unittest import TestCase
+from uuid import uuid4
+
+from brotab.files import in_temp_dir
+from brotab.search.index import index_lines
+from brotab.search.query import QueryClient
+from brotab.search.query import QueryEngine
+from brotab.search.query import QueryResult
+from brotab.search.query import QueryServer
+from brotab.search.query import query
+from brotab.tests.utils import assert_file_absent
+
+
+class WithIndex(TestCase):
+    def setUp(self):
+        self.sqlite_filename = in_temp_dir(uuid4().hex + '.sqlite')
+        index_lines(self.sqlite_filename, [('a.1.1', 'title1', 'url1', 'first body')])
+        self.engine = QueryEngine(self.sqlite_filename)
+
+    def tearDown(self):
+        self.engine.close()
+        for suffix in ('', '-wal', '-shm'):
+            assert_file_absent(self.sqlite_filename + suffix)
+
+
+class TestQueryEngine(WithIndex):
+    def test_query(self):
+        assert [QueryResult('a.1.1', 'title1', '<b>first</b> body')] == \
+               self.engine.query('first')
+        assert [QueryResult('a.1.1', 'title1', '[first] body')] == \
+               self.engine.query('first', marker_start='[', marker_end=']')
+        assert 2 == len(self.engine._cache)
+
+    def test_cache_is_invalidated_by_update(self):
+        assert ['first body'] == self._bodies('body')
+        index_lines(self.sqlite_filename, [('a.1.1', 'title1', 'url1', 'second body')])
+        assert ['second body'] == self._bodies('body')
+
+    def test_replaced_index_is_reopened(self):
+        assert ['first body'] == self._bodies('body')
+        for suffix in ('', '-wal', '-shm'):
+            assert_file_absent(self.sqlite_filename + suffix)
+        index_lines(self.sqlite_filename, [('a.1.2', 'title2', 'url2', 'other body')])
+        assert ['other body'] == self._bodies('body')
+
+    def test_missing_index(self):
+        engine = QueryEngine(in_temp_dir(uuid4().hex + '.sqlite'))
+        assert [] == engine.query('first')
+        assert [] == query(engine.sqlite_filename, 'first')
+        assert not os.path.exists(engine.sqlite_filename)
+
+    def test_bad_query(self):
+        assert [] == self.engine.query('"unbalanced')
+
+    def _bodies(self, user_query):
+        return [result.snippet.replace('<b>', '').replace('</b>', '')
+                for result in self.engine.query(user_query)]
+
+
+class TestQueryServer(WithIndex):
+    def setUp(self):
+        super().setUp()
+        self.server = QueryServer(self.engine, in_temp_dir(uuid4().hex + '.sock'))
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        assert not os.path.exists(self.server.socket_path)
+        super().tearDown()
+
+    def test_query(self):
+        client = QueryClient(self.server.socket_path)
+        try:
+            assert [QueryResult('a.1.1', 'title1', '<b>first</b> body')] == client.query('first')
+            assert [QueryResult('a.1.1', 'title1', 'first <b>body</b>')] == client.query('body')
+            assert [] == client.query('first', unknown_option=1)
+        finally:
+            client.close()
@@ -0,0 +1,75 @@
+import os
+import time
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import psutil
+
+from brotab.mediator.registry import MediatorEntry
+from brotab.mediator.registry import make_entry
+from brotab.mediator.registry import publish
+from brotab.mediator.registry import read_entries
+from brotab.mediator.registry import registry_dir
+from brotab.mediator.registry import unpublish
+
+
+def dead_pid():
+    pid = 2 ** 22 - 1
+    while psutil.pid_exists(pid):
+        pid -= 1
+    return pid
+
+
+class TestRegistry(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.directory = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_publish_and_read(self):
+        first = make_entry('127.0.0.1', 4626, 'firefox')
+        second = make_entry('127.0.0.1', 4625, 'chrome/chromium')
+        publish(first, self.directory)
+        publish(second, self.directory)
+        assert [second, first] == read_entries(self.directory)
+
+    def test_registry_is_per_user(self):
+        directory = registry_dir()
+        assert os.path.basename(directory).startswith('brotab_mediators-')
+        if hasattr(os, 'getuid'):
+            assert directory.endswith('-%s' % os.getuid())
+
+    def test_private_directory(self):
+        directory = os.path.join(self.directory, 'registry')
+        publish(make_entry('127.0.0.1', 4625, 'firefox'), directory)
+        if os.name == 'posix':
+            assert 0o700 == os.stat(directory).st_mode & 0o777
+
+    def test_unpublish(self):
+        entry = make_entry('127.0.0.1', 4625, 'firefox')
+        publish(entry, self.directory)
+        unpublish(4625, os.getpid() + 1, self.directory)
+        assert [entry] == read_entries(self.directory)
+        unpublish(4625, os.getpid(), self.directory)
+        assert [] == read_entries(self.directory)
+
+    def test_dead_process_is_pruned(self):
+        publish(MediatorEntry('127.0.0.1', 4625, dead_pid(), 'firefox', time.time()), self.directory)
+        assert [] == read_entries(self.directory)
+        assert [] == os.listdir(self.directory)
+
+    def test_reused_pid_is_pruned(self):
+        # the entry is older than the process that has its pid now
+        publish(MediatorEntry('127.0.0.1', 4625, os.getpid(), 'firefox', 0.0), self.directory)
+        assert [] == read_entries(self.directory)
+
+    def test_broken_entry_is_pruned(self):
+        with open(os.path.join(self.directory, '4625.json'), 'w') as file_:
+            file_.write('{"host": ')
+        assert [] == read_entries(self.directory)
+        assert [] == os.listdir(self.directory)
+
+    def test_missing_directory(self):
+        assert [] == read_entries(os.path.join(self.directory, 'missing'))
@@ -0,0 +1,207 @@
+import json
+from threading import Thread
+from unittest import TestCase
+
+from brotab.mediator.remote_api import BrowserRemoteAPI
+from brotab.mediator.tab_model import TabModel
+from brotab.tests.test_transport import QueueTransport
+from brotab.utils import encode_query
+
+
+def make_tab(id_, window_id, index, **kwargs):
+    tab = {'id': id_, 'windowId': window_id, 'index': index,
+           'title': 'title%s' % id_, 'url': 'url%s' % id_,
+           'active': False, 'pinned': False, 'audible': False,
+           'muted': False, 'discarded': False}
+    tab.update(kwargs)
+    return tab
+
+
+def query(**kwargs):
+    return encode_query(json.dumps(kwargs))
+
+
+class TestTabModel(TestCase):
+    def setUp(self):
+        self.model = TabModel()
+        self.model.apply_event({'event': 'tab_snapshot', 'tabs': [
+            make_tab(3, 2, 0),
+            make_tab(1, 1, 0, active=True),
+            make_tab(2, 1, 1, pinned=True),
+        ]})
+
+    def test_not_synced_before_snapshot(self):
+        model = TabModel()
+        model.apply_event({'event': 'tab_updated', 'tab': make_tab(1, 1, 0)})
+        assert model.list_tabs() is None
+        assert model.query_tabs(query(active=True)) is None
+
+    def test_snapshot_is_ordered(self):
+        assert ['1.1\ttitle1\turl1',
+                '1.2\ttitle2\turl2',
+                '2.3\ttitle3\turl3'] == self.model.list_tabs()
+
+    def test_created_tab_shifts_others(self):
+        self.model.apply_event({'event': 'tab_updated', 'tab': make_tab(4, 1, 1)})
+        assert ['1.1', '1.4', '1.2', '2.3'] == self._ids()
+
+    def test_updated_tab_keeps_position(self):
+        self.model.apply_event({'event': 'tab_updated', 'tab': make_tab(1, 1, 0, title='new')})
+        assert '1.1\tnew\turl1' == self.model.list_tabs()[0]
+        assert ['1.1', '1.2', '2.3'] == self._ids()
+
+    def test_moved_and_attached(self):
+        self.model.apply_event({'event': 'tab_updated', 'tab': make_tab(1, 1, 1)})
+        assert ['1.2', '1.1', '2.3'] == self._ids()
+        self.model.apply_event({'event': 'tab_updated', 'tab': make_tab(2, 2, 0)})
+        assert ['1.1', '2.2', '2.3'] == self._ids()
+
+    def test_removed(self):
+        self.model.apply_event({'event': 'tab_removed', 'tab_id': 2})
+        self.model.apply_event({'event': 'tab_removed', 'tab_id': 3})
+        assert ['1.1'] == self._ids()
+
+    def test_activated_tab_deactivates_others(self):
+        self.model.apply_event({'event': 'tab_updated', 'tab': make_tab(2, 1, 1, active=True)})
+        assert ['1.2\ttitle2\turl2'] == self.model.query_tabs(query(active=True))
+
+    def test_query(self):
+        assert ['1.2\ttitle2\turl2'] == self.model.query_tabs(query(pinned='true'))
+        assert ['2.3\ttitle3\turl3'] == self.model.query_tabs(query(windowId='2'))
+        assert ['1.2\ttitle2\turl2'] == self.model.query_tabs(query(windowId=1, index=1))
+
+    def test_unsupported_query_is_not_answered(self):
+        assert self.model.query_tabs(query(currentWindow=True)) is None
+        assert self.model.query_tabs(query(url='*://*.example.com/*')) is None
+
+    def _ids(self):
+        return [line.split('\t')[0] for line in self.model.list_tabs()]
+
+
+class TestTabModelDelta(TestCase):
+    def setUp(self):
+        self.model = TabModel(max_tombstones=2)
+        self.model.apply_event({'event': 'tab_snapshot', 'tabs': [
+            make_tab(1, 1, 0), make_tab(2, 1, 1), make_tab(3, 1, 2)]})
+        self.version = self.model.version
+
+    def test_full_list(self):
+        delta = self.model.delta(0)
+        assert delta['full']
+        assert [('1.1\ttitle1\turl1', 0), ('1.2\ttitle2\turl2', 1), ('1.3\ttitle3\turl3', 2)] == \
+               self._changed(delta)
+
+    def test_no_changes(self):
+        delta = self.model.delta(self.version)
+        assert {'version': self.version, 'full': False, 'changed': [], 'removed': []} == delta
+
+    def test_update(self):
+        self.model.apply_event({'event': 'tab_updated', 'tab': make_tab(2, 1, 1, title='new')})
+        delta = self.model.delta(self.version)
+        assert self.version + 1 == delta['version']
+        assert [('1.2\tnew\turl2', 1)] == self._changed(delta)
+
+    def test_insert_reports_shifted_tabs(self):
+        self.model.apply_event({'event': 'tab_updated', 'tab': make_tab(4, 1, 1)})
+        assert [('1.4\ttitle4\turl4', 1), ('1.2\ttitle2\turl2', 2), ('1.3\ttitle3\turl3', 3)] == \
+               self._changed(self.model.delta(self.version))
+
+    def test_remove(self):
+        self.model.apply_event({'event': 'tab_removed', 'tab_id': 1})
+        delta = self.model.delta(self.version)
+        assert ['1.1'] == delta['removed']
+        assert [('1.2\ttitle2\turl2', 0), ('1.3\ttitle3\turl3', 1)] == self._changed(delta)
+
+    def test_snapshot_reports_only_differences(self):
+        self.model.apply_event({'event': 'tab_snapshot', 'tabs': [
+            make_tab(1, 1, 0), make_tab(3, 1, 1, url='new')]})
+        delta = self.model.delta(self.version)
+        assert ['1.2'] == delta['removed']
+        assert [('1.3\ttitle3\tnew', 1)] == self._changed(delta)
+
+    def test_forgotten_tombstones_give_full_list(self):
+        for tab_id in (1, 2, 3):
+            self.model.apply_event({'event': 'tab_removed', 'tab_id': tab_id})
+        assert self.model.delta(self.version)['full']
+        assert not self.model.delta(self.version + 1)['full']
+
+    def test_unknown_version_gives_full_list(self):
+        assert self.model.delta(self.version + 100)['full']
+
+    @staticmethod
+    def _changed(delta):
+        return [(change['line'], change['index']) for change in delta['changed']]
+
+
+class TestRemoteApiTabModel(TestCase):
+    def setUp(self):
+        self.transport = QueueTransport()
+        self.remote_api = BrowserRemoteAPI(self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+
+    def test_list_tabs_from_pushed_snapshot(self):
+        assert ['1.1\ttitle\turl'] == self._call_list_tabs(['1.1\ttitle\turl'])
+
+        self.remote_api.request_tab_snapshot()
+        assert {'name': 'push_tab_snapshot'} == self.transport.sent.get(timeout=1.0)
+        self.transport.replies.put({'event': 'tab_snapshot', 'tabs': [make_tab(1, 1, 0)]})
+        self.transport.replies.put({'event': 'tab_removed', 'tab_id': 2})
+        # events are applied in order with the replies, after this one
+        # is received the snapshot is in the model
+        assert 'firefox' == self._call_get_browser('firefox')
+
+        assert ['1.1\ttitle1\turl1'] == self.remote_api.list_tabs()
+        assert self.transport.sent.empty()
+
+    def test_script_timeout(self):
+        command = {'name': 'get_text', 'tab_ids': [1, 2, 3], 'concurrency': 2, 'timeout': 1.0}
+        assert 62.0 == self.remote_api._script_timeout(command)
+        assert 65.0 == self.remote_api._script_timeout({'name': 'get_words', 'tab_id': None})
+        # the model doesn't know the number of tabs yet
+        assert 60.0 + 625 * 5.0 == self.remote_api._script_timeout({'name': 'get_text'})
+        self.remote_api.tab_model.apply_event({'event': 'tab_snapshot', 'tabs': [
+            make_tab(id_, 1, id_) for id_ in range(20)]})
+        assert 75.0 == self.remote_api._script_timeout({'name': 'get_text'})
+
+    def test_words_of_many_tabs_from_extension_without_ids(self):
+        # an extension that replies without ids ignores tab_ids too
+        results = []
+        thread = Thread(target=lambda: results.append(self.remote_api.get_words(
+            None, '/\\w+/g', '" "', tab_ids=[1, 2])))
+        thread.start()
+        for tab_id, reply in [(1, ['one\ntwo']), (2, ['two\nthree'])]:
+            command = self.transport.sent.get(timeout=1.0)
+            assert tab_id == command['tab_id']
+            assert 'tab_ids' not in command
+            self.transport.replies.put(reply)
+        thread.join(timeout=1.0)
+        assert [['one', 'three', 'two']] == results
+
+    def test_words_of_many_tabs_in_one_command(self):
+        assert 'firefox' == self._call_get_browser('firefox')
+        results = []
+        thread = Thread(target=lambda: results.append(self.remote_api.get_words(
+            None, '/\\w+/g', '" "', tab_ids=[1, 2])))
+        thread.start()
+        command = self.transport.sent.get(timeout=1.0)
+        assert [1, 2] == command['tab_ids']
+        self.transport.replies.put({'id': command['id'], 'result': ['one', 'two']})
+        thread.join(timeout=1.0)
+        assert [['one', 'two']] == results
+
+    def _call_list_tabs(self, reply):
+        return self._call(self.remote_api.list_tabs, reply)
+
+    def _call_get_browser(self, reply):
+        return self._call(self.remote_api.get_browser, reply)
+
+    def _call(self, method, reply):
+        results = []
+        thread = Thread(target=lambda: results.append(method()))
+        thread.start()
+        command = self.transport.sent.get(timeout=1.0)
+        self.transport.replies.put({'id': command['id'], 'result': reply})
+        thread.join(timeout=1.0)
+        return results[0]
@@ -0,0 +1,319 @@
+import io
+import json
+import os
+import struct
+from itertools import zip_longest
+from queue import Queue
+from threading import Thread
+from unittest import TestCase
+
+from brotab.mediator import transport as transport_module
+from brotab.mediator.transport import FragmentError
+from brotab.mediator.transport import Fragments
+from brotab.mediator.transport import Multiplexer
+from brotab.mediator.transport import StdTransport
+from brotab.mediator.transport import Transport
+from brotab.mediator.transport import TransportError
+
+
+class QueueTransport(Transport):
+    """Commands go to `sent`, messages put into `replies` are received."""
+
+    def __init__(self):
+        self.sent = Queue()
+        self.replies = Queue()
+
+    def send(self, command: dict) -> None:
+        self.sent.put(command)
+
+    def recv(self) -> dict:
+        reply = self.replies.get()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def close(self) -> None:
+        self.replies.put(TransportError('closed'))
+
+
+class TestMultiplexer(TestCase):
+    def setUp(self):
+        self.transport = QueueTransport()
+        self.multiplexer = Multiplexer(self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+
+    def _call_in_thread(self, command):
+        results = []
+        thread = Thread(target=lambda: results.append(self.multiplexer.call(command, timeout=5.0)))
+        thread.start()
+        return thread, results
+
+    def _handshake(self):
+        """Reply to the first command with an id, like an extension that knows ids."""
+        thread, result = self._call_in_thread({'name': 'get_browser'})
+        command = self.transport.sent.get(timeout=1.0)
+        self.transport.replies.put({'id': command['id'], 'result': 'firefox'})
+        thread.join(timeout=1.0)
+        assert ['firefox'] == result
+
+    def test_replies_are_routed_by_id(self):
+        self._handshake()
+        slow_thread, slow_result = self._call_in_thread({'name': 'get_text'})
+        slow = self.transport.sent.get(timeout=1.0)
+        fast_thread, fast_result = self._call_in_thread({'name': 'get_browser'})
+        fast = self.transport.sent.get(timeout=1.0)
+        assert slow['id'] != fast['id']
+
+        self.transport.replies.put({'id': fast['id'], 'result': 'firefox'})
+        fast_thread.join(timeout=1.0)
+        assert ['firefox'] == fast_result
+        assert [] == slow_result
+
+        self.transport.replies.put({'id': slow['id'], 'result': ['1.1\ttitle\turl\ttext']})
+        slow_thread.join(timeout=1.0)
+        assert [['1.1\ttitle\turl\ttext']] == slow_result
+
+    def test_bare_reply_goes_to_oldest_command(self):
+        thread, result = self._call_in_thread({'name': 'get_browser'})
+        self.transport.sent.get(timeout=1.0)
+        self.transport.replies.put('chrome/chromium')
+        thread.join(timeout=1.0)
+        assert ['chrome/chromium'] == result
+
+    def test_one_command_at_a_time_until_replies_have_ids(self):
+        # an extension that doesn't know ids can only be answered in order
+        first_thread, first_result = self._call_in_thread({'name': 'list_tabs'})
+        self.transport.sent.get(timeout=1.0)
+        second_thread, second_result = self._call_in_thread({'name': 'close_tabs'})
+        assert self.transport.sent.empty()
+        self.transport.replies.put(['1.1\ttitle\turl'])
+        first_thread.join(timeout=1.0)
+        assert [['1.1\ttitle\turl']] == first_result
+
+        self.transport.sent.get(timeout=1.0)
+        self.transport.replies.put('OK')
+        second_thread.join(timeout=1.0)
+        assert ['OK'] == second_result
+
+    def test_lockstep_wait_counts_towards_timeout(self):
+        thread, _result = self._call_in_thread({'name': 'list_tabs'})
+        self.transport.sent.get(timeout=1.0)
+        with self.assertRaises(TimeoutError):
+            self.multiplexer.call({'name': 'close_tabs'}, timeout=0.05)
+        self.transport.replies.put([])
+        thread.join(timeout=1.0)
+
+    def test_notify_has_no_id(self):
+        self.multiplexer.notify({'name': 'activate_tab', 'tab_id': 1, 'focused': False})
+        assert {'name': 'activate_tab', 'tab_id': 1, 'focused': False} == self.transport.sent.get(timeout=1.0)
+
+    def test_transport_error_fails_waiting_and_later_calls(self):
+        errors = []
+
+        def call():
+            try:
+                self.multiplexer.call({'name': 'list_tabs'}, timeout=5.0)
+            except TransportError as e:
+                errors.append(e)
+
+        thread = Thread(target=call)
+        thread.start()
+        self.transport.sent.get(timeout=1.0)
+        self.transport.replies.put(TransportError('stdin closed'))
+        thread.join(timeout=1.0)
+        assert 1 == len(errors)
+        with self.assertRaises(TransportError):
+            self.multiplexer.call({'name': 'list_tabs'})
+
+    def test_timeout(self):
+        with self.assertRaises(TimeoutError):
+            self.multiplexer.call({'name': 'list_tabs'}, timeout=0.05)
+
+    def test_events_are_passed_to_listener(self):
+        events = Queue()
+        transport = QueueTransport()
+        Multiplexer(transport, on_event=events.put)
+        transport.replies.put({'event': 'tab_removed', 'tab_id': 1})
+        assert {'event': 'tab_removed', 'tab_id': 1} == events.get(timeout=1.0)
+        transport.close()
+
+    def test_stream(self):
+        chunks = self.multiplexer.stream({'name': 'get_text', 'stream': True}, timeout=1.0)
+        command = self.transport.sent.get(timeout=1.0)
+        self.transport.replies.put({'id': command['id'], 'chunk': 'first'})
+        assert 'first' == next(chunks)
+        self.transport.replies.put({'id': command['id'], 'chunk': 'second'})
+        self.transport.replies.put({'id': command['id'], 'result': []})
+        assert ['second'] == list(chunks)
+
+    def test_stream_from_extension_that_cannot_stream(self):
+        chunks = self.multiplexer.stream({'name': 'get_text', 'stream': True}, timeout=1.0)
+        command = self.transport.sent.get(timeout=1.0)
+        self.transport.replies.put({'id': command['id'], 'result': ['first', 'second']})
+        assert ['first', 'second'] == list(chunks)
+
+    def test_stream_timeout(self):
+        chunks = self.multiplexer.stream({'name': 'get_text', 'stream': True}, timeout=0.05)
+        with self.assertRaises(TimeoutError):
+            next(chunks)
+
+
+class TrickleIO(io.RawIOBase):
+    """Returns at most `step` bytes per read, like a pipe under load."""
+
+    def __init__(self, data, step):
+        self._data = io.BytesIO(data)
+        self._step = step
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._data.read(min(len(buffer), self._step))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def frame(message: bytes) -> bytes:
+    return struct.pack('@I', len(message)) + message
+
+
+class TestStdTransport(TestCase):
+    def _codecs(self):
+        yield False
+        if transport_module.orjson is not None:
+            yield True
+
+    def test_round_trip(self):
+        messages = [{'name': 'list_tabs', 'id': 1},
+                    {'id': 2, 'result': ['1.1\tтитул\thttps://example.com']},
+                    {'id': 3, 'result': 'x' * (3 * transport_module.INITIAL_BUFFER)},
+                    {'id': 4, 'result': None}]
+        for fast_json in self._codecs():
+            output = io.BytesIO()
+            sender = StdTransport(io.BytesIO(), output, fast_json=fast_json)
+            for message in messages:
+                sender.send(message)
+            receiver = StdTransport(io.BytesIO(output.getvalue()), io.BytesIO(),
+                                    fast_json=fast_json)
+            assert messages == [receiver.recv() for _ in messages]
+            with self.assertRaises(TransportError):
+                receiver.recv()
+
+    def test_short_reads(self):
+        data = frame(b'{"id": 1, "result": "first"}') + frame(b'[1, 2, 3]')
+        transport = StdTransport(TrickleIO(data, 3), io.BytesIO())
+        assert {'id': 1, 'result': 'first'} == transport.recv()
+        assert [1, 2, 3] == transport.recv()
+
+    def test_truncated_message(self):
+        data = frame(b'{"id": 1, "result": "first"}')[:-5]
+        transport = StdTransport(io.BytesIO(data), io.BytesIO())
+        with self.assertRaises(TransportError):
+            transport.recv()
+
+    def test_large_buffer_is_not_kept(self):
+        large = 'x' * transport_module.MAX_RETAINED_BUFFER
+        transport = StdTransport(io.BytesIO(frame(b'"%s"' % large.encode())), io.BytesIO())
+        assert large == transport.recv()
+        assert transport_module.INITIAL_BUFFER == len(transport._buffer)
+
+    def test_pipe(self):
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'rb') as input_, open(write_fd, 'wb') as output:
+            sender = StdTransport(io.BytesIO(), output)
+            receiver = StdTransport(input_, io.BytesIO())
+            message = {'id': 1, 'result': ['text'] * 10000}
+            thread = Thread(target=sender.send, args=(message,))
+            thread.start()
+            assert message == receiver.recv()
+            thread.join()
+
+
+def fragments(id_, message, size):
+    """Split a message the way sendToApp of the extension does."""
+    text = json.dumps(message, ensure_ascii=False)
+    length = len(text.encode('utf-16-le')) // 2
+    parts = [text[i:i + size] for i in range(0, len(text), size)]
+    extra = {'id': message['id']} if isinstance(message, dict) and 'id' in message else {}
+    return [dict(extra, fragment=id_, seq=seq, length=length, data=part)
+            for seq, part in enumerate(parts)]
+
+
+class TestFragments(TestCase):
+    def test_fragmented_messages_are_joined(self):
+        first = {'id': 1, 'result': ['1.1\ttitle \U0001F600\turl\t' + 'é' * 100] * 50}
+        second = {'event': 'tab_snapshot', 'tabs': [{'id': 1}] * 100}
+        frames = [frame(b'{"id": 2, "result": "small"}')]
+        # fragments of two messages may come interleaved
+        for pair in zip_longest(fragments(1, first, 1000), fragments(2, second, 100)):
+            frames.extend(frame(json.dumps(fragment).encode()) for fragment in pair if fragment)
+        transport = StdTransport(io.BytesIO(b''.join(frames)), io.BytesIO())
+        assert {'id': 2, 'result': 'small'} == transport.recv()
+        assert [first, second] == [transport.recv(), transport.recv()]
+
+    def test_out_of_order(self):
+        first, second = fragments(1, {'id': 7, 'result': 'x' * 100}, 50)[:2]
+        joiner = Fragments()
+        with self.assertRaises(FragmentError) as error:
+            joiner.add(second)
+        assert 7 == error.exception.id
+        assert joiner.add(first) is None
+
+    def test_too_long(self):
+        fragment = dict(fragments(1, ['x' * 100], 50)[0], length=10)
+        with self.assertRaises(FragmentError) as error:
+            Fragments().add(fragment)
+        assert error.exception.id is None
+
+    def test_incomplete_messages_are_dropped(self):
+        joiner = Fragments(timeout=60.0, max_incomplete=2)
+        messages = [fragments(id_, ['x' * 100], 50) for id_ in range(3)]
+        for parts in messages:
+            assert joiner.add(parts[0]) is None
+        # the oldest one has been dropped
+        with self.assertRaises(FragmentError):
+            joiner.add(messages[0][1])
+        assert joiner.add(messages[1][1]) is None
+
+        joiner = Fragments(timeout=0.0)
+        assert joiner.add(messages[0][0]) is None
+        with self.assertRaises(FragmentError):
+            joiner.add(messages[0][1])
+
+    def test_message_with_reused_id_starts_over(self):
+        joiner = Fragments()
+        assert joiner.add(fragments(1, ['x' * 100], 50)[0]) is None
+        parts = fragments(1, ['y'], 50)
+        assert '["y"]' == joiner.add(parts[0])
+
+    def test_bad_message_fails_only_its_call(self):
+        replies_fd, mediator_in_fd = os.pipe()
+        commands_fd, mediator_out_fd = os.pipe()
+        with open(replies_fd, 'rb') as replies_in, open(mediator_in_fd, 'wb') as replies_out, \
+                open(commands_fd, 'rb') as commands_in, open(mediator_out_fd, 'wb') as commands_out:
+            multiplexer = Multiplexer(StdTransport(replies_in, commands_out))
+            browser = StdTransport(commands_in, replies_out)
+
+            def reply(make_reply):
+                command = browser.recv()
+                message = make_reply(command['id'])
+                replies_out.write(frame(json.dumps(message).encode()))
+                replies_out.flush()
+
+            def call(name, make_reply):
+                thread = Thread(target=reply, args=(make_reply,))
+                thread.start()
+                try:
+                    return multiplexer.call({'name': name}, timeout=5.0)
+                finally:
+                    thread.join()
+
+            # the first reply with an id ends lock-step
+            assert 'firefox' == call('get_browser', lambda id_: {'id': id_, 'result': 'firefox'})
+            with self.assertRaises(FragmentError):
+                call('get_text', lambda id_: fragments(1, {'id': id_, 'result': 'x' * 100}, 50)[1])
+            # the reader is still running
+            assert 'chrome' == call('get_browser', lambda id_: {'id': id_, 'result': 'chrome'})
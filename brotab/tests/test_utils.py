@@ -1,6 +1,9 @@
+import re
 from unittest import TestCase
 
 from brotab.utils import split_tab_ids
+from brotab.utils import squeeze_whitespace
+from brotab.utils import text_hash
 
 
 class TestUtils(TestCase):
@@ -8,3 +11,11 @@ class TestUtils(TestCase):
         text = 'c.1.0 c.1.1\tc.1.2\r\nc.1.3 \r\t\n'
         expected = ['c.1.0', 'c.1.1', 'c.1.2', 'c.1.3']
         self.assertEqual(expected, split_tab_ids(text))
+
+    def test_squeeze_whitespace(self):
+        for text in ['', ' ', '\t\n', 'a', ' a', 'a ', '  a \t\r\n b\x1c c\u2003 ']:
+            self.assertEqual(re.sub(r'\s+', ' ', text), squeeze_whitespace(text))
+
+    def test_text_hash(self):
+        # the extension hashes UTF-8 of the text with SHA-1 too
+        self.assertEqual('1047d6f55a1448dfeae44f7a46b8ad966f7633cf', text_hash('h\u00e9llo\u20ac'))
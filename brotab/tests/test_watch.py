@@ -0,0 +1,135 @@
+from queue import Queue
+from unittest import TestCase
+from uuid import uuid4
+
+from brotab.files import in_temp_dir
+from brotab.search.index import index_lines
+from brotab.search.watch import IndexWatcher
+from brotab.search.watch import acquire_watch_lock
+from brotab.tests.utils import assert_file_absent
+from brotab.tests.utils import assert_sqlite3_table_contents
+
+
+class FakeMediatorAPI:
+    def prefix_match(self, tab):
+        return tab.startswith('a.')
+
+
+class PolledMediatorAPI(FakeMediatorAPI):
+    """Replies to a poll with the next delta put into `deltas`."""
+
+    def __init__(self, name):
+        self._name = name
+        self.deltas = Queue()
+
+    def __str__(self):
+        return self._name
+
+    def list_tabs_delta(self, since, wait):
+        return self.deltas.get()
+
+
+def change(tab_id, url, status='complete'):
+    return {'tab': '%s\ttitle\t%s' % (tab_id, url), 'index': 0, 'status': status}
+
+
+def delta(changed, removed=(), full=False):
+    return {'version': 1, 'full': full, 'changed': changed, 'removed': list(removed)}
+
+
+class TestIndexWatcher(TestCase):
+    def setUp(self):
+        self.sqlite_filename = in_temp_dir(uuid4().hex + '.sqlite')
+        index_lines(self.sqlite_filename, [('a.1.1', 'title', 'url1', 'old text')])
+        self.api = FakeMediatorAPI()
+        self.extracted = []
+        self.watcher = IndexWatcher(lambda: [self.api], self.sqlite_filename, self._extract, rate=100.0)
+        self.watcher.load_index()
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm', '.watch.lock'):
+            assert_file_absent(self.sqlite_filename + suffix)
+
+    def test_indexed_tabs_are_not_extracted_again(self):
+        self.watcher.apply_delta(self.api, delta([change('a.1.1', 'url1')], full=True))
+        assert self.watcher.process(timeout=0) is None
+        assert [] == self.extracted
+
+    def test_tab_is_extracted_when_loaded(self):
+        self.watcher.apply_delta(self.api, delta([change('a.1.2', 'url2', 'loading')]))
+        assert self.watcher.process(timeout=0) is None
+        self.watcher.apply_delta(self.api, delta([change('a.1.2', 'url2')]))
+        self.watcher.process(timeout=0)
+        assert [['a.1.2']] == self.extracted
+        self._assert_rows('a.1.1\ttitle\turl1\told text\na.1.2\ttitle\turl2\ttext of url2')
+
+    def test_navigated_tab_replaces_row(self):
+        self.watcher.apply_delta(self.api, delta([change('a.1.1', 'url3')]))
+        self.watcher.process(timeout=0)
+        self._assert_rows('a.1.1\ttitle\turl3\ttext of url3')
+
+    def test_removed_tabs(self):
+        self.watcher.apply_delta(self.api, delta([], removed=['a.1.1']))
+        self.watcher.process(timeout=0)
+        self._assert_rows('')
+
+    def test_tabs_missing_from_full_list_are_removed(self):
+        self.watcher.apply_delta(self.api, delta([change('a.1.2', 'url2')], full=True))
+        self.watcher.process(timeout=0)
+        self._assert_rows('a.1.2\ttitle\turl2\ttext of url2')
+
+    def test_moved_tab(self):
+        self.watcher.apply_delta(self.api, delta([change('a.2.1', 'url1')]))
+        self.watcher.process(timeout=0)
+        self._assert_rows('a.2.1\ttitle\turl1\ttext of url1')
+
+    def test_failed_extraction_removes_row(self):
+        self.watcher.apply_delta(self.api, delta([change('a.1.1', 'gone')]))
+        self.watcher.process(timeout=0)
+        self._assert_rows('')
+
+    def test_mediators_are_discovered_again(self):
+        apis = []
+        self.watcher._discover = lambda: list(apis)
+        self.watcher.discover()
+        assert [] == self.watcher.apis
+
+        # the browser has started after the watcher
+        first = PolledMediatorAPI('a.\tlocalhost:4625\t100\tfirefox')
+        apis.append(first)
+        self.watcher.discover()
+        assert [first] == self.watcher.apis
+        first.deltas.put(delta([change('a.1.2', 'url2')]))
+        assert self.watcher.process(timeout=5.0) is not None
+        assert [['a.1.2']] == self.extracted
+
+        # the browser has been restarted, its mediator has another pid
+        second = PolledMediatorAPI('a.\tlocalhost:4625\t200\tfirefox')
+        apis[:] = [second]
+        self.watcher.discover()
+        assert [second] == self.watcher.apis
+        assert [str(second)] == list(self.watcher._polls)
+        second.deltas.put(delta([change('a.1.3', 'url3')], full=True))
+        self.watcher.process(timeout=5.0)
+        self._assert_rows('a.1.3\ttitle\turl3\ttext of url3')
+
+        self.watcher.stop()
+        for api in (first, second):
+            api.deltas.put(delta([]))
+
+    def test_single_watcher(self):
+        lock_file = acquire_watch_lock(self.sqlite_filename)
+        assert lock_file is not None
+        assert acquire_watch_lock(self.sqlite_filename) is None
+        lock_file.close()
+        acquire_watch_lock(self.sqlite_filename).close()
+
+    def _extract(self, tab_ids):
+        self.extracted.append(tab_ids)
+        for tab_id in tab_ids:
+            url = self.watcher._tabs[tab_id.split('.')[0] + '.' + tab_id.split('.')[2]][1]
+            if url != 'gone':
+                yield tab_id, 'title', url, 'text of %s' % url
+
+    def _assert_rows(self, expected):
+        assert_sqlite3_table_contents(self.sqlite_filename, 'tabs', expected)
@@ -27,6 +27,7 @@ def assert_sqlite3_table_contents(db_filename, table_name, expected_contents):
     cursor = conn.cursor()
     cursor.execute('select * from %s' % (table_name,))
     actual_contents = '\n'.join(['\t'.join(line) for line in cursor.fetchall()])
+    conn.close()
     assert expected_contents == actual_contents, \
         '"%s" != "%s"' % (expected_contents, actual_contents)
 
@@ -1,3 +1,5 @@
+import hashlib
+import json
 import re
 import shutil
 from base64 import urlsafe_b64decode
@@ -6,12 +8,51 @@ from os.path import expanduser
 from os.path import expandvars
 from os.path import getsize
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def split_tab_ids(string):
     items = re.split(r'[ \t\r\n]+', string)
     return list(filter(None, items))
 
 
+def squeeze_whitespace(string):
+    """
+    Same as re.sub(r'\\s+', ' ', string), several times faster on long
+    texts: str.split splits on the same whitespace characters.
+    """
+    squeezed = ' '.join(string.split())
+    if not squeezed:
+        return ' ' if string else ''
+    if string[0].isspace():
+        squeezed = ' ' + squeezed
+    if string[-1].isspace():
+        squeezed += ' '
+    return squeezed
+
+
+def text_hash(text):
+    """Hash of the text of a tab, the extension computes the same one."""
+    return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def fast_json_dumps(value) -> bytes:
+    """UTF-8 JSON of a value of plain lists, strings and numbers, with orjson if it's installed."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False).encode('utf8')
+
+
+def fast_json_loads(data):
+    """json.loads, with orjson if it's installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 def encode_query(string):
     return str(urlsafe_b64encode(string.encode('utf-8')), 'utf-8')
 